@@ -0,0 +1,153 @@
+import threading
+from collections import OrderedDict
+
+
+class AgentCache:
+    """AgentCache is a bounded LRU cache of the in-memory agents of devices.
+    The cache is bounded by the number of devices and by the estimated memory
+    of the agents, either bound is disabled when it is not positive.
+
+    Pinned entries (agents which are being trained right now) are never
+    evicted. The evicted entries are returned to the caller, which is
+    responsible for checkpointing them.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._pinned = {}
+        self._bytes = 0
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "rehydrations": 0,
+            "rehydration_seconds": 0.0,
+            "rehydration_max_seconds": 0.0,
+        }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def memory(self):
+        """memory returns the estimated memory of all of the cached agents."""
+        with self._lock:
+            return self._bytes
+
+    def get(self, key):
+        """get returns the cached entry and marks it as the most recently
+        used one, or None if the entry is not cached. Counts hits and misses.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def peek(self, key):
+        """peek returns the cached entry without touching the statistics or
+        the order of the entries.
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, value, size=0):
+        """put will cache the entry and return a list of (key, value) pairs
+        which had to be evicted to stay within the bounds.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizes[key]
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self._bytes += size
+
+            return self._evict(keep=key)
+
+    def resize(self, key, value, size):
+        """resize will update the size of the entry and mark it as the most
+        recently used one, only if the entry is still the given value. Returns
+        the evicted (key, value) pairs like put.
+        """
+        with self._lock:
+            if self._entries.get(key) is not value:
+                return []
+            self._bytes += size - self._sizes[key]
+            self._sizes[key] = size
+            self._entries.move_to_end(key)
+
+            return self._evict(keep=key)
+
+    def pop(self, key):
+        """pop removes the entry from the cache and returns it."""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._bytes -= self._sizes.pop(key)
+            return value
+
+    def pin(self, key):
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self._lock:
+            count = self._pinned.get(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+            else:
+                self._pinned.pop(key, None)
+
+    def record_rehydration(self, seconds):
+        """record_rehydration will account the time it took to rebuild an
+        evicted agent from its checkpoint.
+        """
+        with self._lock:
+            self.stats["rehydrations"] += 1
+            self.stats["rehydration_seconds"] += seconds
+            self.stats["rehydration_max_seconds"] = max(
+                self.stats["rehydration_max_seconds"], seconds)
+
+    def _over_budget(self):
+        if self.max_entries > 0 and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes > 0 and self._bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self, keep):
+        """Evicts the least recently used entries while the cache is over
+        budget. Must be called with the lock held.
+        """
+        evicted = []
+
+        for key in list(self._entries):
+            if not self._over_budget():
+                break
+            if key == keep or key in self._pinned:
+                continue
+
+            evicted.append((key, self._entries.pop(key)))
+            self._bytes -= self._sizes.pop(key)
+            self.stats["evictions"] += 1
+
+        return evicted
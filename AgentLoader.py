@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import threading
+
+
+class AgentLoader:
+    """AgentLoader creates the agent, and with it imports TensorFlow and
+    tf_agents, on a background thread so that the MQTT front end can answer
+    right away. It stands in for the agent: the training calls wait until
+    the agent is loaded, while the calls made when serving models and
+    intervals are answered without loading it.
+    """
+
+    def __init__(self, factory, model_dir="models", shared_key=None):
+        """
+        Args:
+            factory: a callable() which imports the ML stack and returns the
+                agent.
+            model_dir: the directory of the exported models.
+            shared_key: the export key of a model shared by every device, or
+                None if every device has its own model.
+        """
+        self._factory = factory
+        self._model_dir = model_dir
+        self._shared_key = shared_key
+
+        self._agent = None
+        self._error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+
+        self.load_seconds = None
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set() and self._agent is not None
+
+    def start(self):
+        """start loads the agent in the background, unless it is loaded or
+        being loaded already.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._load,
+                                            name="hades-agent-loader",
+                                            daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        started = time.monotonic()
+        try:
+            self._agent = self._factory()
+            self.load_seconds = time.monotonic() - started
+            logging.info("loaded the agent in %.2fs", self.load_seconds)
+        except Exception as e:
+            self._error = e
+            logging.exception("failed to load the agent")
+        finally:
+            self._loaded.set()
+
+    def get(self):
+        """get returns the agent, loading it first if needed."""
+        self.start()
+        self._loaded.wait()
+        if self._agent is None:
+            raise RuntimeError("the agent failed to load: %r" % self._error)
+        return self._agent
+
+    @property
+    def devices(self):
+        if not self.loaded:
+            return []
+        return self._agent.devices
+
+    def device_exists(self, mac):
+        return self.get().device_exists(mac)
+
+    def add_device(self, mac):
+        return self.get().add_device(mac)
+
+    def release(self, mac):
+        if self.loaded:
+            self._agent.release(mac)
+
+    def train(self, mac, steps=1, before_step=None):
+        return self.get().train(mac, steps=steps, before_step=before_step)
+
+    def export_key(self, mac):
+        if self.loaded:
+            return self._agent.export_key(mac)
+        return self._shared_key or mac
+
+    def needs_export(self, mac):
+        # nothing was trained before the agent was loaded.
+        if not self.loaded:
+            return False
+        return self._agent.needs_export(mac)
+
+    def export(self, key):
+        return self.get().export(key)
+
+    def model_path(self, mac):
+        if self.loaded:
+            return self._agent.model_path(mac)
+        return os.path.join(self._model_dir, self.export_key(mac))
+
+    def save_checkpoint(self, mac):
+        if self.loaded:
+            self._agent.save_checkpoint(mac)
+
+    def save_overdue(self):
+        if self.loaded:
+            self._agent.save_overdue()
+
+    def cache_stats(self):
+        if not self.loaded:
+            return {}
+        return self._agent.cache_stats()
+
+    def replay_stats(self):
+        if not self.loaded:
+            return {}
+        return self._agent.replay_stats()
+
+    def close(self):
+        """close waits for an agent being loaded and closes it."""
+        if self._thread is None:
+            return
+        self._loaded.wait()
+        if self._agent is not None:
+            self._agent.close()
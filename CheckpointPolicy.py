@@ -0,0 +1,83 @@
+import threading
+import time
+
+
+class CheckpointPolicy:
+    """CheckpointPolicy decides when the training state of an agent should be
+    written to its checkpoint. Agents are kept in memory between training
+    steps, so the checkpoint is only needed to recover from a crash and at
+    most every_steps training steps or every_seconds seconds of training are
+    lost. The time bound of an agent which isn't trained again is kept by
+    sweeping the overdue agents periodically.
+    """
+
+    # seconds between the sweeps of the overdue agents, at most
+    sweep_interval = 1.0
+
+    def __init__(self, every_steps=1, every_seconds=0, on_shutdown=True):
+        """
+        Args:
+            every_steps: save after this many training steps, disabled if not
+                positive.
+            every_seconds: save if this many seconds have passed since the
+                last save, disabled if not positive.
+            on_shutdown: save everything that is unsaved on shutdown.
+        """
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.on_shutdown = on_shutdown
+
+        self._lock = threading.Lock()
+        self._steps = {}
+        self._saved_at = {}
+
+    def step(self, key, now=None):
+        """step will count a training step of the given agent and return True
+        if a checkpoint is due.
+        """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            steps = self._steps.get(key, 0) + 1
+            self._steps[key] = steps
+            saved_at = self._saved_at.setdefault(key, now)
+
+        if self.every_steps > 0 and steps >= self.every_steps:
+            return True
+        if self.every_seconds > 0 and now - saved_at >= self.every_seconds:
+            return True
+        return False
+
+    def saved(self, key, now=None):
+        """saved will reset the counters after a checkpoint of the agent was
+        written.
+        """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            self._steps[key] = 0
+            self._saved_at[key] = now
+
+    def unsaved(self):
+        """unsaved returns the agents which have training steps that are not
+        in a checkpoint yet.
+        """
+        with self._lock:
+            return [key for key, steps in self._steps.items() if steps > 0]
+
+    def overdue(self, now=None):
+        """overdue returns the agents with unsaved training steps which were
+        last saved at least every_seconds ago.
+        """
+        if self.every_seconds <= 0:
+            return []
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            return [key for key, steps in self._steps.items() if steps > 0 and
+                    now - self._saved_at[key] >= self.every_seconds]
+
+    def forget(self, key):
+        with self._lock:
+            self._steps.pop(key, None)
+            self._saved_at.pop(key, None)
@@ -0,0 +1,152 @@
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """HashRing is a consistent hash ring which maps MAC addresses to the
+    workers owning them. When a worker joins or leaves, only the devices on
+    its part of the ring change their owner.
+    """
+
+    def __init__(self, members=(), vnodes=64):
+        self.vnodes = vnodes
+        self._members = set()
+        self._points = []
+        self._owners = []
+
+        for member in members:
+            self.add(member)
+
+    def members(self):
+        return sorted(self._members)
+
+    def add(self, member):
+        if member in self._members:
+            return False
+        self._members.add(member)
+        self._rebuild()
+        return True
+
+    def remove(self, member):
+        if member not in self._members:
+            return False
+        self._members.discard(member)
+        self._rebuild()
+        return True
+
+    def owner(self, key):
+        """owner returns the member owning the key or None if the ring is
+        empty.
+        """
+        if not self._points:
+            return None
+
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def _rebuild(self):
+        ring = sorted((_hash("%s#%d" % (member, i)), member)
+                      for member in self._members
+                      for i in range(self.vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [member for _, member in ring]
+
+
+class Cluster:
+    """Cluster splits the devices between several Hades workers. Every worker
+    announces itself with a retained message on hades/cluster/<worker id>,
+    which is cleared by its last will when it goes away. All of the workers
+    see the same members and so agree on the owner of every MAC address.
+
+    The members settle for a while after a worker connects or the members
+    change: a worker doesn't own the devices it is handed until then, so the
+    retained announcements arrive and the previous owner writes out the
+    states and checkpoints of the devices first.
+    """
+
+    topic_prefix = "hades/cluster"
+
+    def __init__(self, worker_id, vnodes=64, settle_seconds=0.0):
+        self.worker_id = worker_id
+        self.settle_seconds = settle_seconds
+
+        self._lock = threading.Lock()
+        self._ring = HashRing([worker_id], vnodes=vnodes)
+        # the ring before the changes of the settle period.
+        self._previous = self._ring
+        self._settle_until = 0.0
+
+    def members_topic(self):
+        return self.topic_prefix + "/+"
+
+    def member_topic(self, worker_id=None):
+        return "%s/%s" % (self.topic_prefix,
+                          worker_id if worker_id else self.worker_id)
+
+    def members(self):
+        with self._lock:
+            return self._ring.members()
+
+    def join(self):
+        """join will start over with this worker alone when it connects, the
+        retained announcements of the other workers follow. Until they have
+        settled no device is owned.
+        """
+        with self._lock:
+            self._ring = HashRing([self.worker_id], vnodes=self._ring.vnodes)
+            self._previous = HashRing(vnodes=self._ring.vnodes)
+            self._settle_until = time.monotonic() + self.settle_seconds
+
+    def settled(self):
+        with self._lock:
+            return time.monotonic() >= self._settle_until
+
+    def owns(self, mac):
+        """owns returns True if the device is assigned to this worker and was
+        already before the members started to settle.
+        """
+        with self._lock:
+            if self._ring.owner(mac) != self.worker_id:
+                return False
+            return time.monotonic() >= self._settle_until or \
+                self._previous.owner(mac) == self.worker_id
+
+    def owner(self, mac):
+        """owner returns the worker the device is assigned to."""
+        with self._lock:
+            return self._ring.owner(mac)
+
+    def on_member(self, topic, payload):
+        """on_member will update the members from an announcement, an empty
+        payload means that the worker has left. Returns True if the members
+        have changed.
+        """
+        worker_id = topic[len(self.topic_prefix) + 1:]
+        if not worker_id or worker_id == self.worker_id:
+            return False
+
+        with self._lock:
+            # the ring is replaced rather than changed, it is kept as the
+            # previous one if the members have settled.
+            ring = HashRing(self._ring.members(), vnodes=self._ring.vnodes)
+            if payload:
+                changed = ring.add(worker_id)
+            else:
+                changed = ring.remove(worker_id)
+
+            if changed:
+                if time.monotonic() >= self._settle_until:
+                    self._previous = self._ring
+                self._ring = ring
+                self._settle_until = time.monotonic() + self.settle_seconds
+
+        if changed:
+            logging.info("cluster members changed: %s", self.members())
+        return changed
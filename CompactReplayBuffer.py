@@ -0,0 +1,308 @@
+import os
+import logging
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    print("failed to import numpy")
+
+try:
+    import tensorflow as tf
+except ImportError:
+    print("failed to import tensorflow")
+
+
+def storage_dtype(dtype, minimum=None, maximum=None, half_precision=False):
+    """storage_dtype returns the smallest dtype which can keep the values of
+    a field. Integers are narrowed when the bounds of the spec fit, floats
+    are kept as float16 only if half precision is asked for.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.dtype(np.float16) if half_precision else dtype
+
+    if dtype.kind in 'iu' and minimum is not None and maximum is not None:
+        for candidate in (np.int8, np.int16, np.int32):
+            info = np.iinfo(candidate)
+            if (info.min <= np.min(minimum) and
+                    np.max(maximum) <= info.max):
+                return np.dtype(candidate)
+    return dtype
+
+
+class Field:
+    """Field describes one flattened part of the stored items."""
+    __slots__ = ("shape", "dtype", "storage")
+
+    def __init__(self, shape, dtype, minimum=None, maximum=None,
+                 half_precision=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.storage = storage_dtype(dtype, minimum, maximum, half_precision)
+
+
+class CompactReplayBuffer:
+    """CompactReplayBuffer is a NumPy ring buffer of the transitions of a
+    single device. It starts small and doubles its capacity until it reaches
+    the maximum, after which the oldest transitions are overwritten, so that
+    a device which sends a few readings an hour doesn't hold a buffer sized
+    for a busy one.
+
+    The buffer of a cold device can be spilled to memory-mapped files and is
+    loaded back into memory when the device is trained again.
+    """
+
+    def __init__(self, fields, max_length=100000, initial_length=64,
+                 data_spec=None):
+        """
+        Args:
+            fields: a list of Field, one for every flattened part of an item.
+            max_length: the maximum number of kept items.
+            initial_length: the number of items allocated at first.
+            data_spec: the nest of specs the items are packed into when
+                sampled as tensors.
+        """
+        self.fields = fields
+        self.max_length = max(1, max_length)
+        self.data_spec = data_spec
+
+        self._lock = threading.Lock()
+        self._length = min(max(1, initial_length), self.max_length)
+        self._arrays = [np.zeros((self._length,) + field.shape,
+                                 dtype=field.storage) for field in fields]
+        self._next = 0
+        self._size = 0
+        self._spill_path = None
+
+    @classmethod
+    def from_spec(cls, data_spec, half_precision=False, **kwargs):
+        """from_spec builds the buffer for the items of a nest of TensorSpecs,
+        such as the collect data spec of an agent.
+        """
+        fields = []
+        for spec in tf.nest.flatten(data_spec):
+            fields.append(Field(spec.shape, spec.dtype.as_numpy_dtype,
+                                getattr(spec, "minimum", None),
+                                getattr(spec, "maximum", None),
+                                half_precision))
+        return cls(fields, data_spec=data_spec, **kwargs)
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+    @property
+    def capacity(self):
+        with self._lock:
+            return self._length
+
+    @property
+    def spilled(self):
+        with self._lock:
+            return self._spill_path is not None
+
+    def memory(self):
+        """memory returns the bytes of the buffer kept in memory, a spilled
+        buffer is kept in the page cache instead.
+        """
+        with self._lock:
+            if self._spill_path is not None:
+                return 0
+            return sum(array.nbytes for array in self._arrays)
+
+    def disk(self):
+        """disk returns the bytes of the buffer spilled to disk."""
+        with self._lock:
+            if self._spill_path is None:
+                return 0
+            return sum(array.nbytes for array in self._arrays)
+
+    def add_batch(self, items):
+        """add_batch adds a batch of items, given as a nest of tensors or
+        arrays with the batch as the outer dimension.
+        """
+        if self.data_spec is not None:
+            items = tf.nest.flatten(items)
+        values = [np.asarray(value) for value in items]
+        count = len(values[0])
+
+        with self._lock:
+            if self._size + count > self._length:
+                self._grow(self._size + count)
+
+            index = (self._next + np.arange(count)) % self._length
+            for array, value in zip(self._arrays, values):
+                array[index] = value
+
+            self._next = (self._next + count) % self._length
+            self._size = min(self._size + count, self._length)
+
+    def _grow(self, needed):
+        """Must be called with the lock held. Doubles the capacity until the
+        needed number of items fit or the maximum is reached. The items are
+        kept in their order, starting with the oldest one.
+        """
+        length = self._length
+        while length < needed and length < self.max_length:
+            length = min(length * 2, self.max_length)
+        if length == self._length:
+            return
+
+        order = self._order()
+        arrays = []
+        for field, array in zip(self.fields, self._arrays):
+            grown = np.zeros((length,) + field.shape, dtype=field.storage)
+            grown[:self._size] = array[order]
+            arrays.append(grown)
+
+        # a grown buffer lives in memory
+        self._drop_spill()
+        self._arrays = arrays
+        self._length = length
+        self._next = self._size % length
+
+    def _order(self):
+        """Must be called with the lock held. Returns the indices of the
+        items from the oldest to the newest.
+        """
+        start = (self._next - self._size) % self._length
+        return (start + np.arange(self._size)) % self._length
+
+    def sample(self, batch_size, num_steps=None):
+        """sample returns a list of arrays, one for every field, of uniformly
+        sampled items. If num_steps is given, sequences of that many
+        consecutive items are sampled and the arrays are [batch, steps, ...].
+        """
+        steps = 1 if num_steps is None else num_steps
+
+        with self._lock:
+            if self._size < steps:
+                raise ValueError("replay buffer has %d items, %d needed" %
+                                 (self._size, steps))
+
+            starts = np.random.randint(0, self._size - steps + 1,
+                                       size=batch_size)
+            logical = starts[:, None] + np.arange(steps)
+            if num_steps is None:
+                logical = logical[:, 0]
+            index = ((self._next - self._size + logical) % self._length)
+
+            return [array[index].astype(field.dtype)
+                    for field, array in zip(self.fields, self._arrays)]
+
+    def as_dataset(self, sample_batch_size=None, num_steps=None,
+                   num_parallel_calls=None):
+        """as_dataset returns a dataset of sampled items as tensors, shaped
+        like the samples of TFUniformReplayBuffer. Every element is sampled
+        from the contents of the buffer when it is requested.
+        """
+        batch_size = 1 if sample_batch_size is None else sample_batch_size
+
+        def shape(field):
+            outer = (batch_size,) if num_steps is None else \
+                (batch_size, num_steps)
+            return outer + field.shape
+
+        signature = tuple(tf.TensorSpec(shape(field), field.dtype)
+                          for field in self.fields)
+
+        def generate():
+            while True:
+                yield tuple(self.sample(batch_size, num_steps))
+
+        dataset = tf.data.Dataset.from_generator(
+            generate, output_signature=signature)
+
+        def pack(*values):
+            if sample_batch_size is None:
+                values = [value[0] for value in values]
+            return tf.nest.pack_sequence_as(self.data_spec, list(values)), ()
+
+        return dataset.map(pack)
+
+    def spill(self, path):
+        """spill moves the buffer to memory-mapped files under the path."""
+        with self._lock:
+            if self._spill_path is not None:
+                return
+
+            os.makedirs(path, exist_ok=True)
+            arrays = []
+            for i, array in enumerate(self._arrays):
+                mapped = np.lib.format.open_memmap(
+                    os.path.join(path, "%d.npy" % i), mode='w+',
+                    dtype=array.dtype, shape=array.shape)
+                mapped[:] = array
+                mapped.flush()
+                arrays.append(mapped)
+
+            self._arrays = arrays
+            self._spill_path = path
+
+        logging.debug("spilled replay buffer to %s", path)
+
+    def unspill(self):
+        """unspill loads a spilled buffer back into memory."""
+        with self._lock:
+            if self._spill_path is None:
+                return
+            self._arrays = [np.array(array) for array in self._arrays]
+            self._drop_spill()
+
+    def close(self):
+        """close removes the spill files of the buffer, if there are any."""
+        with self._lock:
+            self._drop_spill()
+
+    def _drop_spill(self):
+        """Must be called with the lock held."""
+        path, self._spill_path = self._spill_path, None
+        if path is None:
+            return
+
+        for i in range(len(self.fields)):
+            try:
+                os.remove(os.path.join(path, "%d.npy" % i))
+            except OSError:
+                pass
+
+    def save(self, path):
+        """save writes the items of the buffer, from the oldest one."""
+        with self._lock:
+            order = self._order()
+            arrays = {"f%d" % i: array[order]
+                      for i, array in enumerate(self._arrays)}
+
+        tmp_file = path + ".tmp.npz"
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, path)
+
+    def restore(self, path):
+        """restore reads the items written by save, returns False if there
+        is nothing to restore.
+        """
+        try:
+            with np.load(path) as data:
+                values = [data["f%d" % i] for i in range(len(self.fields))]
+        except (OSError, KeyError, ValueError):
+            return False
+
+        count = len(values[0])
+        if count > self.max_length:
+            values = [value[-self.max_length:] for value in values]
+            count = self.max_length
+
+        with self._lock:
+            self._drop_spill()
+            self._length = max(self._length, count)
+            self._arrays = []
+            for field, value in zip(self.fields, values):
+                array = np.zeros((self._length,) + field.shape,
+                                 dtype=field.storage)
+                array[:count] = value
+                self._arrays.append(array)
+            self._size = count
+            self._next = count % self._length
+        return True
@@ -0,0 +1,230 @@
+import os
+import json
+import logging
+import threading
+from hades_utils import num, verify_mac
+
+
+class DeviceState:
+    """DeviceState is a compact record of the statistics of a single device,
+    the same values that are kept under 'stats' in the state files.
+    """
+    __slots__ = ("prev_temperature", "prev_delta", "curr_temperature",
+                 "send_interval")
+
+    def __init__(self, prev_temperature=-999, prev_delta=0,
+                 curr_temperature=-999, send_interval=1):
+        self.prev_temperature = prev_temperature
+        self.prev_delta = prev_delta
+        self.curr_temperature = curr_temperature
+        self.send_interval = send_interval
+
+    def copy(self):
+        return DeviceState(self.prev_temperature, self.prev_delta,
+                           self.curr_temperature, self.send_interval)
+
+    def to_dict(self):
+        return {
+            'stats': {
+                'prev_temperature': self.prev_temperature,
+                'prev_delta': self.prev_delta,
+                'curr_temperature': self.curr_temperature,
+                'send_interval': self.send_interval,
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = data['stats']
+        return cls(num(stats['prev_temperature']), num(stats['prev_delta']),
+                   num(stats['curr_temperature']), num(stats['send_interval']))
+
+
+class DeviceStateStore:
+    """DeviceStateStore keeps the state of every device in memory and writes
+    the changed states to the state directory in the background, so that
+    handling a statistics message doesn't read and rewrite the state file.
+
+    The files keep the same JSON layout as before, so they can be reloaded
+    on startup.
+    """
+
+    def __init__(self, state_dir="states", flush_interval=1.0):
+        """
+        Args:
+            state_dir: the directory where the state files are kept, the
+                states are only kept in memory if it is None.
+            flush_interval: the number of seconds between write-behind
+                flushes. When it is not positive, every update is written to
+                disk immediately.
+        """
+        self.state_dir = state_dir
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._states = {}
+        self._dirty = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """load will read all of the state files from the state directory.
+        Returns the number of loaded devices.
+        """
+        if self.state_dir is None or not os.path.isdir(self.state_dir):
+            return 0
+
+        count = 0
+        for mac in os.listdir(self.state_dir):
+            if verify_mac(mac) and self.load_device(mac):
+                count += 1
+
+        logging.info("loaded %d device states from %s", count, self.state_dir)
+        return count
+
+    def load_device(self, mac):
+        """load_device will (re)read the state file of a single device.
+        Returns True if the state was loaded.
+        """
+        if self.state_dir is None:
+            return False
+
+        state_file = os.path.join(self.state_dir, mac)
+        if not os.path.isfile(state_file):
+            return False
+
+        try:
+            with open(state_file, 'r') as json_file:
+                state = DeviceState.from_dict(json.load(json_file))
+        except (ValueError, KeyError, TypeError):
+            logging.error("failed to load the state of %s", mac)
+            return False
+
+        with self._lock:
+            self._states[mac] = state
+            self._dirty.discard(mac)
+        return True
+
+    def ensure(self, mac):
+        """ensure will read the state file of the device if its state isn't
+        in memory, e.g. when the device was handled by another worker.
+        Returns True if the device has a state.
+        """
+        if self.exists(mac):
+            return True
+        return self.load_device(mac)
+
+    def release(self, mac):
+        """release will write out the state of the device if it has changed
+        and drop it from memory.
+        """
+        with self._io_lock:
+            with self._lock:
+                state = self._states.pop(mac, None)
+                dirty = mac in self._dirty
+                self._dirty.discard(mac)
+
+            if state is not None and dirty:
+                self._write(mac, state.to_dict())
+
+    def exists(self, mac):
+        with self._lock:
+            return mac in self._states
+
+    def keys(self):
+        with self._lock:
+            return list(self._states)
+
+    def get(self, mac):
+        """get returns a copy of the state of the device or None if the
+        device has no state.
+        """
+        with self._lock:
+            state = self._states.get(mac)
+            return state.copy() if state is not None else None
+
+    def observe(self, mac, temperature):
+        """observe will apply a received temperature reading to the state of
+        the device, keeping the values which exist already. If it is the
+        first reading of the device then default values are used.
+        """
+        with self._lock:
+            state = self._states.get(mac)
+            if state is None:
+                state = self._states[mac] = DeviceState(
+                    prev_temperature=temperature, prev_delta=0,
+                    send_interval=1)
+
+            state.curr_temperature = temperature
+            self._dirty.add(mac)
+
+        self._written(mac)
+
+    def update(self, mac, **values):
+        """update will set the given values of the state of the device."""
+        with self._lock:
+            state = self._states.get(mac)
+            if state is None:
+                state = self._states[mac] = DeviceState()
+
+            for name, value in values.items():
+                setattr(state, name, value)
+            self._dirty.add(mac)
+
+        self._written(mac)
+
+    def _written(self, mac):
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """flush will write all of the changed states to disk in one batch."""
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                batch = [(mac, self._states[mac].to_dict())
+                         for mac in self._dirty]
+                self._dirty.clear()
+
+            for mac, data in batch:
+                self._write(mac, data)
+
+    def _write(self, mac, data):
+        """Must be called with the I/O lock held."""
+        if self.state_dir is None:
+            return
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_file = os.path.join(self.state_dir, mac)
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(tmp_file, state_file)
+
+    def start(self):
+        """start will start the write-behind flushing thread."""
+        if self.flush_interval <= 0 or self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="hades-state-flush",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """close will stop the flushing thread and write out what is left."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                logging.exception("failed to flush device states")
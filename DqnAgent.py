@@ -1,16 +1,26 @@
 import os
+import time
 import logging
+import threading
+from AgentCache import AgentCache
+from CheckpointPolicy import CheckpointPolicy
+from CompactReplayBuffer import CompactReplayBuffer
+from DeviceStateStore import DeviceStateStore
+from Metrics import Metrics
+from NumpyPolicy import NumpyPolicy, SUFFIX as NUMPY_SUFFIX
 
 try:
+    import numpy as np
     import tensorflow as tf
     try:
-        from SensorEnvironment import SensorEnv
+        from SensorEnvironment import SensorEnv, tf_sensor_step
         from tf_agents.trajectories import trajectory
+        from tf_agents.trajectories import time_step as ts
         from tf_agents.environments import tf_py_environment
         from tf_agents.agents.dqn import dqn_agent
         from tf_agents.networks import q_network
-        from tf_agents.replay_buffers import tf_uniform_replay_buffer as replay
         from tf_agents.policies import policy_saver
+        from tf_agents.specs import tensor_spec
         from tf_agents.utils import common
     except ImportError:
         print("failed to import libraries")
@@ -18,6 +28,89 @@ except ImportError:
     print("failed to import tensorflow or numpy")
 
 
+def convert_policy_to_tflite(policy, model_file):
+    """convert_policy_to_tflite converts the 'action' of the in-memory policy
+    to the TensorFlow Lite model using its concrete function and writes it to
+    the given file, without a round-trip through a SavedModel on disk.
+    """
+    time_step_spec = tensor_spec.add_outer_dims_nest(policy.time_step_spec,
+                                                     (None,))
+
+    @tf.function(input_signature=[time_step_spec])
+    def action(time_step):
+        return policy.action(time_step).action
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [action.get_concrete_function()], policy)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS,
+                                           tf.lite.OpsSet.SELECT_TF_OPS]
+    tflite_model = converter.convert()
+
+    tmp_file = model_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(tflite_model)
+    os.replace(tmp_file, model_file)
+
+
+def convert_q_network_to_numpy(q_net, model_file):
+    """convert_q_network_to_numpy writes the weights of the Q-network next to
+    the TensorFlow Lite model, so that the greedy actions can be computed
+    without TensorFlow.
+    """
+    NumpyPolicy.from_q_network(q_net).save(model_file + NUMPY_SUFFIX)
+
+
+# the temperature deltas on which the greedy actions of a policy are compared
+# to tell whether the policy has changed meaningfully since the last export.
+PROBE_MAX_DELTA = 10
+PROBE_POINTS = 41
+
+
+def policy_signature(q_net):
+    """policy_signature returns the greedy actions of the Q-network for the
+    probe observations.
+    """
+    probe = np.linspace(0, PROBE_MAX_DELTA, PROBE_POINTS, dtype=np.float32)
+    return tuple(NumpyPolicy.from_q_network(q_net).actions(probe).tolist())
+
+
+class DeviceAgent:
+    """DeviceAgent keeps all of the parts of the DQN agent of a single device,
+    so that they can be built, cached and dropped together.
+    """
+    __slots__ = ("mac", "env", "train_env", "q_net", "global_step", "agent",
+                 "eval_policy", "collect_policy", "replay_buffer",
+                 "train_checkpointer", "policy_saver", "checkpoint_dir",
+                 "policy_dir", "initial_step", "lock", "version",
+                 "exported_version", "signature", "exported_signature",
+                 "iterator", "iteration", "time_step", "compiled")
+
+    def __init__(self, mac, checkpoint_dir, policy_dir):
+        self.mac = mac
+        self.checkpoint_dir = checkpoint_dir
+        self.policy_dir = policy_dir
+        self.initial_step = True
+
+        # the long-lived iterator sampling the replay buffer
+        self.iterator = None
+
+        # the compiled collect and train steps, with the step count and the
+        # current time step of the environment they keep themselves.
+        self.compiled = None
+        self.iteration = 0
+        self.time_step = None
+
+        # training and export of the device must not run at the same time.
+        self.lock = threading.Lock()
+
+        # the version is bumped on every training step, the signature is
+        # the greedy behaviour of the policy.
+        self.version = 0
+        self.exported_version = -1
+        self.signature = None
+        self.exported_signature = None
+
+
 class DqnAgent:
 
     # Hyperparameters for the network
@@ -25,94 +118,226 @@ class DqnAgent:
     log_interval = 1
     collect_steps_per_iteration = 1
     replay_buffer_max_length = 100000
-
-    def __init__(self):
-        # Dictionaries that keep parts of DqnAgent for different devices
-        # XXX: this whole class is a mess - optimizations non-existant.
-        self.devices = []
-        self.env = {}
-        self.train_env = {}
-        self.train_checkpointer = {}
-        self.policy_saver = {}
-        self.global_step = {}
-        self.agent = {}
-        self.q_net = {}
-        self.eval_policy = {}
-        self.collect_policy = {}
-        self.checkpoint_dirs = {}
-        self.policy_dirs = {}
-        self.replay_buffer = {}
-        self.initial_training = {}
-        self.initial_step = {}
+    replay_buffer_initial_length = 64
+
+    def __init__(self, state_store=None, checkpoint_policy=None,
+                 agent_cache=None, sample_batch_size=2, num_steps=2,
+                 train_steps=1, replay_config=None, compiled=False,
+                 jit_compile=False, metrics=None):
+        # the device states shared with the environments
+        if state_store is None:
+            state_store = DeviceStateStore(flush_interval=0)
+        self.state_store = state_store
+
+        # the timings of the training stages, disabled unless given.
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+        # collect and train with a compiled function instead of stepping
+        # the Python environment, optionally compiled with XLA.
+        self.compiled = compiled
+        self.jit_compile = jit_compile
+
+        # the experience sampled for every gradient step and the number of
+        # gradient steps taken for every training request, 0 only collects.
+        self.sample_batch_size = sample_batch_size
+        self.num_steps = max(2, num_steps)
+        self.train_steps = max(0, train_steps)
+
+        # the replay buffers start small and grow up to the maximum length,
+        # the buffers of all but the most recently trained devices may be
+        # spilled to disk.
+        replay_config = dict(replay_config or {})
+        self.replay_max_length = replay_config.get(
+            "max_length", self.replay_buffer_max_length)
+        self.replay_initial_length = replay_config.get(
+            "initial_length", self.replay_buffer_initial_length)
+        self.replay_half_precision = replay_config.get("half_precision",
+                                                       False)
+        self.replay_hot_devices = replay_config.get("hot_devices", 0)
+        self.replay_spill_dir = replay_config.get("spill_dir", "replay")
+        self.replay_spill_interval = replay_config.get("spill_interval",
+                                                       10.0)
+        self._spill_lock = threading.Lock()
+        self._spilled_at = time.monotonic()
+
+        # agents are kept in memory, checkpoints are only written when the
+        # policy says so and restored when a device is added.
+        if checkpoint_policy is None:
+            checkpoint_policy = CheckpointPolicy()
+        self.checkpoint_policy = checkpoint_policy
+
+        # the agents of the devices, idle ones are evicted when the cache is
+        # over its budget and rebuilt from their checkpoints when needed.
+        if agent_cache is None:
+            agent_cache = AgentCache()
+        self.agents = agent_cache
+        self._evicted = set()
 
         self.checkpoint_dir = "checkpoints"
         self.policy_dir = "policies"
+        self.model_dir = "models"
 
         logging.info("initialized DqnAgent")
         return
 
+    @property
+    def devices(self):
+        """devices returns the MAC addresses of the devices in memory."""
+        return self.agents.keys()
+
     def device_exists(self, mac):
-        if mac in self.devices:
+        if self.agents.get(mac) is not None:
             return True
         return False
 
     def add_device(self, mac):
-        self.devices.append(mac)
-        self.initial_training[mac] = True
-        self.initial_step[mac] = True
+        started = time.monotonic()
 
         # construct directory names
-        self.checkpoint_dirs[mac] = os.path.join(self.checkpoint_dir, mac)
-        self.policy_dirs[mac] = os.path.join(self.policy_dir, mac)
+        device = DeviceAgent(mac, os.path.join(self.checkpoint_dir, mac),
+                             os.path.join(self.policy_dir, mac))
 
         # initialize environment for the device
-        self._init_env(mac)
+        self._init_env(device)
 
         # create the QNetwork for the device
-        self.q_net[mac] = q_network.QNetwork(
-                self.train_env[mac].observation_spec(),
-                self.train_env[mac].action_spec())
-
-        # create a global step (required for checkpoints)
-        self.global_step[mac] = tf.compat.v1.train.get_or_create_global_step()
-
-        self._init_agent(mac, self.learning_rate, self.q_net[mac],
-                         self.global_step[mac], self.train_env[mac])
-        self._init_policy(mac, self.agent[mac])
-        self._init_replay_buffer(mac, self.agent[mac], self.train_env[mac])
-        self._init_checkpointer(mac, self.agent[mac], self.replay_buffer[mac],
-                                self.global_step[mac])
-        self._init_policy_saver(mac, self.agent[mac])
-
-        logging.info("added a device with MAC = " + mac)
+        device.q_net = q_network.QNetwork(
+                device.train_env.observation_spec(),
+                device.train_env.action_spec())
+
+        # create a global step (required for checkpoints) - every device has
+        # its own, so restoring one device doesn't touch the others.
+        device.global_step = tf.Variable(0, dtype=tf.int64, trainable=False,
+                                         name="global_step")
+
+        self._init_agent(device, self.learning_rate)
+        self._init_policy(device)
+        self._init_replay_buffer(device)
+        self._init_checkpointer(device)
+        self._init_policy_saver(device)
+
+        # pick up the training state of a previous run, if there is one.
+        with self.metrics.span("restore"):
+            device.train_checkpointer.initialize_or_restore()
+            device.replay_buffer.restore(self._replay_path(device))
+
+        for evicted_mac, evicted in self.agents.put(
+                mac, device, self._device_memory(device)):
+            self._evict(evicted_mac, evicted)
+
+        if mac in self._evicted:
+            self._evicted.discard(mac)
+            elapsed = time.monotonic() - started
+            self.agents.record_rehydration(elapsed)
+            logging.info("rehydrated a device with MAC = %s in %.3fs "
+                         "(cache hits %d, misses %d)", mac, elapsed,
+                         self.agents.stats["hits"],
+                         self.agents.stats["misses"])
+        else:
+            logging.info("added a device with MAC = " + mac)
         return
 
-    def _init_env(self, mac):
+    def _evict(self, mac, device):
+        """_evict will write a checkpoint of the evicted device if it has
+        unsaved training steps and drop it. Pinned devices aren't evicted,
+        the lock waits for a checkpoint or a spill of the device in progress.
+        """
+        with device.lock:
+            if mac in self.checkpoint_policy.unsaved():
+                self._save_checkpoint(device)
+            device.replay_buffer.close()
+        self.checkpoint_policy.forget(mac)
+        self._evicted.add(mac)
+
+        logging.info("evicted a device with MAC = %s", mac)
+
+    def release(self, mac):
+        """release will drop a device which is now handled by another worker,
+        writing a checkpoint first so that the other worker can restore it.
+        """
+        device = self.agents.pop(mac)
+        if device is None:
+            return
+
+        # wait for the training step in progress, if there is one.
+        with device.lock:
+            if mac in self.checkpoint_policy.unsaved():
+                self._save_checkpoint(device)
+            device.replay_buffer.close()
+        self.checkpoint_policy.forget(mac)
+        self._evicted.discard(mac)
+
+        logging.info("released a device with MAC = %s", mac)
+
+    def _device_memory(self, device):
+        """_device_memory estimates the memory of the variables of the agent
+        and the replay buffer of the device in bytes.
+        """
+        size = device.replay_buffer.memory()
+        for variable in device.agent.variables:
+            size += variable.shape.num_elements() * variable.dtype.size
+        return size
+
+    def replay_stats(self):
+        """replay_stats reports the replay memory of every device in memory
+        and of the fleet in total.
+        """
+        stats = {"devices": {}, "memory": 0, "disk": 0}
+        for mac in self.agents.keys():
+            device = self.agents.peek(mac)
+            if device is None:
+                continue
+
+            buffer = device.replay_buffer
+            device_stats = {
+                "size": buffer.size,
+                "capacity": buffer.capacity,
+                "memory": buffer.memory(),
+                "disk": buffer.disk(),
+            }
+            stats["devices"][mac] = device_stats
+            stats["memory"] += device_stats["memory"]
+            stats["disk"] += device_stats["disk"]
+        return stats
+
+    def cache_stats(self):
+        """cache_stats reports the hits, misses, evictions and rehydration
+        latency of the agent cache, used to size the cache for the fleet.
+        """
+        stats = dict(self.agents.stats)
+        stats["devices"] = len(self.agents)
+        stats["memory"] = self.agents.memory()
+        return stats
+
+    def _init_env(self, device):
         """Will initialize a custom made Python Environment. This is a step
         zero for subsequent initializations.
         """
-        self.env[mac] = SensorEnv(mac)
-        self.train_env[mac] = tf_py_environment.TFPyEnvironment(self.env[mac])
+        device.env = SensorEnv(device.mac, state_store=self.state_store)
+        device.train_env = tf_py_environment.TFPyEnvironment(device.env)
 
         return
 
-    def _init_agent(self, mac, learning_rate, q_net, train_step_counter,
-                    train_env):
+    def _init_agent(self, device, learning_rate):
         optimizer = tf.compat.v1.train.AdamOptimizer(
                 learning_rate=learning_rate)
 
-        self.agent[mac] = dqn_agent.DqnAgent(
-                train_env.time_step_spec(),
-                train_env.action_spec(),
-                q_network=q_net,
+        device.agent = dqn_agent.DqnAgent(
+                device.train_env.time_step_spec(),
+                device.train_env.action_spec(),
+                q_network=device.q_net,
                 optimizer=optimizer,
                 td_errors_loss_fn=common.element_wise_squared_loss,
-                train_step_counter=train_step_counter)
-        self.agent[mac].initialize()
+                # the samples of the replay buffer are num_steps long.
+                n_step_update=self.num_steps - 1,
+                train_step_counter=device.global_step)
+        device.agent.initialize()
 
         return
 
-    def _init_policy(self, mac, agent):
+    def _init_policy(self, device):
         """
             - In our case, the desired outcome is to keep the temperature
             readings delta within boundaries of a pre-defined delta.
@@ -128,67 +353,109 @@ class DqnAgent:
             We use the default ones, atlthough, it would be better to make
             custom ones.
         """
-        self.eval_policy[mac] = agent.policy
-        self.collect_policy[mac] = agent.collect_policy
+        device.eval_policy = device.agent.policy
+        device.collect_policy = device.agent.collect_policy
 
         return
 
-    def _init_replay_buffer(self, mac, agent, train_env):
+    def _init_replay_buffer(self, device):
         """Replay buffer keeps track of data collected from the environment.
-        We will be using TFUniformReplayBuffer.
+        We will be using a compact NumPy ring buffer, which grows with the
+        number of transitions of the device.
         """
-        self.replay_buffer[mac] = replay.TFUniformReplayBuffer(
-            data_spec=agent.collect_data_spec,
-            batch_size=train_env.batch_size,
-            max_length=self.replay_buffer_max_length)
+        device.replay_buffer = CompactReplayBuffer.from_spec(
+            device.agent.collect_data_spec,
+            half_precision=self.replay_half_precision,
+            max_length=self.replay_max_length,
+            initial_length=self.replay_initial_length)
 
         return
 
-    def _init_checkpointer(self, mac, agent, replay_buffer, global_step):
+    def _init_checkpointer(self, device):
         """Create a checkpointer for a given device with identification of
         a given MAC address. We will use this to save/load the training state
         of the device.
         """
-        self.train_checkpointer[mac] = common.Checkpointer(
-            ckpt_dir=self.checkpoint_dirs[mac],
+        device.train_checkpointer = common.Checkpointer(
+            ckpt_dir=device.checkpoint_dir,
             max_to_keep=1,
-            agent=agent,
-            policy=agent.policy,
-            replay_buffer=replay_buffer,
-            global_step=global_step)
+            agent=device.agent,
+            policy=device.agent.policy,
+            global_step=device.global_step)
 
         return
 
-    def _init_policy_saver(self, mac, agent):
-        self.policy_saver[mac] = policy_saver.PolicySaver(agent.policy)
+    def _init_policy_saver(self, device):
+        device.policy_saver = policy_saver.PolicySaver(device.agent.policy)
 
         return
 
-    def convert_to_tflite(self, mac):
-        """convert_to_tflite loads up the policy of the MAC address and tries
-        to convert it to the TensorFlow Lite model using concrete function for
-        policy 'action'. However, in current TensorFlow Lite implementation
-        some ops used here are not yet supported: BroadcastArgs and BroadcastTo
+    def export_key(self, mac):
+        """export_key returns the key under which the model of the device is
+        exported - every device has its own model.
         """
-        export_dir = os.path.join(self.policy_dir, mac)
+        return mac
 
-        model = tf.saved_model.load(export_dir=export_dir)
-        concrete_func = model.signatures['action']
+    def needs_export(self, mac):
+        """needs_export returns True if the policy of the device was trained
+        since the model was last exported.
+        """
+        device = self.agents.peek(mac)
+        if device is None:
+            return False
+        return device.version > device.exported_version
+
+    def export(self, mac):
+        """export converts the current in-memory policy of the device to the
+        TensorFlow Lite model and returns the exported version, or None if the
+        device isn't in memory.
+        """
+        self.agents.pin(mac)
+        try:
+            device = self.agents.peek(mac)
+            if device is None:
+                return None
+
+            with device.lock:
+                version = device.version
+                signature = device.signature
+                with self.metrics.span("tflite"):
+                    convert_policy_to_tflite(device.agent.policy,
+                                             self.model_path(mac))
+                convert_q_network_to_numpy(device.q_net,
+                                           self.model_path(mac))
+                device.exported_version = version
+                device.exported_signature = signature
+        finally:
+            self.agents.unpin(mac)
+
+        logging.debug("exported model of %s, version %d", mac, version)
+        return version
+
+    def convert_to_tflite(self, mac):
+        """convert_to_tflite converts the policy of the MAC address to the
+        TensorFlow Lite model using concrete function for policy 'action'.
+        However, in current TensorFlow Lite implementation some ops used here
+        are not yet supported: BroadcastArgs and BroadcastTo
+        """
+        return self.export(mac)
 
-        converter = tf.lite.TFLiteConverter.from_concrete_functions(
-            [concrete_func])
-        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS,
-                                               tf.lite.OpsSet.SELECT_TF_OPS]
-        tflite_model = converter.convert()
-        model_dir = os.path.join('models', mac)
-        open(model_dir, 'wb').write(tflite_model)
+    def model_path(self, mac):
+        """model_path returns the path of the TensorFlow Lite model which is
+        served to the device.
+        """
+        return os.path.join(self.model_dir, mac)
 
-    def collect_step(self, env, policy, buffer, mac):
+    def collect_step(self, device):
         """Collects the current time step of the environment and maps the
         current time_step to action in Q-table.
         """
-        if self.initial_step[mac]:
-            self.initial_step[mac] = False
+        env = device.train_env
+        policy = device.agent.collect_policy
+        buffer = device.replay_buffer
+
+        if device.initial_step:
+            device.initial_step = False
             time_step = env.current_time_step()
             action_step = policy.action(time_step)
             next_time_step = env.step(action_step.action)
@@ -203,36 +470,301 @@ class DqnAgent:
                                           next_time_step)
         buffer.add_batch(traj)
 
-    def train(self, mac):
+    def train(self, mac, steps=1, before_step=None):
         """Here we run the training for the given device. The data is extracted
         from the environment using collect_step and given to the network for
         training. The trained networks checkpoint and policies are then saved.
+
+        Args:
+            mac: the MAC address of the device to train.
+            steps: the number of collect steps to take before the single
+                training step, one for each of the received readings.
+            before_step: an optional callable(i) called before the i-th
+                collect step, used to apply the i-th reading to the state.
+
+        Returns:
+            True if the greedy behaviour of the policy has changed since the
+            model was last exported and a new model should be exported.
         """
 
-        # don't allow training for devices that don't exist here.
-        if mac not in self.devices:
+        # the device can't be evicted while it is being trained.
+        self.agents.pin(mac)
+        try:
+            # the device may have been evicted by another worker since the
+            # caller checked that it exists, it is rebuilt from its
+            # checkpoint so that the readings are not lost.
+            device = self.agents.peek(mac)
+            if device is None:
+                logging.info("device with MAC = %s was evicted before "
+                             "training, adding it again", mac)
+                self.add_device(mac)
+                device = self.agents.peek(mac)
+
+            with device.lock:
+                device.replay_buffer.unspill()
+                changed = self._train(device, steps, before_step)
+
+            # the replay buffer may have grown, the device isn't put back if
+            # it was released while it was trained.
+            for evicted_mac, evicted in self.agents.resize(
+                    mac, device, self._device_memory(device)):
+                self._evict(evicted_mac, evicted)
+        finally:
+            self.agents.unpin(mac)
+
+        self._spill_cold()
+        return changed
+
+    def _spill_cold(self):
+        """_spill_cold spills the replay buffers of the devices which weren't
+        trained recently to disk, only the most recently trained ones are
+        kept in memory. The devices are walked at most every spill interval
+        and by a single worker at a time.
+        """
+        if self.replay_hot_devices <= 0:
             return
-
-        if self.initial_training[mac]:
-            self.agent[mac].train_step_counter.assign(0)
-            self.initial_training[mac] = False
-        else:
-            self.train_checkpointer[mac].initialize_or_restore()
-            self.global_step[mac] = tf.compat.v1.train.get_global_step()
+        if time.monotonic() - self._spilled_at < self.replay_spill_interval:
+            return
+        if not self._spill_lock.acquire(blocking=False):
+            return
+        try:
+            self._spilled_at = time.monotonic()
+            self._spill_devices()
+        finally:
+            self._spill_lock.release()
+
+    def _spill_devices(self):
+        """_spill_devices spills the buffers of all but the hot devices."""
+        cold = self.agents.keys()[:-self.replay_hot_devices]
+        for mac in cold:
+            device = self.agents.peek(mac)
+            if device is None or device.replay_buffer.spilled:
+                continue
+
+            # skip the devices which are being trained right now
+            if not device.lock.acquire(blocking=False):
+                continue
+            try:
+                device.replay_buffer.spill(
+                    os.path.join(self.replay_spill_dir, mac))
+            finally:
+                device.lock.release()
+
+    def _train(self, device, steps, before_step):
+        if self.compiled:
+            return self._train_compiled(device, steps, before_step)
 
         # collect data
-        self.collect_step(self.train_env[mac], self.agent[mac].collect_policy,
-                          self.replay_buffer[mac], mac)
-
-        dataset = self.replay_buffer[mac].as_dataset(
-            num_parallel_calls=2,
-            sample_batch_size=2,
-            num_steps=2).prefetch(2)
-        iterator = iter(dataset)
+        with self.metrics.span("collect"):
+            for i in range(steps):
+                if before_step is not None:
+                    before_step(i)
+                self.collect_step(device)
+
+        # a sample needs num_steps consecutive transitions in the buffer.
+        if device.replay_buffer.size >= self.num_steps:
+            for _ in range(self.train_steps):
+                with self.metrics.span("sample"):
+                    experience, unused_info = self._sample(device)
+                with self.metrics.span("optimize"):
+                    _ = device.agent.train(experience).loss
+
+        return self._trained(device)
+
+    def _trained(self, device):
+        device.version += 1
+        device.signature = policy_signature(device.q_net)
+
+        if self.checkpoint_policy.step(device.mac):
+            self._save_checkpoint(device)
+
+        return device.signature != device.exported_signature
+
+    def _train_compiled(self, device, steps, before_step):
+        """_train_compiled collects the readings and trains in a single call
+        of a compiled function. The environment step is done by TensorFlow
+        ops on the device state, the state is read from the store before the
+        call and written back after it.
+
+        The experience for the first gradient step is sampled before the
+        transitions of this call are added to the replay buffer.
+        """
+        mac = device.mac
+        readings = []
+        for i in range(steps):
+            if before_step is not None:
+                before_step(i)
+            self.state_store.ensure(mac)
+            readings.append(self.state_store.get(mac).curr_temperature)
+
+        # the first collect of a device takes an extra step, like
+        # collect_step does.
+        if device.initial_step:
+            device.initial_step = False
+            readings.insert(0, readings[0])
+
+        if device.compiled is None:
+            device.compiled = self._compile(device)
+            device.time_step = device.train_env.current_time_step()
+        collect, collect_and_train = device.compiled
+
+        state = self.state_store.get(mac)
+        inputs = (device.time_step,
+                  tf.constant([state.prev_temperature, state.prev_delta,
+                               state.send_interval], dtype=tf.float64),
+                  tf.constant(device.iteration, dtype=tf.int64),
+                  tf.constant(readings, dtype=tf.float64))
+
+        train_steps = self.train_steps
+        if train_steps > 0 and device.replay_buffer.size >= self.num_steps:
+            with self.metrics.span("sample"):
+                experience, unused_info = self._sample(device)
+            with self.metrics.span("collect_and_optimize"):
+                traj, time_step, values, _ = collect_and_train(*inputs,
+                                                               experience)
+            train_steps -= 1
+        else:
+            with self.metrics.span("collect"):
+                traj, time_step, values = collect(*inputs)
+
+        device.replay_buffer.add_batch(traj)
+        device.time_step = time_step
+        device.iteration += len(readings)
+
+        prev_temperature, prev_delta, send_interval = values.numpy()
+        self.state_store.update(
+            mac, prev_temperature=float(prev_temperature),
+            prev_delta=float(prev_delta), curr_temperature=readings[-1],
+            send_interval=float(send_interval))
+
+        for _ in range(train_steps):
+            with self.metrics.span("sample"):
+                experience, unused_info = self._sample(device)
+            with self.metrics.span("optimize"):
+                _ = device.agent.train(experience).loss
+
+        return self._trained(device)
+
+    def _compile(self, device):
+        """_compile builds the compiled collect step of the device, alone and
+        fused with the training step.
+        """
+        policy = device.agent.collect_policy
+        specs = tf.nest.flatten(device.agent.collect_data_spec)
+        discount = tf.constant([0.5], dtype=tf.float32)
+        delta = device.env.delta
+
+        def collect(time_step, state, iteration, readings):
+            count = tf.shape(readings)[0]
+            arrays = [tf.TensorArray(spec.dtype, size=count)
+                      for spec in specs]
+            prev_temperature, prev_delta, send_interval = \
+                state[0], state[1], state[2]
+
+            for i in tf.range(count):
+                action_step = policy.action(time_step)
+                current_delta, reward, interval = tf_sensor_step(
+                    prev_temperature, readings[i], send_interval,
+                    action_step.action[0, 0], delta)
+
+                next_time_step = ts.transition(
+                    tf.cast(tf.reshape(current_delta, [1, 1]), tf.float32),
+                    tf.reshape(reward, [1]), discount)
+                traj = trajectory.from_transition(time_step, action_step,
+                                                  next_time_step)
+                arrays = [array.write(i, value[0]) for array, value in
+                          zip(arrays, tf.nest.flatten(traj))]
+
+                # the environment writes its state every other step only
+                iteration += 1
+                saved = tf.equal(iteration % 2, 0)
+                prev_temperature = tf.where(saved, readings[i],
+                                            prev_temperature)
+                prev_delta = tf.where(saved, current_delta, prev_delta)
+                send_interval = tf.where(saved, interval, send_interval)
+                time_step = next_time_step
+
+            traj = tf.nest.pack_sequence_as(
+                device.agent.collect_data_spec,
+                [array.stack() for array in arrays])
+            values = tf.stack([prev_temperature, prev_delta, send_interval])
+            return traj, time_step, values
+
+        def collect_and_train(time_step, state, iteration, readings,
+                              experience):
+            traj, time_step, values = collect(time_step, state, iteration,
+                                              readings)
+            loss = device.agent.train(experience).loss
+            return traj, time_step, values, loss
+
+        options = {"experimental_relax_shapes": True}
+        if self.jit_compile:
+            options["jit_compile"] = True
+        return (tf.function(collect, **options),
+                tf.function(collect_and_train, **options))
+
+    def _sampler(self, device):
+        """_sampler returns the iterator sampling the replay buffer of the
+        device, built once and kept with the agent. The dataset samples from
+        the current contents of the buffer on every call, so the transitions
+        collected later are sampled as well. Nothing is prefetched, so that a
+        batch is never sampled before the latest collect steps.
+        """
+        if device.iterator is None:
+            dataset = device.replay_buffer.as_dataset(
+                num_parallel_calls=2,
+                sample_batch_size=self.sample_batch_size,
+                num_steps=self.num_steps)
+            device.iterator = iter(dataset)
+        return device.iterator
+
+    def _sample(self, device):
+        """_sample returns the next sample of the replay buffer of the
+        device. An iterator which failed is dropped, the next sample builds
+        a new one.
+        """
+        try:
+            return next(self._sampler(device))
+        except Exception:
+            device.iterator = None
+            raise
+
+    def save_checkpoint(self, mac):
+        """save_checkpoint writes the training state of the device."""
+        device = self.agents.peek(mac)
+        if device is not None:
+            with device.lock:
+                self._save_checkpoint(device)
+
+    def save_overdue(self):
+        """save_overdue writes the checkpoints of the devices which weren't
+        saved for longer than the checkpoint policy allows, including the
+        ones which weren't trained since.
+        """
+        for mac in self.checkpoint_policy.overdue():
+            self.save_checkpoint(mac)
 
-        experience, unused_info = next(iterator)
-        _ = self.agent[mac].train(experience).loss
+    def _save_checkpoint(self, device):
+        """Writes the training state and, next to it, the SavedModel of the
+        policy of the device.
+        """
+        with self.metrics.span("checkpoint"):
+            device.train_checkpointer.save(device.global_step)
+            device.replay_buffer.save(self._replay_path(device))
+        with self.metrics.span("policy_saver"):
+            device.policy_saver.save(device.policy_dir)
+        self.checkpoint_policy.saved(device.mac)
+
+    def _replay_path(self, device):
+        """The replay buffer is written next to the training checkpoint."""
+        return os.path.join(device.checkpoint_dir, "replay.npz")
+
+    def close(self):
+        """close will write checkpoints of all of the devices which have
+        unsaved training steps, if the policy asks for it on shutdown.
+        """
+        if not self.checkpoint_policy.on_shutdown:
+            return
 
-        self.train_checkpointer[mac].save(self.global_step[mac])
-        self.policy_saver[mac].save(self.policy_dirs[mac])
-        self.convert_to_tflite(mac)
+        for mac in self.checkpoint_policy.unsaved():
+            self.save_checkpoint(mac)
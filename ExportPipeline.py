@@ -0,0 +1,130 @@
+import logging
+import threading
+from collections import OrderedDict
+
+
+class ExportPipeline:
+    """ExportPipeline runs the TensorFlow Lite model exports on a pool of
+    worker threads, separately from training.
+
+    Requests are deduplicated per key: while an export of a key is waiting,
+    further requests for it are merged into the waiting one, so only the
+    newest policy is exported once no matter how many versions were queued.
+    """
+
+    def __init__(self, export_fn, workers=1):
+        """
+        Args:
+            export_fn: a callable(key) which exports the current policy of
+                the key and returns the exported version.
+            workers: the number of worker threads in the pool.
+        """
+        self._export_fn = export_fn
+        self._workers = max(1, int(workers))
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._active = set()
+        self._threads = []
+        self._running = False
+
+        self.stats = {
+            "requested": 0,
+            "deduplicated": 0,
+            "exported": 0,
+            "failed": 0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run,
+                                      name="hades-export-%d" % i,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait=True):
+        with self._cond:
+            if wait and self._running:
+                while self._pending or self._active:
+                    self._cond.wait()
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def request(self, key, callback=None):
+        """request will schedule an export of the key. The optional
+        callback(key, version) is called once the export is done, with the
+        version None if the export failed.
+        """
+        with self._cond:
+            self.stats["requested"] += 1
+
+            callbacks = self._pending.get(key)
+            if callbacks is None:
+                callbacks = self._pending[key] = []
+                # join and stop wait on the same condition as the workers.
+                self._cond.notify_all()
+            else:
+                self.stats["deduplicated"] += 1
+
+            if callback is not None:
+                callbacks.append(callback)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def join(self):
+        """join blocks until all of the requested exports are done."""
+        with self._cond:
+            while self._pending or self._active:
+                self._cond.wait()
+
+    def _next(self):
+        """_next returns the first waiting key which isn't being exported
+        right now. Must be called with the lock held.
+        """
+        while self._running:
+            for key in self._pending:
+                if key not in self._active:
+                    return key, self._pending.pop(key)
+            self._cond.wait()
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, callbacks = self._next()
+                if key is None:
+                    return
+                self._active.add(key)
+
+            try:
+                version = self._export_fn(key)
+                failed = False
+            except Exception:
+                logging.exception("export failed for %s", key)
+                version = None
+                failed = True
+
+            with self._cond:
+                self._active.discard(key)
+                self.stats["failed" if failed else "exported"] += 1
+                self._cond.notify_all()
+
+            # the callbacks are called on failure as well, the requests
+            # waiting for the export must still be answered.
+            for callback in callbacks:
+                try:
+                    callback(key, version)
+                except Exception:
+                    logging.exception("export callback failed for %s", key)
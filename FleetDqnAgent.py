@@ -0,0 +1,391 @@
+import os
+import logging
+import threading
+from CheckpointPolicy import CheckpointPolicy
+
+try:
+    import numpy as np
+    import tensorflow as tf
+    try:
+        from SensorEnvironment import SensorEnv
+        from DqnAgent import (convert_policy_to_tflite,
+                              convert_q_network_to_numpy, policy_signature)
+        from tf_agents.agents.dqn import dqn_agent
+        from tf_agents.networks import q_network
+        from tf_agents.policies import policy_saver
+        from tf_agents.specs import tensor_spec
+        from tf_agents.trajectories import trajectory
+        from tf_agents.utils import common
+    except ImportError:
+        print("failed to import libraries")
+except ImportError:
+    print("failed to import tensorflow or numpy")
+
+
+class TransitionReplay:
+    """TransitionReplay is a ring buffer of single transitions of the whole
+    fleet. Every transition is one row, no matter which device it came from.
+    """
+
+    fields = ("observation", "next_observation", "action", "reward",
+              "discount", "step_type", "next_step_type")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+
+        self.observation = np.zeros((capacity, 1), dtype=np.float32)
+        self.next_observation = np.zeros((capacity, 1), dtype=np.float32)
+        self.action = np.zeros((capacity, 1), dtype=np.int32)
+        self.reward = np.zeros((capacity,), dtype=np.float32)
+        self.discount = np.zeros((capacity,), dtype=np.float32)
+        self.step_type = np.zeros((capacity,), dtype=np.int32)
+        self.next_step_type = np.zeros((capacity,), dtype=np.int32)
+
+    def add(self, rows):
+        """add will append a batch of transitions given as a dictionary of
+        arrays with the same names as the fields of the buffer.
+        """
+        count = len(rows["reward"])
+        index = (self._next + np.arange(count)) % self.capacity
+
+        for name, values in rows.items():
+            getattr(self, name)[index] = values
+
+        self._next = (self._next + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+
+    def sample(self, batch_size):
+        index = np.random.randint(0, self.size, size=batch_size)
+        return {name: getattr(self, name)[index] for name in self.fields}
+
+    def _order(self):
+        """_order returns the indices of the rows from the oldest one."""
+        if self.size < self.capacity:
+            return np.arange(self.size)
+        return (self._next + np.arange(self.capacity)) % self.capacity
+
+    def save(self, path):
+        """save writes the rows of the buffer, from the oldest one."""
+        order = self._order()
+        arrays = {name: getattr(self, name)[order] for name in self.fields}
+
+        tmp_file = path + ".tmp.npz"
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, path)
+
+    def restore(self, path):
+        """restore reads the rows written by save, returns False if there is
+        nothing to restore.
+        """
+        try:
+            with np.load(path) as data:
+                rows = {name: data[name] for name in self.fields}
+        except (OSError, KeyError, ValueError):
+            return False
+
+        # only the newest rows are kept if the capacity is smaller now
+        rows = {name: values[-self.capacity:] for name, values in
+                rows.items()}
+        self.size = self._next = 0
+        if len(rows["reward"]):
+            self.add(rows)
+        return True
+
+
+class FleetDqnAgent:
+    """FleetDqnAgent trains a single Q-network shared by every device instead
+    of building a network, optimizer, replay buffer and checkpointer for each
+    MAC address. The reward of SensorEnv doesn't depend on the device, so a
+    single policy can be learned from the transitions of the whole fleet.
+
+    Each device only keeps its SensorEnv. The transitions that were collected
+    since the last training step are trained on in a single batched step
+    together with a sample from the shared replay buffer, so the cost of a
+    device is a row in a tensor rather than a graph.
+    """
+
+    # Hyperparameters for the network
+    learning_rate = 1
+    replay_buffer_max_length = 100000
+
+    def __init__(self, state_store=None, checkpoint_policy=None,
+                 sample_batch_size=32):
+        # the device states shared with the environments
+        self.state_store = state_store
+
+        # the transitions sampled from the replay buffer for every step, on
+        # top of the fresh ones.
+        self.sample_batch_size = sample_batch_size
+
+        if checkpoint_policy is None:
+            checkpoint_policy = CheckpointPolicy()
+        self.checkpoint_policy = checkpoint_policy
+
+        self.devices = set()
+        self.env = {}
+
+        self.agent = None
+        self.replay_buffer = None
+        self.train_checkpointer = None
+        self.policy_saver = None
+
+        # the version is bumped on every training step, the signature is
+        # the greedy behaviour of the policy.
+        self.version = 0
+        self.exported_version = -1
+        self.signature = None
+        self.exported_signature = None
+
+        # transitions collected by the workers, waiting for a training step.
+        self._pending = []
+        self._lock = threading.Lock()
+        self._train_lock = threading.Lock()
+
+        self.checkpoint_dir = os.path.join("checkpoints", "fleet")
+        self.policy_dir = os.path.join("policies", "fleet")
+        self.model_file = os.path.join("models", "fleet")
+
+        logging.info("initialized FleetDqnAgent")
+        return
+
+    def device_exists(self, mac):
+        return mac in self.devices
+
+    def add_device(self, mac):
+        env = SensorEnv(mac, state_store=self.state_store)
+        env.reset()
+
+        with self._lock:
+            if self.agent is None:
+                self._init_agent(env)
+            self.env[mac] = env
+            self.devices.add(mac)
+
+        logging.info("added a device with MAC = " + mac)
+        return
+
+    def cache_stats(self):
+        """cache_stats reports the devices of the fleet, the fleet keeps no
+        agents per device which could be evicted.
+        """
+        return {"devices": len(self.devices)}
+
+    def replay_stats(self):
+        """replay_stats reports the memory of the shared replay buffer, it
+        is never spilled to disk.
+        """
+        memory = 0
+        if self.replay_buffer is not None:
+            memory = sum(getattr(self.replay_buffer, name).nbytes
+                         for name in TransitionReplay.fields)
+        return {"memory": memory, "disk": 0}
+
+    def release(self, mac):
+        """release will drop the environment of a device which is now handled
+        by another worker. The shared network isn't split between workers.
+        """
+        with self._lock:
+            self.env.pop(mac, None)
+            self.devices.discard(mac)
+
+    def _init_agent(self, env):
+        """Build the shared network, agent, replay buffer and checkpointer
+        using the specs of the first environment. The specs are the same for
+        every SensorEnv.
+        """
+        time_step_spec = tensor_spec.from_spec(env.time_step_spec())
+        action_spec = tensor_spec.from_spec(env.action_spec())
+
+        self.q_net = q_network.QNetwork(time_step_spec.observation,
+                                        action_spec)
+        self.global_step = tf.compat.v1.train.get_or_create_global_step()
+
+        optimizer = tf.compat.v1.train.AdamOptimizer(
+                learning_rate=self.learning_rate)
+
+        self.agent = dqn_agent.DqnAgent(
+                time_step_spec,
+                action_spec,
+                q_network=self.q_net,
+                optimizer=optimizer,
+                td_errors_loss_fn=common.element_wise_squared_loss,
+                # the rows of the replay buffer are single transitions.
+                n_step_update=1,
+                train_step_counter=self.global_step)
+        self.agent.initialize()
+
+        self.replay_buffer = TransitionReplay(self.replay_buffer_max_length)
+
+        self.train_checkpointer = common.Checkpointer(
+            ckpt_dir=self.checkpoint_dir,
+            max_to_keep=1,
+            agent=self.agent,
+            policy=self.agent.policy,
+            global_step=self.global_step)
+        self.train_checkpointer.initialize_or_restore()
+        self.replay_buffer.restore(self._replay_path())
+
+        self.policy_saver = policy_saver.PolicySaver(self.agent.policy)
+
+        return
+
+    def model_path(self, mac):
+        """model_path returns the path of the TensorFlow Lite model which is
+        served to the device - every device is served the fleet model.
+        """
+        return self.model_file
+
+    def export_key(self, mac):
+        """export_key returns the key under which the model of the device is
+        exported - the whole fleet shares one model.
+        """
+        return "fleet"
+
+    def needs_export(self, mac):
+        """needs_export returns True if the fleet network was trained since
+        the model was last exported.
+        """
+        return self.version > self.exported_version
+
+    def export(self, key="fleet"):
+        """export converts the current in-memory fleet policy to the
+        TensorFlow Lite model and returns the exported version.
+        """
+        if self.agent is None:
+            return None
+
+        with self._train_lock:
+            version = self.version
+            signature = self.signature
+            convert_policy_to_tflite(self.agent.policy, self.model_file)
+            convert_q_network_to_numpy(self.q_net, self.model_file)
+            self.exported_version = version
+            self.exported_signature = signature
+
+        logging.debug("exported the fleet model, version %d", version)
+        return version
+
+    def collect_step(self, env):
+        """Takes a single step in the environment of a device using the
+        shared collect policy and returns the transition as a row.
+        """
+        time_step = env.current_time_step()
+        batched = tf.nest.map_structure(
+            lambda x: tf.convert_to_tensor(np.expand_dims(x, 0)), time_step)
+        action = self.agent.collect_policy.action(batched).action.numpy()[0]
+        next_time_step = env.step(action)
+
+        return {
+            "observation": time_step.observation,
+            "next_observation": next_time_step.observation,
+            "action": action,
+            "reward": next_time_step.reward,
+            "discount": next_time_step.discount,
+            "step_type": time_step.step_type,
+            "next_step_type": next_time_step.step_type,
+        }
+
+    def train(self, mac, steps=1, before_step=None):
+        """Collects the transitions of the given device and then runs one
+        batched training step over the transitions of every device collected
+        since the last step. When several workers call train at once, the
+        first one to get the lock trains for all of them.
+
+        Args:
+            mac: the MAC address of the device to train.
+            steps: the number of collect steps to take, one for each of the
+                received readings.
+            before_step: an optional callable(i) called before the i-th
+                collect step, used to apply the i-th reading to the state.
+
+        Returns:
+            True if this call trained the network and its greedy behaviour
+            has changed since the model was last exported.
+        """
+        if mac not in self.devices:
+            return False
+
+        rows = []
+        for i in range(steps):
+            if before_step is not None:
+                before_step(i)
+            rows.append(self.collect_step(self.env[mac]))
+
+        with self._lock:
+            self._pending.extend(rows)
+
+        with self._train_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return False
+
+            fresh = {name: np.stack([row[name] for row in pending])
+                     for name in pending[0]}
+            self.replay_buffer.add(fresh)
+            sample = self.replay_buffer.sample(self.sample_batch_size)
+            batch = {name: np.concatenate([fresh[name], sample[name]])
+                     for name in fresh}
+
+            _ = self.agent.train(self._experience(batch)).loss
+
+            self.version += 1
+            self.signature = policy_signature(self.q_net)
+
+            if self.checkpoint_policy.step("fleet"):
+                self.save_checkpoint()
+
+            logging.debug("trained the fleet on %d transitions", len(pending))
+            return self.signature != self.exported_signature
+
+    def save_checkpoint(self):
+        """save_checkpoint writes the training state of the fleet network
+        and, next to it, the SavedModel of its policy.
+        """
+        self.train_checkpointer.save(self.global_step)
+        self.replay_buffer.save(self._replay_path())
+        self.policy_saver.save(self.policy_dir)
+        self.checkpoint_policy.saved("fleet")
+
+    def _replay_path(self):
+        """The replay buffer is written next to the training checkpoint."""
+        return os.path.join(self.checkpoint_dir, "replay.npz")
+
+    def save_overdue(self):
+        """save_overdue writes the checkpoint of the fleet network if it
+        wasn't saved for longer than the checkpoint policy allows.
+        """
+        with self._train_lock:
+            if "fleet" in self.checkpoint_policy.overdue():
+                self.save_checkpoint()
+
+    def close(self):
+        """close will write a checkpoint of the fleet network if it has
+        unsaved training steps and the policy asks for it on shutdown.
+        """
+        if not self.checkpoint_policy.on_shutdown or self.agent is None:
+            return
+
+        with self._train_lock:
+            if self.checkpoint_policy.unsaved():
+                self.save_checkpoint()
+
+    def _experience(self, batch):
+        """Turns a batch of transitions into a trajectory of two time steps
+        as expected by the agent. Only the observation and the step type of
+        the second time step are used by the agent.
+        """
+        def pair(first, second):
+            return tf.convert_to_tensor(np.stack([first, second], axis=1))
+
+        return trajectory.Trajectory(
+            step_type=pair(batch["step_type"], batch["next_step_type"]),
+            observation=pair(batch["observation"], batch["next_observation"]),
+            action=pair(batch["action"], batch["action"]),
+            policy_info=(),
+            next_step_type=pair(batch["next_step_type"],
+                                batch["next_step_type"]),
+            reward=pair(batch["reward"], np.zeros_like(batch["reward"])),
+            discount=pair(batch["discount"], batch["discount"]))
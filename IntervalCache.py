@@ -0,0 +1,149 @@
+import json
+import threading
+
+import wire_format
+
+
+class IntervalReply:
+    """IntervalReply is the pre-serialized send interval reply of a device -
+    the interval message in JSON and in the binary wire format, and the
+    event, the event only lacks the time it is sent at.
+    """
+    __slots__ = ("net", "send_interval", "topic", "payload", "binary_topic",
+                 "binary_payload", "event_topic", "_event_prefix",
+                 "_event_suffix")
+
+    def __init__(self, prefix, net, mac, send_interval):
+        self.net = net
+        self.send_interval = send_interval
+
+        self.topic = f"{prefix}/node/{net}/{mac}/hades/interval/receive"
+        self.payload = json.dumps({
+            "mac": mac,
+            "send_interval": send_interval,
+        })
+        self.binary_topic = self.topic + wire_format.SUFFIX
+        self.binary_payload = wire_format.encode_interval(send_interval)
+
+        # the same as json.dumps of the whole event
+        self.event_topic = f"node/{net}/{mac}/hades/event/sent"
+        self._event_prefix = json.dumps({"model": mac})[:-1] + \
+            ', "time_sent": '
+        self._event_suffix = ', "send_interval": %s}' % json.dumps(
+            send_interval)
+
+    def message(self, binary=False):
+        """message returns the topic and the payload of the reply in the
+        format of the device.
+        """
+        if binary:
+            return self.binary_topic, self.binary_payload
+        return self.topic, self.payload
+
+    def event(self, time_sent):
+        return self._event_prefix + json.dumps(time_sent) + self._event_suffix
+
+
+class IntervalCache:
+    """IntervalCache keeps the interval replies of the devices, so that
+    answering a repeated request is a lookup and a publish. A reply is
+    invalidated when training changes the send interval of the device, the
+    invalidated devices are remembered until they are pushed.
+    """
+
+    def __init__(self, prefix="hermes"):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._replies = {}
+        self._stale = {}
+        self._sent = {}
+        self._generations = {}
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+        }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._replies)
+
+    def get(self, mac, net):
+        """get returns the reply of the device or None if it has to be
+        built.
+        """
+        with self._lock:
+            reply = self._replies.get(mac)
+            if reply is None or reply.net != net:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return reply
+
+    def generation(self, mac):
+        """generation returns the number of times the reply of the device was
+        invalidated, it is taken before reading the send interval.
+        """
+        with self._lock:
+            return self._generations.get(mac, 0)
+
+    def put(self, mac, net, send_interval, generation=None):
+        """put builds the reply of the device and returns it. The reply is
+        only kept if the device wasn't invalidated since the generation.
+        """
+        reply = IntervalReply(self._prefix, net, mac, send_interval)
+        with self._lock:
+            if generation is None or \
+                    generation == self._generations.get(mac, 0):
+                self._replies[mac] = reply
+        return reply
+
+    def invalidate(self, mac, net=None):
+        """invalidate drops the reply of the device, it is pushed to the
+        device by the next push. Without a network the one of the dropped
+        reply is used, if there is one.
+        """
+        with self._lock:
+            reply = self._replies.pop(mac, None)
+            if net is None and reply is not None:
+                net = reply.net
+            if net is not None:
+                self._stale[mac] = net
+            self._generations[mac] = self._generations.get(mac, 0) + 1
+            self.stats["invalidations"] += 1
+
+    def discard(self, mac):
+        """discard forgets the device."""
+        with self._lock:
+            self._replies.pop(mac, None)
+            self._stale.pop(mac, None)
+            self._sent.pop(mac, None)
+            self._generations.pop(mac, None)
+
+    def clear(self):
+        """clear drops every reply, the devices are pushed by the next
+        push.
+        """
+        with self._lock:
+            for mac, reply in self._replies.items():
+                self._stale.setdefault(mac, reply.net)
+                self._generations[mac] = self._generations.get(mac, 0) + 1
+            self._replies.clear()
+
+    def stale(self):
+        """stale returns the devices invalidated since the last call, as a
+        dict of their networks by MAC address.
+        """
+        with self._lock:
+            stale, self._stale = self._stale, {}
+            return stale
+
+    def sent(self, mac, send_interval):
+        """sent records the send interval last published to the device."""
+        with self._lock:
+            self._sent[mac] = send_interval
+
+    def last_sent(self, mac):
+        with self._lock:
+            return self._sent.get(mac)
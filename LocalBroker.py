@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import asyncio
+import logging
+import argparse
+import struct
+from hades_utils import topic_matches
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    """encode_length encodes the MQTT remaining length."""
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def encode_packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + \
+        body
+
+
+def encode_publish(topic, payload, retain=False):
+    return encode_packet(PUBLISH, 1 if retain else 0,
+                         encode_string(topic) + payload)
+
+
+def decode_string(data, offset):
+    length, = struct.unpack_from("!H", data, offset)
+    offset += 2
+    return data[offset:offset + length], offset + length
+
+
+async def read_packet(reader):
+    """read_packet reads a single MQTT packet and returns its type, flags and
+    body.
+    """
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0f, body
+
+
+class LocalBroker:
+    """LocalBroker is a minimal MQTT 3.1.1 broker stand-in to run several
+    Hades workers locally, without a real broker. It supports QoS 0 delivery
+    (QoS 1 publishes are acknowledged and delivered at QoS 0), retained
+    messages and last wills, which is what the Hades cluster mode needs.
+    """
+
+    def __init__(self, host="127.0.0.1", port=1883):
+        self.host = host
+        self.port = port
+        self.server = None
+
+        self._subscriptions = {}
+        self._retained = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info("local broker listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def publish(self, topic, payload, retain=False):
+        """publish delivers the message to the matching subscribers."""
+        if retain:
+            if payload:
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+
+        packet = encode_publish(topic, payload)
+        for writer, filters in list(self._subscriptions.items()):
+            if any(topic_matches(sub, topic) for sub in filters):
+                writer.write(packet)
+
+    async def _serve(self, reader, writer):
+        will = None
+
+        try:
+            packet_type, _, body = await read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            will = self._connect(body)
+            writer.write(encode_packet(CONNACK, 0, b"\x00\x00"))
+            self._subscriptions[writer] = set()
+
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+
+                if packet_type == PUBLISH:
+                    self._publish(writer, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(writer, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._unsubscribe(writer, body)
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    will = None
+                    break
+
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+            # the client went away without a disconnect - send its will.
+            if will is not None:
+                self.publish(*will)
+
+    def _connect(self, body):
+        """Parses the CONNECT packet and returns the last will as a tuple of
+        (topic, payload, retain) or None.
+        """
+        _, offset = decode_string(body, 0)
+        flags = body[offset + 1]
+        offset += 4
+        _, offset = decode_string(body, offset)
+
+        if not flags & 0x04:
+            return None
+
+        topic, offset = decode_string(body, offset)
+        payload, offset = decode_string(body, offset)
+        return topic.decode(), payload, bool(flags & 0x20)
+
+    def _publish(self, writer, flags, body):
+        topic, offset = decode_string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            writer.write(encode_packet(PUBACK, 0, packet_id))
+
+        self.publish(topic.decode(), body[offset:], retain=bool(flags & 0x01))
+
+    def _subscribe(self, writer, body):
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        filters = []
+
+        while offset < len(body):
+            sub, offset = decode_string(body, offset)
+            offset += 1
+            filters.append(sub.decode())
+            granted.append(0)
+
+        self._subscriptions[writer].update(filters)
+        writer.write(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+
+        for topic, payload in self._retained.items():
+            if any(topic_matches(sub, topic) for sub in filters):
+                writer.write(encode_publish(topic, payload, retain=True))
+
+    def _unsubscribe(self, writer, body):
+        packet_id = body[:2]
+        offset = 2
+
+        while offset < len(body):
+            sub, offset = decode_string(body, offset)
+            self._subscriptions[writer].discard(sub.decode())
+
+        writer.write(encode_packet(UNSUBACK, 0, packet_id))
+
+
+async def serve(host, port):
+    broker = LocalBroker(host, port)
+    await broker.start()
+    await broker.server.serve_forever()
+
+
+# Main entry point
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="local MQTT broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port))
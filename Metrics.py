@@ -0,0 +1,239 @@
+import time
+import bisect
+import logging
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+class NullSpan:
+    """NullSpan is the span handed out while the metrics are disabled, it
+    does nothing at all.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Span measures the time spent in a stage and records it on exit."""
+    __slots__ = ("_metrics", "_stage", "_started")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe("stage_seconds",
+                              time.perf_counter() - self._started,
+                              stage=self._stage)
+        return False
+
+
+class Metrics:
+    """Metrics keeps the counters and the latency histograms of Hades and
+    renders them, with the gauges read on demand, in the Prometheus text
+    exposition format.
+
+    While disabled every call returns right away and spans are a shared
+    no-op, so the instrumentation can stay in the hot paths.
+    """
+
+    def __init__(self, enabled=False, prefix="hades"):
+        self.enabled = enabled
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = []
+        self._server = None
+        self._thread = None
+
+    def span(self, stage):
+        """span returns a context manager timing the given stage."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage)
+
+    def count(self, name, amount=1, **labels):
+        """count increments the counter with the given labels."""
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """observe records a duration in the histogram with the given
+        labels.
+        """
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # the counts of the buckets, the sum and the count
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1)
+                histogram.append(0.0)
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    def gauge(self, name, fn, label=None):
+        """gauge registers a gauge read when the metrics are rendered. The
+        callable returns a number or, if a label is given, a dict of numbers
+        by the value of the label.
+        """
+        self._gauges.append((name, fn, label))
+
+    def handler(self, name, fn):
+        """handler wraps a topic handler so that its messages are counted
+        and timed, the handler is returned as is while disabled.
+        """
+        if not self.enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def handle(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.count("messages_total", handler=name)
+                self.observe("handler_seconds",
+                             time.perf_counter() - started, handler=name)
+
+        return handle
+
+    def render(self):
+        """render returns all of the metrics in the text exposition
+        format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in
+                                self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            name = self._name(name, "counter", typed, lines)
+            lines.append("%s%s %s" % (name, self._labels(labels),
+                                      self._value(value)))
+
+        for (name, labels), histogram in histograms:
+            name = self._name(name, "histogram", typed, lines)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (
+                    name, self._labels(labels + (("le", str(bound)),)),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (name, self._labels(labels),
+                                          self._value(histogram[-1])))
+            lines.append("%s_count%s %d" % (name, self._labels(labels),
+                                            cumulative))
+
+        for name, fn, label in self._gauges:
+            try:
+                value = fn()
+            except Exception:
+                logging.exception("failed to read the gauge %s", name)
+                continue
+
+            name = self._name(name, "gauge", typed, lines)
+            if label is None:
+                lines.append("%s %s" % (name, self._value(value)))
+                continue
+            for key, item in sorted(value.items()):
+                lines.append("%s%s %s" % (name,
+                                          self._labels(((label, key),)),
+                                          self._value(item)))
+
+        return "\n".join(lines) + "\n"
+
+    def _name(self, name, kind, typed, lines):
+        name = "%s_%s" % (self.prefix, name)
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE %s %s" % (name, kind))
+        return name
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"')) for key, value in labels)
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, int):
+            return str(value)
+        return repr(float(value))
+
+    def start(self, host="127.0.0.1", port=9108):
+        """start serves the metrics over HTTP on /metrics, port 0 picks a
+        free port. Returns the address the endpoint is bound to.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="hades-metrics", daemon=True)
+        self._thread.start()
+
+        address = self._server.server_address
+        logging.info("serving metrics on http://%s:%d/metrics", *address[:2])
+        return address
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
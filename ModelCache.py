@@ -0,0 +1,181 @@
+import os
+import mmap
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+def model_digest(data):
+    """model_digest returns the content hash of a serialized model."""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+class ModelBlob:
+    """ModelBlob is a serialized model kept in memory, either as bytes or as
+    a read-only memory map of the model file.
+
+    The digest is a hash of the content of the model, nodes send it back when
+    requesting a model so that an unchanged model isn't sent again.
+    """
+    __slots__ = ("path", "version", "size", "digest", "_data", "_map",
+                 "_lock")
+
+    def __init__(self, path, version, data=None, mapped=None):
+        self.path = path
+        self.version = version
+        self._data = data
+        self._map = mapped
+        self._lock = threading.Lock()
+        self.size = len(data) if data is not None else len(mapped)
+        self.digest = model_digest(data if data is not None else mapped)
+
+    @property
+    def mapped(self):
+        return self._map is not None
+
+    def payload(self):
+        """payload returns the model as bytes to be published. The MQTT client
+        only accepts bytes, so a mapped model is copied straight from the page
+        cache without opening and reading the file.
+        """
+        if self._data is not None:
+            return self._data
+
+        with self._lock:
+            if not self._map.closed:
+                return self._map[:]
+
+        # the model was evicted while it was being served
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        """close unmaps a mapped model and closes its file descriptor."""
+        if self._map is None:
+            return
+        with self._lock:
+            self._map.close()
+
+
+class ModelCache:
+    """ModelCache keeps the serialized models in memory so that serving a
+    model request doesn't read the model file from disk.
+
+    Models are bounded by a byte budget with LRU eviction. Models larger than
+    the mmap threshold are memory mapped instead, those live in the page cache
+    and don't count against the budget. Every map holds a file descriptor, so
+    the mapped models are bounded by their number with LRU eviction.
+    """
+
+    def __init__(self, max_bytes=0, mmap_threshold=0, max_mapped=256):
+        """
+        Args:
+            max_bytes: the budget of the models kept as bytes, not bounded if
+                it is not positive.
+            mmap_threshold: models of this size or larger are memory mapped,
+                disabled if it is not positive.
+            max_mapped: the most models kept memory mapped, not bounded if it
+                is not positive.
+        """
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold
+        self.max_mapped = max_mapped
+
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()
+        self._bytes = 0
+        self._mapped = 0
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "evictions": 0,
+        }
+
+    def memory(self):
+        """memory returns the bytes of the models kept in memory."""
+        with self._lock:
+            return self._bytes
+
+    def get(self, path):
+        """get returns the cached model of the path, loading it from disk on
+        a miss. Returns None if there is no such model.
+        """
+        with self._lock:
+            blob = self._blobs.get(path)
+            if blob is not None:
+                self._blobs.move_to_end(path)
+                self.stats["hits"] += 1
+                return blob
+            self.stats["misses"] += 1
+
+        return self.load(path)
+
+    def load(self, path, version=None):
+        """load reads the model file into the cache, replacing the cached
+        model of the path. Called by the export stage to fill the cache.
+        """
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if self.mmap_threshold > 0 and size >= self.mmap_threshold:
+                    blob = ModelBlob(path, version, mapped=mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ))
+                else:
+                    blob = ModelBlob(path, version, data=f.read())
+        except (OSError, ValueError):
+            # missing or empty model files can't be served
+            return None
+
+        with self._lock:
+            self.stats["loads"] += 1
+            self._remove(path)
+            self._blobs[path] = blob
+            if blob.mapped:
+                self._mapped += 1
+            else:
+                self._bytes += blob.size
+            self._evict(keep=path)
+
+        return blob
+
+    def invalidate(self, path):
+        """invalidate drops the cached model of the path."""
+        with self._lock:
+            self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._blobs):
+                self._remove(path)
+
+    def _remove(self, path):
+        """Must be called with the lock held."""
+        blob = self._blobs.pop(path, None)
+        if blob is None:
+            return
+        # a mapped model still being published by another thread is read
+        # from its file instead.
+        if blob.mapped:
+            self._mapped -= 1
+            blob.close()
+        else:
+            self._bytes -= blob.size
+
+    def _over_budget(self, blob):
+        if blob.mapped:
+            return self.max_mapped > 0 and self._mapped > self.max_mapped
+        return self.max_bytes > 0 and self._bytes > self.max_bytes
+
+    def _evict(self, keep):
+        """Must be called with the lock held."""
+        for path in list(self._blobs):
+            blob = self._blobs[path]
+            if path == keep or not self._over_budget(blob):
+                continue
+
+            self._remove(path)
+            self.stats["evictions"] += 1
+            logging.debug("evicted model %s from the cache", path)
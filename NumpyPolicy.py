@@ -0,0 +1,122 @@
+import os
+import numpy as np
+
+# the numpy weights are written next to the TensorFlow Lite model
+SUFFIX = ".npz"
+
+
+class NumpyPolicy:
+    """NumpyPolicy is the greedy policy of a trained QNetwork evaluated with
+    NumPy alone. The weights are kept as a single flat float32 array with
+    the (inputs, outputs) shape of every dense layer, the kernel of a layer
+    followed by its bias. The hidden layers use ReLU and the last one gives
+    the Q-values, as in the default QNetwork of tf_agents.
+    """
+
+    def __init__(self, weights, shapes):
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.shapes = np.asarray(shapes, dtype=np.int32).reshape(-1, 2)
+
+        # the layers are views into the flat array
+        self.layers = []
+        offset = 0
+        for inputs, outputs in self.shapes.tolist():
+            kernel = self.weights[offset:offset + inputs * outputs]
+            offset += inputs * outputs
+            bias = self.weights[offset:offset + outputs]
+            offset += outputs
+            self.layers.append((kernel.reshape(inputs, outputs), bias))
+
+        if offset != self.weights.size:
+            raise ValueError("the weights don't match the layer shapes")
+
+    @classmethod
+    def from_q_network(cls, q_net):
+        """from_q_network exports the weights of a QNetwork, its variables
+        are the kernels and the biases of the dense layers in order.
+        """
+        variables = [v.numpy() for v in q_net.trainable_variables]
+        kernels, biases = variables[0::2], variables[1::2]
+        return cls(np.concatenate([np.concatenate([k.ravel(), b.ravel()])
+                                   for k, b in zip(kernels, biases)]),
+                   [k.shape for k in kernels])
+
+    @classmethod
+    def load(cls, path):
+        """load reads the policy written by save, or returns None if there is
+        no such file.
+        """
+        try:
+            with np.load(path) as data:
+                return cls(data["weights"], data["shapes"])
+        except FileNotFoundError:
+            return None
+
+    def save(self, path):
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, weights=self.weights, shapes=self.shapes)
+        os.replace(tmp_file, path)
+
+    @property
+    def nbytes(self):
+        return self.weights.nbytes + self.shapes.nbytes
+
+    def q_values(self, observations):
+        """q_values returns the Q-values of a batch of observations."""
+        x = np.asarray(observations, dtype=np.float32)
+        x = x.reshape(x.shape[0] if x.ndim else 1, -1)
+        last = len(self.layers) - 1
+        for i, (kernel, bias) in enumerate(self.layers):
+            x = x @ kernel + bias
+            if i < last:
+                np.maximum(x, 0, out=x)
+        return x
+
+    def actions(self, observations):
+        """actions returns the greedy actions of a batch of observations."""
+        return np.argmax(self.q_values(observations), axis=-1)
+
+    def action(self, observation):
+        """action returns the greedy action of a single observation."""
+        return int(self.actions([observation])[0])
+
+
+class PolicyBatch:
+    """PolicyBatch evaluates the policies of many devices, every device with
+    its own network, with a single batched matrix multiplication per layer.
+    The networks of the devices must have the same layer shapes.
+    """
+
+    def __init__(self, policies):
+        policies = list(policies)
+        self.size = len(policies)
+        self.layers = []
+        if not policies:
+            return
+
+        shapes = policies[0].shapes
+        for policy in policies[1:]:
+            if not np.array_equal(policy.shapes, shapes):
+                raise ValueError("the policies have different layer shapes")
+
+        for i in range(len(shapes)):
+            kernels = np.stack([policy.layers[i][0] for policy in policies])
+            biases = np.stack([policy.layers[i][1] for policy in policies])
+            self.layers.append((kernels, biases[:, np.newaxis, :]))
+
+    def actions(self, observations):
+        """actions returns the greedy action of every device, given one
+        observation of each device in the order of the policies.
+        """
+        if not self.size:
+            return np.zeros(0, dtype=np.int64)
+
+        x = np.asarray(observations, dtype=np.float32)
+        x = x.reshape(self.size, 1, -1)
+        last = len(self.layers) - 1
+        for i, (kernels, biases) in enumerate(self.layers):
+            x = np.matmul(x, kernels) + biases
+            if i < last:
+                np.maximum(x, 0, out=x)
+        return np.argmax(x[:, 0, :], axis=-1)
@@ -0,0 +1,346 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from Cluster import HashRing
+from CheckpointPolicy import CheckpointPolicy
+from DeviceStateStore import DeviceStateStore
+
+# the stats of a training process are sent along with a train reply at most
+# this often, in seconds.
+STATS_INTERVAL = 1.0
+
+
+def create_dqn_agent(state_store, settings):
+    """create_dqn_agent builds the DqnAgent of a training process. TensorFlow
+    is only imported in the training processes.
+    """
+    from DqnAgent import DqnAgent
+    from AgentCache import AgentCache
+
+    checkpoint = settings.get("checkpoint", {})
+    cache = settings.get("cache", {})
+    training = settings.get("training", {})
+
+    checkpoint_policy = CheckpointPolicy(
+        every_steps=checkpoint.get("every_steps", 1),
+        every_seconds=checkpoint.get("every_seconds", 0),
+        on_shutdown=checkpoint.get("on_shutdown", True))
+    agent_cache = AgentCache(
+        max_entries=cache.get("max_devices", 0),
+        max_bytes=cache.get("max_memory_mb", 0) * 1024 * 1024)
+
+    return DqnAgent(state_store=state_store,
+                    checkpoint_policy=checkpoint_policy,
+                    agent_cache=agent_cache,
+                    sample_batch_size=training.get("sample_batch_size", 2),
+                    num_steps=training.get("num_steps", 2),
+                    train_steps=training.get("gradient_steps", 1),
+                    replay_config=settings.get("replay"),
+                    compiled=training.get("compiled", False),
+                    jit_compile=training.get("xla", False))
+
+
+def serve(conn, factory, settings):
+    """serve is the main loop of a training process. It owns the agents of
+    its devices and handles the requests of the Hades process one at a time.
+    In between the requests, the checkpoints which are overdue are written.
+
+    The device states are kept in memory only - the Hades process sends the
+    state with every reading and writes back the state it gets in return,
+    along with the stats of the agent cache and the replay buffers.
+    """
+    # the Hades process decides when the training processes stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=settings.get("log_level", logging.INFO))
+
+    state_store = DeviceStateStore(None, flush_interval=0)
+    agent = factory(state_store, settings)
+    reported_at = None
+
+    def stats():
+        """Returns the stats of the process, or None if they were reported
+        recently.
+        """
+        nonlocal reported_at
+        now = time.monotonic()
+        if reported_at is not None and now - reported_at < STATS_INTERVAL:
+            return None
+        reported_at = now
+
+        # the stats of the single devices are left out of the reply.
+        replay = agent.replay_stats()
+        return {"cache": agent.cache_stats(),
+                "replay": {"memory": replay["memory"],
+                           "disk": replay["disk"]}}
+
+    def train(mac, state, readings):
+        state_store.update(mac, **state['stats'])
+
+        # the agent cache of the process may have evicted the device, the
+        # Hades process still takes it as added.
+        if not agent.device_exists(mac):
+            agent.add_device(mac)
+
+        def observe(i):
+            state_store.observe(mac, readings[i])
+
+        changed = agent.train(mac, steps=len(readings), before_step=observe)
+        return changed, state_store.get(mac).to_dict(), stats()
+
+    def release(mac):
+        agent.release(mac)
+        state_store.release(mac)
+
+    handlers = {
+        "add": agent.add_device,
+        "train": train,
+        "export": agent.export,
+        "save": agent.save_checkpoint,
+        "release": release,
+        "close": agent.close,
+    }
+
+    sweep_interval = None
+    every_seconds = settings.get("checkpoint", {}).get("every_seconds", 0)
+    if every_seconds > 0:
+        sweep_interval = min(CheckpointPolicy.sweep_interval, every_seconds)
+    swept_at = time.monotonic()
+
+    while True:
+        try:
+            if sweep_interval is not None:
+                if time.monotonic() - swept_at >= sweep_interval:
+                    swept_at = time.monotonic()
+                    try:
+                        agent.save_overdue()
+                    except Exception:
+                        logging.exception("failed to save the overdue "
+                                          "checkpoints")
+                if not conn.poll(sweep_interval):
+                    continue
+            command, args = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        try:
+            conn.send(("ok", handlers[command](*args)))
+        except Exception as e:
+            logging.exception("training process failed to %s", command)
+            conn.send(("error", repr(e)))
+
+        if command == "close":
+            break
+
+    conn.close()
+
+
+class TrainingProcess:
+    """TrainingProcess is the Hades side of a training process, requests are
+    sent over a pipe and the caller waits for the reply.
+    """
+
+    def __init__(self, context, name, factory, settings):
+        self.name = name
+        self._lock = threading.Lock()
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=serve, name=name,
+                                        args=(child_conn, factory, settings),
+                                        daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def call(self, command, *args):
+        with self._lock:
+            self._conn.send((command, args))
+            status, result = self._conn.recv()
+
+        if status != "ok":
+            raise RuntimeError("%s failed to %s: %s" % (self.name, command,
+                                                        result))
+        return result
+
+    def close(self, timeout=None):
+        try:
+            self.call("close")
+        except (EOFError, OSError, RuntimeError):
+            logging.exception("failed to close %s", self.name)
+
+        self._conn.close()
+        self._process.join(timeout)
+
+
+class ProcessDqnAgent:
+    """ProcessDqnAgent partitions the devices across a pool of training
+    processes, so that collecting and training of the agents isn't
+    serialized by the interpreter lock of the Hades process.
+
+    Every process owns the agents of its devices. The readings of a device
+    are sent to its process, which replies with the new device state and
+    whether the model should be exported. Training and export of different
+    processes run in parallel, the requests for a single process are handled
+    one at a time - the training workers should be at least as many as the
+    processes.
+    """
+
+    def __init__(self, processes=2, state_store=None, settings=None,
+                 factory=create_dqn_agent):
+        """
+        Args:
+            processes: the number of training processes.
+            state_store: the device states of the Hades process.
+            settings: the checkpoint, agent cache, replay and training
+                settings given to every training process.
+            factory: a callable(state_store, settings) building the agent of
+                a training process.
+        """
+        if state_store is None:
+            state_store = DeviceStateStore()
+        self.state_store = state_store
+        self.model_dir = "models"
+
+        settings = dict(settings or {})
+        settings.setdefault("log_level", logging.getLogger().level)
+
+        # TensorFlow isn't safe to fork, the processes start from scratch.
+        context = multiprocessing.get_context("spawn")
+        self._processes = {}
+        for i in range(max(1, int(processes))):
+            name = "hades-train-process-%d" % i
+            self._processes[name] = TrainingProcess(context, name, factory,
+                                                    settings)
+        self._ring = HashRing(self._processes)
+
+        # the version of the model of every device against the exported one
+        self._lock = threading.Lock()
+        self._versions = {}
+
+        # the last stats reported by every process, read by the metrics
+        # without waiting for the processes.
+        self._stats = {name: {"cache": {}, "replay": {}}
+                       for name in self._processes}
+
+        logging.info("initialized ProcessDqnAgent with %d processes",
+                     len(self._processes))
+
+    @property
+    def devices(self):
+        with self._lock:
+            return list(self._versions)
+
+    def process(self, mac):
+        """process returns the training process owning the device."""
+        return self._processes[self._ring.owner(mac)]
+
+    def device_exists(self, mac):
+        with self._lock:
+            return mac in self._versions
+
+    def add_device(self, mac):
+        self.process(mac).call("add", mac)
+        with self._lock:
+            self._versions.setdefault(mac, [0, -1])
+
+    def release(self, mac):
+        with self._lock:
+            if self._versions.pop(mac, None) is None:
+                return
+        self.process(mac).call("release", mac)
+
+    def train(self, mac, steps=1, before_step=None):
+        """train applies the readings to the device state, like the other
+        agents, and sends the readings with the state to the process of the
+        device for training.
+        """
+        if not self.device_exists(mac):
+            return False
+
+        readings = []
+        for i in range(steps):
+            if before_step is not None:
+                before_step(i)
+            readings.append(self.state_store.get(mac).curr_temperature)
+
+        state = self.state_store.get(mac).to_dict()
+        process = self.process(mac)
+        changed, state, stats = process.call("train", mac, state, readings)
+
+        self.state_store.update(mac, **state['stats'])
+        with self._lock:
+            versions = self._versions.get(mac)
+            if versions is not None:
+                versions[0] += 1
+            if stats is not None:
+                self._stats[process.name] = stats
+        return changed
+
+    def export_key(self, mac):
+        return mac
+
+    def needs_export(self, mac):
+        with self._lock:
+            versions = self._versions.get(mac)
+            return versions is not None and versions[0] > versions[1]
+
+    def export(self, mac):
+        with self._lock:
+            versions = self._versions.get(mac)
+            if versions is None:
+                return None
+            version = versions[0]
+
+        if self.process(mac).call("export", mac) is None:
+            return None
+
+        with self._lock:
+            versions = self._versions.get(mac)
+            if versions is not None:
+                versions[1] = max(versions[1], version)
+        return version
+
+    def convert_to_tflite(self, mac):
+        return self.export(mac)
+
+    def model_path(self, mac):
+        return os.path.join(self.model_dir, mac)
+
+    def save_checkpoint(self, mac):
+        self.process(mac).call("save", mac)
+
+    def save_overdue(self):
+        # the training processes sweep their own checkpoints.
+        pass
+
+    def replay_stats(self):
+        """replay_stats reports the replay memory of all of the training
+        processes together, as last reported by the processes.
+        """
+        stats = {"memory": 0, "disk": 0}
+        with self._lock:
+            for reported in self._stats.values():
+                for name, value in reported["replay"].items():
+                    stats[name] += value
+        return stats
+
+    def cache_stats(self):
+        """cache_stats reports the agent caches of all of the training
+        processes together, as last reported by the processes.
+        """
+        stats = {}
+        with self._lock:
+            for reported in self._stats.values():
+                for name, value in reported["cache"].items():
+                    if name.endswith("max_seconds"):
+                        stats[name] = max(stats.get(name, 0), value)
+                    else:
+                        stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def close(self):
+        """close will stop the training processes, which write their
+        checkpoints according to the checkpoint policy.
+        """
+        for process in self._processes.values():
+            process.close()
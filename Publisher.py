@@ -0,0 +1,226 @@
+import time
+import logging
+import threading
+from collections import deque
+
+# the classes of the published topics, by the suffix of the topic
+TOPIC_CLASSES = (
+    ("/hades/interval/receive", "interval"),
+    ("/hades/interval/receive/bin", "interval"),
+    ("/hades/model/receive", "model"),
+    ("/hades/event/sent", "event"),
+    ("/hades/pong", "pong"),
+)
+
+
+def topic_class(topic):
+    """topic_class returns the class of the topic rate limits apply to."""
+    for suffix, name in TOPIC_CLASSES:
+        if topic.endswith(suffix):
+            return name
+    return "other"
+
+
+class TokenBucket:
+    """TokenBucket allows rate messages a second, with bursts of up to a
+    second's worth.
+    """
+    __slots__ = ("rate", "tokens", "updated")
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(max(1.0, self.rate),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """wait returns the seconds until the next token."""
+        return (1.0 - self.tokens) / self.rate
+
+
+class Publisher:
+    """Publisher sends the outgoing messages of Hades. Once started, the
+    messages are queued by the class of their topic and published in batches
+    by a single thread, the classes with a rate limit are throttled without
+    holding back the others. When not started, the messages are published
+    right away.
+    """
+
+    def __init__(self, send, batch_size=64, queue_size=10000, rates=None,
+                 qos=None, metrics=None):
+        """
+        Args:
+            send: a callable(topic, payload, qos, retain) publishing a single
+                message, the publish of the MQTT client.
+            batch_size: the most messages published in one batch.
+            queue_size: the most messages queued, further ones are dropped.
+            rates: a dict of the messages a second allowed by topic class,
+                a class without a rate isn't limited.
+            qos: a dict of the QoS level by topic class, used when a message
+                is published without one. The classes without one use 0.
+            metrics: the Metrics the throughput and the lag are recorded in.
+        """
+        self._send = send
+        self._batch_size = max(1, int(batch_size))
+        self._queue_size = int(queue_size)
+        self._buckets = {name: TokenBucket(rate) for name, rate in
+                         (rates or {}).items() if rate > 0}
+        self._qos = dict(qos or {})
+        self._metrics = metrics
+
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._queued = 0
+        self._sending = 0
+        self._thread = None
+        self._running = False
+
+        self.stats = {
+            "published": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+            "lag_seconds": 0.0,
+            "max_lag_seconds": 0.0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(target=self._run,
+                                        name="hades-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """stop publishes the queued messages, without the rate limits, and
+        stops the publishing thread.
+        """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+
+        if wait:
+            self._thread.join()
+        self._thread = None
+
+    def pending(self):
+        with self._cond:
+            return self._queued
+
+    def flush(self):
+        """flush blocks until the queued messages have been published."""
+        with self._cond:
+            while self._running and (self._queued or self._sending):
+                self._cond.wait()
+
+    def publish(self, topic, payload=None, qos=None, retain=False):
+        """publish queues the message, or publishes it right away if the
+        publisher isn't started. Without a QoS level, the one of the topic
+        class is used. Returns False if the queue is full and the message was
+        dropped.
+        """
+        name = topic_class(topic)
+        if qos is None:
+            qos = self._qos.get(name, 0)
+        with self._cond:
+            if not self._running:
+                queued = False
+            elif self._queued >= self._queue_size:
+                self.stats["dropped"] += 1
+                logging.warning("publish queue is full, dropping %s", topic)
+                return False
+            else:
+                queue = self._queues.get(name)
+                if queue is None:
+                    queue = self._queues[name] = deque()
+                queue.append((time.monotonic(), topic, payload, qos,
+                              retain))
+                self._queued += 1
+                # flush waits on the same condition as the publishing thread.
+                self._cond.notify_all()
+                queued = True
+
+        if not queued:
+            self._publish([(name, (time.monotonic(), topic, payload, qos,
+                                   retain))])
+        return True
+
+    def _take(self):
+        """_take returns the next batch of messages with their classes and
+        the seconds until a throttled class may publish again. Must be
+        called with the lock held.
+        """
+        batch = []
+        wait = None
+        now = time.monotonic()
+        for name, queue in self._queues.items():
+            count = min(len(queue), self._batch_size - len(batch))
+            bucket = self._buckets.get(name)
+            if bucket is not None and self._running:
+                bucket.refill(now)
+                count = min(count, int(bucket.tokens))
+                bucket.tokens -= count
+                if queue and count < len(queue) and \
+                        len(batch) + count < self._batch_size:
+                    delay = bucket.wait()
+                    wait = delay if wait is None else min(wait, delay)
+
+            for _ in range(count):
+                batch.append((name, queue.popleft()))
+        self._queued -= len(batch)
+        return batch, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch, wait = self._take()
+                while not batch:
+                    if not self._running and not self._queued:
+                        return
+                    self._cond.wait(wait)
+                    batch, wait = self._take()
+                self._sending += 1
+
+            try:
+                self._publish(batch)
+            finally:
+                with self._cond:
+                    self._sending -= 1
+                    self.stats["batches"] += 1
+                    self._cond.notify_all()
+
+    def _publish(self, batch):
+        published = failed = 0
+        max_lag = lag = 0.0
+        for name, (queued_at, topic, payload, qos, retain) in batch:
+            try:
+                self._send(topic, payload, qos, retain)
+            except Exception:
+                logging.exception("failed to publish on %s", topic)
+                failed += 1
+                continue
+
+            published += 1
+            delay = time.monotonic() - queued_at
+            lag += delay
+            max_lag = max(max_lag, delay)
+            if self._metrics is not None:
+                self._metrics.count("published_total", topic_class=name)
+                self._metrics.observe("publish_lag_seconds", delay,
+                                      topic_class=name)
+
+        with self._cond:
+            self.stats["published"] += published
+            self.stats["failed"] += failed
+            self.stats["lag_seconds"] += lag
+            self.stats["max_lag_seconds"] = max(
+                self.stats["max_lag_seconds"], max_lag)
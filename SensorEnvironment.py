@@ -1,13 +1,22 @@
 import numpy as np
 import tensorflow as tf
-import os
-import json
-from hades_utils import num
+import sensor_kernel
+from DeviceStateStore import DeviceStateStore
 from tf_agents.environments import py_environment
 from tf_agents.specs import array_spec
 from tf_agents.trajectories import time_step as ts
 
-tf.compat.v1.enable_v2_behavior()
+_v2_enabled = False
+
+
+def enable_v2_behavior():
+    """enable_v2_behavior enables the TensorFlow 2 behaviour once, when the
+    first environment is created rather than when the module is imported.
+    """
+    global _v2_enabled
+    if not _v2_enabled:
+        tf.compat.v1.enable_v2_behavior()
+        _v2_enabled = True
 
 
 class SensorEnv(py_environment.PyEnvironment):
@@ -24,21 +33,18 @@ class SensorEnv(py_environment.PyEnvironment):
     The action is a vector of one element which indicates what action to take
     with the current temperature send interval.
     """
-    REWARD_WITHIN_BOUNDS = np.asarray(1., dtype=np.float32)
-    REWARD_DO_NOTHING = np.asarray(0., dtype=np.float32)
-    REWARD_OUT_OF_BOUNDS = np.asarray(-2., dtype=np.float32)
-
-    REWARD_CORRECT_ACTION = np.asarray(1., dtype=np.float32)
-    REWARD_INCORRECT_ACTION = np.asarray(-2., dtype=np.float32)
-
-    REWARD_WITHIN_BOUNDS.setflags(write=False)
-    REWARD_OUT_OF_BOUNDS.setflags(write=False)
-    REWARD_DO_NOTHING.setflags(write=False)
-
-    REWARD_INCORRECT_ACTION.setflags(write=False)
-    REWARD_CORRECT_ACTION.setflags(write=False)
-
-    def __init__(self, mac, discount=0.5, delta=3):
+    # the step logic is kept in sensor_kernel, which has a vectorized
+    # variant for many devices at once.
+    REWARD_WITHIN_BOUNDS = sensor_kernel.REWARD_WITHIN_BOUNDS
+    REWARD_DO_NOTHING = sensor_kernel.REWARD_DO_NOTHING
+    REWARD_OUT_OF_BOUNDS = sensor_kernel.REWARD_OUT_OF_BOUNDS
+
+    REWARD_CORRECT_ACTION = sensor_kernel.REWARD_CORRECT_ACTION
+    REWARD_INCORRECT_ACTION = sensor_kernel.REWARD_INCORRECT_ACTION
+
+    def __init__(self, mac, state_store=None, discount=0.5,
+                 delta=sensor_kernel.DELTA):
+        enable_v2_behavior()
         super(SensorEnv, self).__init__()
 
         # the environment of a given device with a MAC address.
@@ -46,6 +52,13 @@ class SensorEnv(py_environment.PyEnvironment):
         self._iteration = 0
         self._state_dir = "states"
 
+        # the state of the device is shared with Hades through the store, if
+        # no store is given - read and write the state files directly.
+        if state_store is None:
+            state_store = DeviceStateStore(self._state_dir, flush_interval=0)
+            state_store.load_device(mac)
+        self._state_store = state_store
+
         # three actions are allowed for reading time modification:
         #   0. Do nothing
         #   1. Decrease
@@ -97,6 +110,11 @@ class SensorEnv(py_environment.PyEnvironment):
         """
         return self._action_spec
 
+    @property
+    def delta(self):
+        """delta returns the boundary of the temperature delta."""
+        return self._delta
+
     def observation_spec(self):
         """Override the internal observation specification. It will define
         the structure of observations that are provided by the environment.
@@ -109,43 +127,30 @@ class SensorEnv(py_environment.PyEnvironment):
         return ts.restart(np.array(self._states, dtype=np.float32))
 
     def load_env_state(self, mac):
-        state_file = os.path.join(self._state_dir, mac)
-
-        with open(state_file, 'r') as json_file:
-            data = json.load(json_file)
-            self._states[0] = data['stats']['prev_delta']
-
-            previous_temperature = data['stats']['prev_temperature']
-            self._previous_temperature = num(previous_temperature)
+        state = self._state_store.get(mac)
 
-            current_temperature = data['stats']['curr_temperature']
-            self._current_temperature = num(current_temperature)
-
-            current_send_interval = data['stats']['send_interval']
-            self._current_send_interval = num(current_send_interval)
+        self._states[0] = state.prev_delta
+        self._previous_temperature = state.prev_temperature
+        self._current_temperature = state.curr_temperature
+        self._current_send_interval = state.send_interval
 
         return
 
     def save_env_state(self, mac, states):
-        """We save important environment values in a json dump file for later
-        reuse. As when using a Checkpointer it doesn't save environment values.
+        """We save important environment values in the device state store for
+        later reuse. As when using a Checkpointer it doesn't save environment
+        values.
 
         Args:
             mac: the MAC address of the device whose state we save.
             states: the state of the environment.
         """
-        state_file = os.path.join(self._state_dir, mac)
-
-        data = {}
-        data['stats'] = {
-            'prev_temperature': self._previous_temperature,
-            'prev_delta': self._states[0],
-            'curr_temperature': self._current_temperature,
-            'send_interval': self._current_send_interval,
-        }
-
-        with open(state_file, 'w') as outfile:
-            json.dump(data, outfile)
+        self._state_store.update(
+            mac,
+            prev_temperature=self._previous_temperature,
+            prev_delta=self._states[0],
+            curr_temperature=self._current_temperature,
+            send_interval=self._current_send_interval)
 
         return
 
@@ -197,23 +202,12 @@ class SensorEnv(py_environment.PyEnvironment):
 
         Args:
             action: the action to be taken selected by the policy.
-            states: the state of temperature and send interval of delta.
+            send_interval: the current send interval.
 
         Returns:
             A modified send interval.
         """
-
-        # we need to decrease the read time as the temperature differences
-        # are too great.
-        if action == 1 and send_interval > 1:
-            send_interval -= 1  # decrease by a minute
-
-        # we need to increase the read time as we have some spare room for
-        # accuracy disregard.
-        if action == 2:
-            send_interval += 1  # increase by a minute
-
-        return send_interval
+        return sensor_kernel.calculate_read_time(action, send_interval)
 
     def _check_delta_within_bounds(self, states, delta):
         """Check if the given state temperature delta is within given delta.
@@ -225,30 +219,8 @@ class SensorEnv(py_environment.PyEnvironment):
             A tuple of (need_adjust, reward) where was_adjusted means whether
             we need to make changes to send interval or not, and reward is the
             reward for is temperature delta within defined delta.
-
-            The meaning of reward:
-            1 = within bounds (good), 0 = just good, -1 = out of bounds (bad)
         """
-        currentDelta = abs(states[0])
-
-        # XXX: the 'just in case' values (0.7; 0.5) should be made more logical
-        # and derived from something.
-        if currentDelta >= delta:
-            # temperature delta is out of safe bounds! Reduce send interval.
-            # Simple as that!
-            return True, self.REWARD_OUT_OF_BOUNDS  # decrease send interval
-        elif currentDelta + 0.7 >= delta:
-            # mmm, we are in a comfortable position and we can leave it at that
-            return False, self.REWARD_DO_NOTHING    # don't adjust
-        elif currentDelta < (delta - 0.5):
-            # if we come here, it means that we can further increase the send
-            # interval. We do this by checking that we are still within delta
-            # bounds minus accuracy penalty (just in case by increasing the
-            # send interval we make the delta too big).
-            return True, self.REWARD_WITHIN_BOUNDS  # increase send interval
-
-        # if nothing is triggered
-        return False, self.REWARD_DO_NOTHING
+        return sensor_kernel.check_delta_within_bounds(states[0], delta)
 
     def _check_calculated(self, states, delta, n_interval, reward, o_interval):
         """Should be called after calculations were made. With this, we do
@@ -263,35 +235,60 @@ class SensorEnv(py_environment.PyEnvironment):
             o_interval: the previous send interval.
             reward: the calculated reward.
         """
-        current_delta = states[0]
-        new_interval = n_interval
-        old_interval = o_interval
-
-        # if we got a negative reward and action was 1 - we reward.
-        if new_interval < old_interval and reward < 0:
-            return self.REWARD_CORRECT_ACTION, new_interval
-
-        # if we got a positive reward and needed to adjust, it means we can
-        # increase the send interval. However, if we haven't adjusted it,
-        # punish with negative reward.
-        if reward > 0 and new_interval <= old_interval:
-            return self.REWARD_INCORRECT_ACTION, new_interval
-
-        # if we increased the send interval but the delta was too big. Reward
-        # with a negative reward and decrease the send interval.
-        if new_interval > old_interval and delta < current_delta:
-            if old_interval > 1:
-                return self.REWARD_INCORRECT_ACTION, old_interval - 1
-            else:
-                return self.REWARD_INCORRECT_ACTION, old_interval
-
-        # if we decremented and the delta was too big - reward!
-        if new_interval < old_interval and delta < current_delta:
-            return self.REWARD_CORRECT_ACTION, new_interval
-
-        # if we can increase but haven't - negative reward.
-        if current_delta < (delta - 0.5) and new_interval == old_interval:
-            return self.REWARD_INCORRECT_ACTION, new_interval + 1
-
-        # just in case return
-        return reward, new_interval
+        return sensor_kernel.check_calculated(states[0], delta, n_interval,
+                                              reward, o_interval)
+
+
+def tf_sensor_step(prev_temperature, curr_temperature, send_interval, action,
+                   delta=3):
+    """tf_sensor_step is the step of SensorEnv as TensorFlow ops, so that it
+    can be compiled together with the policy and the training step. The
+    temperatures and the send interval are float64 scalars, like the Python
+    floats of the environment, and the action is an int32 scalar.
+
+    Returns:
+        A tuple of (temperature delta, reward, send interval) after the step,
+        the previous temperature becomes the current one.
+    """
+    float64 = tf.float64
+    delta = tf.constant(delta, dtype=float64)
+    prev = tf.where(tf.equal(prev_temperature, -999.), curr_temperature,
+                    prev_temperature)
+    current_delta = tf.abs(prev - curr_temperature)
+
+    # _check_delta_within_bounds
+    out_of_bounds = current_delta >= delta
+    do_nothing = current_delta + 0.7 >= delta
+    within_bounds = current_delta < delta - 0.5
+    adjust = out_of_bounds | (~do_nothing & within_bounds)
+    reward = tf.where(out_of_bounds, SensorEnv.REWARD_OUT_OF_BOUNDS,
+                      tf.where(~do_nothing & within_bounds,
+                               SensorEnv.REWARD_WITHIN_BOUNDS,
+                               SensorEnv.REWARD_DO_NOTHING))
+
+    # calculate_read_time
+    old = send_interval
+    new = tf.where(tf.equal(action, 1) & (old > 1), old - 1, old)
+    new = tf.where(tf.equal(action, 2), new + 1, new)
+
+    # _check_calculated - the conditions are applied from the last one, so
+    # that the first matching one takes precedence.
+    correct = SensorEnv.REWARD_CORRECT_ACTION
+    incorrect = SensorEnv.REWARD_INCORRECT_ACTION
+    checks = [
+        ((new < old) & (reward < 0), correct, new),
+        ((reward > 0) & (new <= old), incorrect, new),
+        ((new > old) & (delta < current_delta), incorrect,
+         tf.where(old > 1, old - 1, old)),
+        ((new < old) & (delta < current_delta), correct, new),
+        ((current_delta < delta - 0.5) & tf.equal(new, old), incorrect,
+         new + 1),
+    ]
+    checked_reward, checked_interval = reward, new
+    for condition, value, interval in reversed(checks):
+        checked_reward = tf.where(condition, value, checked_reward)
+        checked_interval = tf.where(condition, interval, checked_interval)
+
+    reward = tf.where(adjust, checked_reward, reward)
+    send_interval = tf.where(adjust, checked_interval, send_interval)
+    return current_delta, reward, send_interval
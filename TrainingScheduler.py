@@ -0,0 +1,218 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+
+class TrainingScheduler:
+    """TrainingScheduler moves training off the MQTT network thread. Work is
+    kept in per-device queues and handed to a bounded pool of worker threads.
+
+    A device is only ever processed by one worker at a time, so the work for
+    a single device is executed in the order it was submitted, while
+    different devices are trained concurrently and served round-robin.
+
+    Items of a device that arrive within the coalescing window are handed to
+    the handler together, so a burst of messages results in a single run.
+    """
+
+    def __init__(self, handler, workers=1, queue_depth=16, window=0.0):
+        """
+        Args:
+            handler: a callable(key, items) that performs the actual work on
+                a list of items collected for the device.
+            workers: the number of worker threads in the pool.
+            queue_depth: the maximum number of pending items per device. When
+                the queue of a device is full, new items are rejected.
+            window: the number of seconds to wait after the first item of a
+                device arrives before running, to coalesce following items.
+        """
+        self._handler = handler
+        self._workers = max(1, int(workers))
+        self._queue_depth = max(1, int(queue_depth))
+        self._window = max(0.0, float(window))
+
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._since = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._active = set()
+        self._threads = []
+        self._running = False
+
+        # "submitted" against "runs" gives the coalescing ratio.
+        self.stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "runs": 0,
+            "completed": 0,
+            "failed": 0,
+            "discarded": 0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run,
+                                      name="hades-train-%d" % i,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logging.info("started training scheduler with %d workers",
+                     self._workers)
+
+    def stop(self, wait=True):
+        """stop will stop the workers. If wait is True then the pending work
+        is finished before the workers exit.
+        """
+        with self._cond:
+            if wait and self._running:
+                while self._ready or self._active:
+                    self._cond.wait()
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, key, item):
+        """submit will enqueue an item of work for the given device and
+        return immediately. Returns False if the device queue is full and the
+        item was rejected.
+        """
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+
+            if len(queue) >= self._queue_depth:
+                self.stats["rejected"] += 1
+                return False
+
+            queue.append(item)
+            self.stats["submitted"] += 1
+
+            if len(queue) == 1:
+                self._since[key] = time.monotonic()
+
+                # the device is either waiting or being processed already
+                if key not in self._active:
+                    self._schedule(key)
+
+        return True
+
+    def coalescing_ratio(self):
+        """coalescing_ratio returns the number of submitted items per a
+        single run of the handler.
+        """
+        with self._cond:
+            if self.stats["runs"] == 0:
+                return 0.0
+            return self.stats["submitted"] / self.stats["runs"]
+
+    def pending(self, key=None):
+        """pending returns the number of queued items for the given device or
+        for all devices if no key is given.
+        """
+        with self._cond:
+            if key is not None:
+                return len(self._queues.get(key, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def discard(self, key):
+        """discard drops the queued items of the device and waits for the run
+        of the device in progress, if there is one, to finish. Returns the
+        number of dropped items. Must not be called from the handler.
+        """
+        with self._cond:
+            queue = self._queues.get(key)
+            dropped = len(queue) if queue else 0
+            self.stats["discarded"] += dropped
+
+            self._since.pop(key, None)
+            self._ready = [entry for entry in self._ready if entry[2] != key]
+            heapq.heapify(self._ready)
+            if key in self._active:
+                # the worker drops the emptied queue when it is done.
+                queue.clear()
+                while key in self._active:
+                    self._cond.wait()
+            else:
+                self._queues.pop(key, None)
+            self._cond.notify_all()
+
+        return dropped
+
+    def join(self):
+        """join blocks until all of the submitted work has been processed."""
+        with self._cond:
+            while self._ready or self._active:
+                self._cond.wait()
+
+    def _schedule(self, key):
+        """_schedule will mark the device ready once its window has passed.
+        Must be called with the lock held.
+        """
+        ready_at = self._since[key] + self._window
+        heapq.heappush(self._ready, (ready_at, next(self._seq), key))
+        # join and stop wait on the same condition, a single wakeup could
+        # reach one of them instead of an idle worker.
+        self._cond.notify_all()
+
+    def _next(self):
+        """_next waits for a device whose window has passed and returns it
+        or None if the scheduler was stopped. Must be called with the lock
+        held.
+        """
+        while self._running:
+            if not self._ready:
+                self._cond.wait()
+                continue
+
+            delay = self._ready[0][0] - time.monotonic()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+
+            return heapq.heappop(self._ready)[2]
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key = self._next()
+                if key is None:
+                    return
+
+                queue = self._queues[key]
+                items = list(queue)
+                queue.clear()
+                del self._since[key]
+                self._active.add(key)
+                self.stats["runs"] += 1
+
+            try:
+                self._handler(key, items)
+                failed = False
+            except Exception:
+                logging.exception("training failed for %s", key)
+                failed = True
+
+            with self._cond:
+                self._active.discard(key)
+                self.stats["failed" if failed else "completed"] += len(items)
+
+                if self._queues[key]:
+                    self._schedule(key)
+                else:
+                    del self._queues[key]
+                self._cond.notify_all()
@@ -0,0 +1,176 @@
+"""Benchmarks of the message hot paths of Hades, with pytest-benchmark. The
+server is driven directly with an in-process client and everything runs
+offline, the benchmarks of the agent are skipped without TensorFlow.
+
+    pytest benchmarks/bench_hot_paths.py --benchmark-autosave
+    pytest benchmarks/bench_hot_paths.py --benchmark-compare
+
+The results are stored as JSON under .benchmarks/ for every run, compare two
+of them with 'pytest-benchmark compare 0001 0002'.
+"""
+
+import os
+import sys
+import json
+import itertools
+from collections import namedtuple
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import hades  # noqa: E402
+import simulate  # noqa: E402
+from AgentLoader import AgentLoader  # noqa: E402
+from ModelCache import model_digest  # noqa: E402
+from CheckpointPolicy import CheckpointPolicy  # noqa: E402
+from DeviceStateStore import DeviceStateStore  # noqa: E402
+
+MAC = "AA:BB:CC:DD:EE:FF"
+MODEL = os.urandom(16 * 1024)
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+class NullClient:
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+
+class InlineScheduler:
+    """InlineScheduler trains on a reading as soon as it is submitted, so
+    that on_stats is measured together with the training it causes.
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+        self.stats = {"submitted": 0, "rejected": 0}
+
+    def submit(self, key, item):
+        self.stats["submitted"] += 1
+        self._handler(key, [item])
+        return True
+
+    def coalescing_ratio(self):
+        return 1.0
+
+
+def new_macs():
+    return ("02:00:00:00:%02X:%02X" % (i >> 8 & 0xff, i & 0xff)
+            for i in itertools.count())
+
+
+def statistics(mac, temperature):
+    return Message(f"hades/global/{mac}/statistics",
+                   json.dumps({"temperature": temperature}))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.mkdir(directory)
+    return tmp_path
+
+
+@pytest.fixture
+def quiet_checkpoints():
+    return CheckpointPolicy(every_steps=0, on_shutdown=False)
+
+
+@pytest.fixture
+def dqn_agent(workdir, quiet_checkpoints):
+    pytest.importorskip("tf_agents")
+    from DqnAgent import DqnAgent
+
+    store = DeviceStateStore(None, flush_interval=0)
+    return DqnAgent(state_store=store, checkpoint_policy=quiet_checkpoints)
+
+
+@pytest.fixture(params=["kernel", "dqn"])
+def server(request, workdir, quiet_checkpoints):
+    server = hades.Hades(hades.HadesConfig("hades.conf"))
+    server.client = NullClient()
+    server.scheduler = InlineScheduler(server._train_device)
+
+    if request.param == "kernel":
+        server.dqn_agent = AgentLoader(
+            lambda: simulate.KernelAgent(server.state_store))
+    else:
+        pytest.importorskip("tf_agents")
+        server.dqn_agent.get().checkpoint_policy = quiet_checkpoints
+    return server
+
+
+def test_on_stats_warm(benchmark, server):
+    server.on_stats(None, None, statistics(MAC, 20.0))
+    temperatures = itertools.cycle([20.0, 21.5, 19.0, 24.0, 22.0])
+
+    benchmark(lambda: server.on_stats(
+        None, None, statistics(MAC, next(temperatures))))
+
+
+def test_on_stats_cold(benchmark, server):
+    macs = new_macs()
+
+    def setup():
+        return (None, None, statistics(next(macs), 20.0)), {}
+
+    benchmark.pedantic(server.on_stats, setup=setup, rounds=20)
+
+
+def test_add_device(benchmark, dqn_agent):
+    macs = new_macs()
+
+    def setup():
+        return (next(macs),), {}
+
+    benchmark.pedantic(dqn_agent.add_device, setup=setup, rounds=10)
+
+
+def test_train(benchmark, dqn_agent):
+    store = dqn_agent.state_store
+    dqn_agent.add_device(MAC)
+    temperatures = itertools.cycle([20.0, 21.5, 19.0, 24.0, 22.0])
+
+    def observe(step):
+        store.observe(MAC, next(temperatures))
+
+    dqn_agent.train(MAC, before_step=observe)
+    benchmark(dqn_agent.train, MAC, before_step=observe)
+
+
+def test_convert_to_tflite(benchmark, dqn_agent):
+    dqn_agent.add_device(MAC)
+    dqn_agent.state_store.observe(MAC, 20.0)
+    dqn_agent.train(MAC)
+
+    benchmark(dqn_agent.convert_to_tflite, MAC)
+
+
+@pytest.fixture
+def model_server(workdir):
+    server = hades.Hades(hades.HadesConfig("hades.conf"))
+    server.client = NullClient()
+    with open(os.path.join("models", MAC), "wb") as f:
+        f.write(MODEL)
+    return server
+
+
+@pytest.mark.parametrize("version", [None, model_digest(MODEL)],
+                         ids=["send", "not-modified"])
+def test_on_request(benchmark, model_server, version):
+    payload = json.dumps({"version": version}) if version else b""
+    message = Message(f"hades/global/{MAC}/model/request", payload)
+
+    benchmark(model_server.on_request, None, None, message)
+
+
+def test_send_interval(benchmark, model_server):
+    model_server.state_store.observe(MAC, 20.0)
+
+    benchmark(model_server.send_interval, "global", MAC)
@@ -0,0 +1,75 @@
+"""Benchmarks of the JSON and the binary wire format, with pytest-benchmark.
+The size of every message on the wire is stored as the extra info of its
+benchmark, next to the decode cost.
+
+    pytest benchmarks/bench_wire_format.py --benchmark-group-by=param:readings
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import wire_format  # noqa: E402
+
+MAC = "AA:BB:CC:DD:EE:FF"
+TIMESTAMP = 1700000000
+
+
+def make_readings(count):
+    return [(20.0 + 0.25 * i, TIMESTAMP + 60 * i) for i in range(count)]
+
+
+def encode_json_statistics(readings):
+    if len(readings) == 1:
+        return json.dumps({"temperature": readings[0][0],
+                           "timestamp": readings[0][1]}).encode()
+    return json.dumps({"readings": [
+        {"temperature": temperature, "timestamp": timestamp}
+        for temperature, timestamp in readings]}).encode()
+
+
+def decode_json_statistics(payload):
+    data = json.loads(payload)
+    if "readings" in data:
+        return [(r["temperature"], r["timestamp"]) for r in data["readings"]]
+    return [(data["temperature"], data.get("timestamp"))]
+
+
+STATISTICS = {
+    "json": (encode_json_statistics, decode_json_statistics),
+    "binary": (wire_format.encode_statistics, wire_format.decode_statistics),
+}
+
+INTERVALS = {
+    "json": (lambda interval: json.dumps({"mac": MAC,
+                                          "send_interval": interval}).encode(),
+             lambda payload: json.loads(payload)["send_interval"]),
+    "binary": (wire_format.encode_interval, wire_format.decode_interval),
+}
+
+
+@pytest.mark.parametrize("readings", [1, 16, 64])
+@pytest.mark.parametrize("wire", ["json", "binary"])
+def test_decode_statistics(benchmark, wire, readings):
+    encode, decode = STATISTICS[wire]
+    payload = encode(make_readings(readings))
+    benchmark.extra_info["bytes"] = len(payload)
+
+    decoded = benchmark(decode, payload)
+    assert len(decoded) == readings
+
+
+@pytest.mark.parametrize("wire", ["json", "binary"])
+def test_decode_interval(benchmark, wire):
+    encode, decode = INTERVALS[wire]
+    payload = encode(12)
+    benchmark.extra_info["bytes"] = len(payload)
+
+    assert benchmark(decode, payload) == 12
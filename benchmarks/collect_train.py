@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""Measures the latency of training on a statistics message, stepping the
+Python environment against the compiled collect and train step.
+
+    python benchmarks/collect_train.py --messages 200
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from DqnAgent import DqnAgent  # noqa: E402
+from CheckpointPolicy import CheckpointPolicy  # noqa: E402
+from DeviceStateStore import DeviceStateStore  # noqa: E402
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+
+def measure(messages, warmup, **options):
+    """measure returns the latencies of training on every message, in
+    seconds, after the warm-up messages.
+    """
+    store = DeviceStateStore(None, flush_interval=0)
+    agent = DqnAgent(state_store=store,
+                     checkpoint_policy=CheckpointPolicy(every_steps=0,
+                                                        on_shutdown=False),
+                     **options)
+    agent.add_device(MAC)
+
+    latencies = []
+    temperature = 20.0
+    for i in range(warmup + messages):
+        temperature += random.uniform(-2, 2)
+
+        def observe(step, reading=temperature):
+            store.observe(MAC, reading)
+
+        started = time.perf_counter()
+        agent.train(MAC, before_step=observe)
+        if i >= warmup:
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    mean = sum(latencies) / len(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("%-10s mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms" % (
+        name, 1000 * mean, 1000 * p50, 1000 * p99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--xla", action="store_true",
+                        help="also compile the step with XLA")
+    args = parser.parse_args()
+
+    runs = [("eager", {}), ("compiled", {"compiled": True})]
+    if args.xla:
+        runs.append(("xla", {"compiled": True, "jit_compile": True}))
+
+    # the agents write their checkpoints and models to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="hades-bench-"))
+    for name, options in runs:
+        random.seed(0)
+        report(name, measure(args.messages, args.warmup, **options))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+"""Compares the per-message cost of sampling the replay buffer of a device
+with a new dataset for every message against the long-lived iterator.
+
+The buffer is the CompactReplayBuffer of DqnAgent. Every message adds a
+transition to the buffer and draws one batch, the same as DqnAgent.train
+does.
+
+    python benchmarks/sampling.py --messages 500
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tf_agents.specs import tensor_spec
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from CompactReplayBuffer import CompactReplayBuffer  # noqa: E402
+
+
+def create_buffer(max_length):
+    data_spec = (tensor_spec.TensorSpec([1], tf.float32, 'observation'),
+                 tensor_spec.BoundedTensorSpec([1], tf.int32, 0, 2, 'action'),
+                 tensor_spec.TensorSpec([], tf.float32, 'reward'))
+    return CompactReplayBuffer.from_spec(data_spec, max_length=max_length)
+
+
+def add(buffer, i):
+    buffer.add_batch((np.array([[i % 10]], dtype=np.float32),
+                      np.array([[i % 3]], dtype=np.int32),
+                      np.array([1.0], dtype=np.float32)))
+
+
+def per_message_dataset(buffer, messages, batch_size, num_steps):
+    """The sampling of DqnAgent.train before the long-lived iterator."""
+    started = time.perf_counter()
+    for i in range(messages):
+        add(buffer, i)
+        dataset = buffer.as_dataset(num_parallel_calls=2,
+                                    sample_batch_size=batch_size,
+                                    num_steps=num_steps)
+        next(iter(dataset))
+    return time.perf_counter() - started
+
+
+def long_lived_iterator(buffer, messages, batch_size, num_steps):
+    started = time.perf_counter()
+    iterator = iter(buffer.as_dataset(num_parallel_calls=2,
+                                      sample_batch_size=batch_size,
+                                      num_steps=num_steps))
+    for i in range(messages):
+        add(buffer, i)
+        next(iterator)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--num-steps", type=int, default=2)
+    parser.add_argument("--max-length", type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, run in (("per-message dataset", per_message_dataset),
+                      ("long-lived iterator", long_lived_iterator)):
+        buffer = create_buffer(args.max_length)
+        # the buffer needs num_steps transitions before it can be sampled
+        for i in range(args.num_steps):
+            add(buffer, i)
+
+        elapsed = run(buffer, args.messages, args.batch_size, args.num_steps)
+        print("%-20s %8.3f ms/message" % (
+            name, 1000 * elapsed / args.messages))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,64 @@
 #!/usr/bin/python
 
 import os
+import argparse
 import logging
 import hades_utils
+import wire_format
 import json
 import configparser
 import time
-from DqnAgent import DqnAgent
+import threading
+from AgentLoader import AgentLoader
+from ProcessDqnAgent import ProcessDqnAgent
+from DeviceStateStore import DeviceStateStore
+from CheckpointPolicy import CheckpointPolicy
+from AgentCache import AgentCache
+from TrainingScheduler import TrainingScheduler
+from ExportPipeline import ExportPipeline
+from ModelCache import ModelCache
+from Cluster import Cluster
+from Metrics import Metrics
+from IntervalCache import IntervalCache
+from Publisher import Publisher
+import sensor_kernel
+from NumpyPolicy import NumpyPolicy, PolicyBatch
+from NumpyPolicy import SUFFIX as NUMPY_SUFFIX
 
 try:
     import paho.mqtt.client as mqtt
 except ImportError:
     print("failed to import paho.mqtt.client")
 
+# the time the process started, the cold start is reported from it.
+STARTED = time.monotonic()
+
 
 def start():
     logging.basicConfig(level=logging.DEBUG)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="handle MQTT messages on an asyncio event loop")
+    parser.add_argument("--worker-id", dest="worker_id",
+                        help="run as this worker of a Hades cluster")
+    args, _ = parser.parse_known_args()
+
     # parse the hades config
     config = HadesConfig("hades.conf")
     config.parseConfig()
 
+    # several workers are usually started from the same config file
+    if args.worker_id:
+        config.cluster["enabled"] = True
+        config.cluster["worker_id"] = args.worker_id
+
     # start the client program with parsed config
-    client = Hades(config)
+    if args.use_async:
+        from hades_async import AsyncHades
+        client = AsyncHades(config)
+    else:
+        client = Hades(config)
     client.main()
 
     return 0
@@ -35,6 +71,18 @@ class HadesConfig:
         self.config = config
         self.parser = configparser.ConfigParser()
         self.mqtt = {}
+        self.training = {}
+        self.state = {}
+        self.checkpoint = {}
+        self.cache = {}
+        self.export = {}
+        self.models = {}
+        self.replay = {}
+        self.cluster = {}
+        self.metrics = {}
+        self.intervals = {}
+        self.publish = {}
+        self.wire = {}
 
         # Logging
         # self.log_level = logging.DEBUG
@@ -44,6 +92,77 @@ class HadesConfig:
         self.mqtt["password"] = "test"
         self.mqtt["server"] = "172.18.0.3"
         self.mqtt["port"] = 1883
+        self.mqtt["handler_workers"] = 4
+        self.mqtt["max_inflight"] = 20
+        self.mqtt["max_queued"] = 0
+
+        # Publish config
+        self.publish["queued"] = False
+        self.publish["batch_size"] = 64
+        self.publish["queue_size"] = 10000
+        self.publish["rates"] = {"interval": 0.0, "model": 0.0,
+                                 "event": 0.0, "pong": 0.0}
+        self.publish["qos"] = {"interval": 0, "model": 0, "event": 0,
+                               "pong": 0}
+
+        # State config
+        self.state["flush_interval"] = 1.0
+
+        # Checkpoint config
+        self.checkpoint["every_steps"] = 1
+        self.checkpoint["every_seconds"] = 0.0
+        self.checkpoint["on_shutdown"] = True
+
+        # Agent cache config
+        self.cache["max_devices"] = 0
+        self.cache["max_memory_mb"] = 0
+
+        # Export config
+        self.export["workers"] = 1
+
+        # Model cache config
+        self.models["cache_mb"] = 64
+        self.models["mmap_threshold_kb"] = 0
+        self.models["max_mapped"] = 256
+
+        # Replay buffer config
+        self.replay["max_length"] = 100000
+        self.replay["initial_length"] = 64
+        self.replay["half_precision"] = False
+        self.replay["hot_devices"] = 0
+        self.replay["spill_dir"] = "replay"
+        self.replay["spill_interval"] = 10.0
+
+        # Training config
+        self.training["workers"] = 1
+        self.training["queue_depth"] = 16
+        self.training["coalesce_window"] = 0.0
+        self.training["fleet_mode"] = False
+        self.training["processes"] = 0
+        self.training["sample_batch_size"] = 2
+        self.training["num_steps"] = 2
+        self.training["gradient_steps"] = 1
+        self.training["compiled"] = False
+        self.training["xla"] = False
+        self.training["warm_up"] = True
+
+        # Cluster config
+        self.cluster["enabled"] = False
+        self.cluster["worker_id"] = "hades"
+        self.cluster["virtual_nodes"] = 64
+        self.cluster["settle_seconds"] = 2.0
+
+        # Metrics config
+        self.metrics["enabled"] = False
+        self.metrics["host"] = "127.0.0.1"
+        self.metrics["port"] = 9108
+
+        # Intervals config
+        self.intervals["greedy"] = False
+        self.intervals["push_interval"] = 0.0
+
+        # Wire format config
+        self.wire["binary"] = False
 
     def parseConfig(self):
         if self.parser is not None:
@@ -58,10 +177,183 @@ class HadesConfig:
             self.mqtt["server"] = self.parser.get("MQTT", "Server")
             self.mqtt["port"] = self.parser.getint("MQTT", "Port")
             self.mqtt["clientid"] = self.parser.get("MQTT", "ClientID")
+            self.mqtt["handler_workers"] = self.parser.getint(
+                "MQTT", "HandlerWorkers",
+                fallback=self.mqtt["handler_workers"])
+            self.mqtt["max_inflight"] = self.parser.getint(
+                "MQTT", "MaxInflight", fallback=self.mqtt["max_inflight"])
+            self.mqtt["max_queued"] = self.parser.getint(
+                "MQTT", "MaxQueued", fallback=self.mqtt["max_queued"])
+
+        if self.parser.has_section("PUBLISH"):
+            self.publish["queued"] = self.parser.getboolean(
+                "PUBLISH", "Queued", fallback=self.publish["queued"])
+            self.publish["batch_size"] = self.parser.getint(
+                "PUBLISH", "BatchSize", fallback=self.publish["batch_size"])
+            self.publish["queue_size"] = self.parser.getint(
+                "PUBLISH", "QueueSize", fallback=self.publish["queue_size"])
+            for name in self.publish["rates"]:
+                self.publish["rates"][name] = self.parser.getfloat(
+                    "PUBLISH", name.capitalize() + "Rate",
+                    fallback=self.publish["rates"][name])
+            for name in self.publish["qos"]:
+                self.publish["qos"][name] = self.parser.getint(
+                    "PUBLISH", name.capitalize() + "QoS",
+                    fallback=self.publish["qos"][name])
+
+        if self.parser.has_section("STATE"):
+            self.state["flush_interval"] = self.parser.getfloat(
+                "STATE", "FlushInterval",
+                fallback=self.state["flush_interval"])
+
+        if self.parser.has_section("CHECKPOINT"):
+            self.checkpoint["every_steps"] = self.parser.getint(
+                "CHECKPOINT", "EverySteps",
+                fallback=self.checkpoint["every_steps"])
+            self.checkpoint["every_seconds"] = self.parser.getfloat(
+                "CHECKPOINT", "EverySeconds",
+                fallback=self.checkpoint["every_seconds"])
+            self.checkpoint["on_shutdown"] = self.parser.getboolean(
+                "CHECKPOINT", "OnShutdown",
+                fallback=self.checkpoint["on_shutdown"])
+
+        if self.parser.has_section("CACHE"):
+            self.cache["max_devices"] = self.parser.getint(
+                "CACHE", "MaxDevices", fallback=self.cache["max_devices"])
+            self.cache["max_memory_mb"] = self.parser.getint(
+                "CACHE", "MaxMemoryMB", fallback=self.cache["max_memory_mb"])
+
+        if self.parser.has_section("EXPORT"):
+            self.export["workers"] = self.parser.getint(
+                "EXPORT", "Workers", fallback=self.export["workers"])
+
+        if self.parser.has_section("MODELS"):
+            self.models["cache_mb"] = self.parser.getint(
+                "MODELS", "CacheMB", fallback=self.models["cache_mb"])
+            self.models["mmap_threshold_kb"] = self.parser.getint(
+                "MODELS", "MmapThresholdKB",
+                fallback=self.models["mmap_threshold_kb"])
+            self.models["max_mapped"] = self.parser.getint(
+                "MODELS", "MaxMapped", fallback=self.models["max_mapped"])
+
+        if self.parser.has_section("REPLAY"):
+            self.replay["max_length"] = self.parser.getint(
+                "REPLAY", "MaxLength", fallback=self.replay["max_length"])
+            self.replay["initial_length"] = self.parser.getint(
+                "REPLAY", "InitialLength",
+                fallback=self.replay["initial_length"])
+            self.replay["half_precision"] = self.parser.getboolean(
+                "REPLAY", "HalfPrecision",
+                fallback=self.replay["half_precision"])
+            self.replay["hot_devices"] = self.parser.getint(
+                "REPLAY", "HotDevices", fallback=self.replay["hot_devices"])
+            self.replay["spill_dir"] = self.parser.get(
+                "REPLAY", "SpillDir", fallback=self.replay["spill_dir"])
+            self.replay["spill_interval"] = self.parser.getfloat(
+                "REPLAY", "SpillInterval",
+                fallback=self.replay["spill_interval"])
+
+        if self.parser.has_section("TRAINING"):
+            self.training["workers"] = self.parser.getint(
+                "TRAINING", "Workers", fallback=self.training["workers"])
+            self.training["queue_depth"] = self.parser.getint(
+                "TRAINING", "QueueDepth",
+                fallback=self.training["queue_depth"])
+            self.training["coalesce_window"] = self.parser.getfloat(
+                "TRAINING", "CoalesceWindow",
+                fallback=self.training["coalesce_window"])
+            self.training["fleet_mode"] = self.parser.getboolean(
+                "TRAINING", "FleetMode",
+                fallback=self.training["fleet_mode"])
+            self.training["processes"] = self.parser.getint(
+                "TRAINING", "Processes",
+                fallback=self.training["processes"])
+            self.training["sample_batch_size"] = self.parser.getint(
+                "TRAINING", "SampleBatchSize",
+                fallback=self.training["sample_batch_size"])
+            self.training["num_steps"] = self.parser.getint(
+                "TRAINING", "NumSteps",
+                fallback=self.training["num_steps"])
+            self.training["gradient_steps"] = self.parser.getint(
+                "TRAINING", "GradientSteps",
+                fallback=self.training["gradient_steps"])
+            self.training["compiled"] = self.parser.getboolean(
+                "TRAINING", "Compiled", fallback=self.training["compiled"])
+            self.training["xla"] = self.parser.getboolean(
+                "TRAINING", "XLA", fallback=self.training["xla"])
+            self.training["warm_up"] = self.parser.getboolean(
+                "TRAINING", "WarmUp", fallback=self.training["warm_up"])
+
+        if self.parser.has_section("CLUSTER"):
+            self.cluster["enabled"] = self.parser.getboolean(
+                "CLUSTER", "Enabled", fallback=self.cluster["enabled"])
+            self.cluster["worker_id"] = self.parser.get(
+                "CLUSTER", "WorkerID", fallback=self.cluster["worker_id"])
+            self.cluster["virtual_nodes"] = self.parser.getint(
+                "CLUSTER", "VirtualNodes",
+                fallback=self.cluster["virtual_nodes"])
+            self.cluster["settle_seconds"] = self.parser.getfloat(
+                "CLUSTER", "SettleSeconds",
+                fallback=self.cluster["settle_seconds"])
+
+        if self.parser.has_section("METRICS"):
+            self.metrics["enabled"] = self.parser.getboolean(
+                "METRICS", "Enabled", fallback=self.metrics["enabled"])
+            self.metrics["host"] = self.parser.get(
+                "METRICS", "Host", fallback=self.metrics["host"])
+            self.metrics["port"] = self.parser.getint(
+                "METRICS", "Port", fallback=self.metrics["port"])
+
+        if self.parser.has_section("INTERVALS"):
+            self.intervals["greedy"] = self.parser.getboolean(
+                "INTERVALS", "Greedy", fallback=self.intervals["greedy"])
+            self.intervals["push_interval"] = self.parser.getfloat(
+                "INTERVALS", "PushInterval",
+                fallback=self.intervals["push_interval"])
+
+        if self.parser.has_section("WIRE"):
+            self.wire["binary"] = self.parser.getboolean(
+                "WIRE", "Binary", fallback=self.wire["binary"])
 
     def getMqttConfig(self):
         return self.mqtt
 
+    def getStateConfig(self):
+        return self.state
+
+    def getCheckpointConfig(self):
+        return self.checkpoint
+
+    def getCacheConfig(self):
+        return self.cache
+
+    def getExportConfig(self):
+        return self.export
+
+    def getModelsConfig(self):
+        return self.models
+
+    def getReplayConfig(self):
+        return self.replay
+
+    def getTrainingConfig(self):
+        return self.training
+
+    def getClusterConfig(self):
+        return self.cluster
+
+    def getMetricsConfig(self):
+        return self.metrics
+
+    def getIntervalsConfig(self):
+        return self.intervals
+
+    def getPublishConfig(self):
+        return self.publish
+
+    def getWireConfig(self):
+        return self.wire
+
 
 # Hades is a main class for MQTT message handling as well as calling
 # the model generator.
@@ -72,7 +364,164 @@ class Hades:
         self.models_dir = "models"
         self.hermesPrefix = "hermes"
         self.states_dir = "states"
-        self.dqn_agent = DqnAgent()
+
+        # timings of the stages, message counters and queue depths - when
+        # disabled the instrumentation does next to nothing.
+        self.metrics = Metrics(enabled=config.metrics["enabled"])
+
+        # in cluster mode the devices are split between several workers
+        # sharing the state, checkpoint and model directories.
+        self.cluster = None
+        if config.cluster["enabled"]:
+            self.cluster = Cluster(
+                config.cluster["worker_id"],
+                vnodes=config.cluster["virtual_nodes"],
+                settle_seconds=config.cluster["settle_seconds"])
+            if config.training["fleet_mode"]:
+                logging.warning("fleet mode is not sharded, every worker "
+                                "trains its own fleet network")
+
+        if config.training["fleet_mode"] and \
+                config.training["num_steps"] != 2:
+            logging.warning("fleet mode trains on single transitions, "
+                            "NumSteps is ignored")
+
+        # device states are kept in memory and written out in the background,
+        # the states of the previous run are picked up on startup. A cluster
+        # worker only reads the states of the devices it owns, when needed.
+        self.state_store = DeviceStateStore(
+            self.states_dir, flush_interval=config.state["flush_interval"])
+        if self.cluster is None:
+            self.state_store.load()
+
+        # the agent imports TensorFlow and tf_agents, it is loaded in the
+        # background so that pings and the cached models and intervals are
+        # served while it loads.
+        self.dqn_agent = AgentLoader(
+            self._create_agent, model_dir=self.models_dir,
+            shared_key="fleet" if config.training["fleet_mode"] else None)
+        self.first_pong_seconds = None
+
+        # training is done on a pool of workers so that the MQTT network
+        # thread would only have to parse and enqueue the statistics.
+        self.scheduler = TrainingScheduler(
+            self._train_device,
+            workers=config.training["workers"],
+            queue_depth=config.training["queue_depth"],
+            window=config.training["coalesce_window"])
+
+        # models are exported separately from training, only when the policy
+        # has changed meaningfully or a model is requested.
+        self.exporter = ExportPipeline(self._export_model,
+                                       workers=config.export["workers"])
+
+        # the served models are kept in memory, filled by the export stage.
+        self.model_cache = ModelCache(
+            max_bytes=config.models["cache_mb"] * 1024 * 1024,
+            mmap_threshold=config.models["mmap_threshold_kb"] * 1024,
+            max_mapped=config.models["max_mapped"])
+
+        # the greedy policies of the exported models evaluated with NumPy,
+        # by the export key - the send intervals are decided without
+        # TensorFlow.
+        self.policies = {}
+        self._policies_lock = threading.Lock()
+
+        # the replies to the devices are published through the publisher,
+        # with the QoS of their topic class, queued and rate limited when
+        # enabled.
+        self.publisher = Publisher(
+            lambda *message: self.client.publish(*message),
+            batch_size=config.publish["batch_size"],
+            queue_size=config.publish["queue_size"],
+            rates=config.publish["rates"], qos=config.publish["qos"],
+            metrics=self.metrics)
+
+        # the serialized interval replies, dropped when training changes the
+        # send interval of a device.
+        self.interval_cache = IntervalCache(self.hermesPrefix)
+        self._pusher = None
+
+        # the devices speaking the binary wire format, by the suffix of the
+        # topics they last published on.
+        self.binary_devices = set()
+
+        # the checkpoints of the devices which weren't trained again are
+        # written by a periodic sweep, within the EverySeconds bound.
+        self._sweeper = None
+        self._stopped = threading.Event()
+
+        self.metrics.gauge("training_queue_depth", self.scheduler.pending)
+        self.metrics.gauge("export_queue_depth", self.exporter.pending)
+        self.metrics.gauge("active_devices",
+                           lambda: len(self.dqn_agent.devices))
+        self.metrics.gauge("known_devices",
+                           lambda: len(self.state_store.keys()))
+        self.metrics.gauge("training", lambda: self.scheduler.stats,
+                           label="event")
+        self.metrics.gauge("export", lambda: self.exporter.stats,
+                           label="event")
+        self.metrics.gauge("model_cache", lambda: self.model_cache.stats,
+                           label="event")
+        self.metrics.gauge("model_cache_bytes", self.model_cache.memory)
+        self.metrics.gauge("interval_cache",
+                           lambda: self.interval_cache.stats, label="event")
+        self.metrics.gauge("publish_queue_depth", self.publisher.pending)
+        self.metrics.gauge("publisher", lambda: self.publisher.stats,
+                           label="event")
+        self.metrics.gauge("agent_cache", lambda: self.dqn_agent.cache_stats(),
+                           label="event")
+        self.metrics.gauge("replay_bytes", self.replay_bytes,
+                           label="medium")
+        self.metrics.gauge("agent_load_seconds",
+                           lambda: self.dqn_agent.load_seconds or 0.0)
+        self.metrics.gauge("first_pong_seconds",
+                           lambda: self.first_pong_seconds or 0.0)
+
+    def _create_agent(self):
+        """_create_agent is called by the agent loader, it imports the agent
+        and creates it as configured.
+        """
+        config = self.config
+        checkpoint_policy = CheckpointPolicy(
+            every_steps=config.checkpoint["every_steps"],
+            every_seconds=config.checkpoint["every_seconds"],
+            on_shutdown=config.checkpoint["on_shutdown"])
+
+        # in fleet mode every device is trained by one shared network.
+        if config.training["fleet_mode"]:
+            from FleetDqnAgent import FleetDqnAgent
+            return FleetDqnAgent(
+                state_store=self.state_store,
+                checkpoint_policy=checkpoint_policy,
+                sample_batch_size=config.training["sample_batch_size"])
+
+        # the agents are split between training processes, which apply
+        # their own checkpoint policy and agent cache.
+        if config.training["processes"] > 0:
+            return ProcessDqnAgent(
+                processes=config.training["processes"],
+                state_store=self.state_store,
+                settings={"checkpoint": dict(config.checkpoint),
+                          "cache": dict(config.cache),
+                          "replay": dict(config.replay),
+                          "training": dict(config.training)})
+
+        from DqnAgent import DqnAgent
+        agent_cache = AgentCache(
+            max_entries=config.cache["max_devices"],
+            max_bytes=config.cache["max_memory_mb"] * 1024 * 1024)
+        return DqnAgent(
+            state_store=self.state_store,
+            checkpoint_policy=checkpoint_policy,
+            agent_cache=agent_cache,
+            sample_batch_size=config.training["sample_batch_size"],
+            num_steps=config.training["num_steps"],
+            train_steps=config.training["gradient_steps"],
+            replay_config=config.replay,
+            compiled=config.training["compiled"],
+            jit_compile=config.training["xla"],
+            metrics=self.metrics)
 
     """on_connect will be called when the MQTT client connects to the MQTT
     broker.
@@ -85,16 +534,39 @@ class Hades:
         self.client.subscribe("hades/+/+/model/+", 0)
         self.client.subscribe("hades/+/+/interval/+", 0)
 
-    """subscribe will subscribe all required topics with their respective
-    handlers for MQTT.
+        # announce this worker to the others - the announcement is cleared by
+        # the last will when the worker goes away. The members are gathered
+        # again from the retained announcements on every connect.
+        if self.cluster is not None:
+            self.cluster.join()
+            self.client.subscribe(self.cluster.members_topic(), 0)
+            self.client.publish(self.cluster.member_topic(),
+                                json.dumps({"time": time.time()}), 1,
+                                retain=True)
+
+    """topics returns the topics handled by Hades with their respective
+    handlers, counted and timed if the metrics are enabled.
     """
-    def subscribe(self):
+    def topics(self):
         topics = {
             "hades/+/+/statistics": self.on_stats,
             "hades/+/+/ping": self.on_ping,
             "hades/+/+/model/request": self.on_request,
             "hades/+/+/interval/request": self.on_request_send_interval,
         }
+        if self.config.wire["binary"]:
+            topics.update({topic + wire_format.SUFFIX: handler
+                           for topic, handler in list(topics.items())})
+        if self.cluster is not None:
+            topics[self.cluster.members_topic()] = self.on_member
+        return {topic: self.metrics.handler(handler.__name__, handler)
+                for topic, handler in topics.items()}
+
+    """subscribe will subscribe all required topics with their respective
+    handlers for MQTT.
+    """
+    def subscribe(self):
+        topics = self.topics()
 
         # subscribe to the given topic list
         for topic in topics:
@@ -110,70 +582,163 @@ class Hades:
     def on_message(self, client, userdata, msg):
         print(msg.topic)
 
+    def replay_bytes(self):
+        """replay_bytes returns the bytes of the replay buffers in memory and
+        spilled to disk.
+        """
+        stats = self.dqn_agent.replay_stats()
+        return {medium: stats[medium] for medium in ("memory", "disk")
+                if medium in stats}
+
+    def owns(self, mac):
+        """owns returns True if the device is handled by this worker."""
+        return self.cluster is None or self.cluster.owns(mac)
+
+    def negotiate(self, mac, topic):
+        """negotiate records the wire format of the device from the topic of
+        its message and returns True if it is the binary one.
+        """
+        if wire_format.is_binary(topic):
+            self.binary_devices.add(mac)
+            return True
+        self.binary_devices.discard(mac)
+        return False
+
+    """on_member will handle the announcements of the cluster workers. When
+    a worker joins or leaves, the devices which are now owned by another
+    worker are released.
+
+    endpoint: hades/cluster/+
+    """
+    def on_member(self, client, userdata, msg):
+        if self.cluster.on_member(msg.topic, msg.payload):
+            # checkpoints are written on release, so it isn't done on the
+            # network thread.
+            threading.Thread(target=self.rebalance,
+                             name="hades-rebalance", daemon=True).start()
+
+    def rebalance(self):
+        """rebalance will release the devices which are no longer owned by
+        this worker. Their queued statistics are dropped and the training in
+        progress is waited for, then their states and checkpoints are written
+        out, so the new owner picks them up when the members have settled.
+        """
+        macs = set(self.state_store.keys()) | set(self.dqn_agent.devices)
+        released = 0
+        for mac in macs:
+            if self.cluster.owner(mac) == self.cluster.worker_id:
+                continue
+            self.scheduler.discard(mac)
+            self.dqn_agent.release(mac)
+            self.state_store.release(mac)
+            self.interval_cache.discard(mac)
+            self.binary_devices.discard(mac)
+
+            # the new owner exports the next models of the device, they are
+            # read again if the device comes back.
+            self.model_cache.invalidate(self.dqn_agent.model_path(mac))
+            with self._policies_lock:
+                self.policies.pop(self.dqn_agent.export_key(mac), None)
+            released += 1
+
+        logging.info("released %d devices, members: %s", released,
+                     self.cluster.members())
+
     """on_stats will handle the received messages of a devices statistics,
-    when data is received, it will send this data for analyze.
+    when data is received, it will send this data for analyze. A message may
+    carry several timestamped readings buffered by the device, they are
+    trained on together in the order they were read.
 
-    endpoint: hades/+/+/statistics
+    endpoint: hades/+/+/statistics[/bin]
     """
     def on_stats(self, client, userdata, msg):
-        data = {}
-        first = False
-
         _, net, mac, _ = hades_utils.split_segments4(msg.topic)
         if not hades_utils.verify_mac(mac):
             logging.info("MAC address (%s) is invalid!", mac)
             return
+        elif not self.owns(mac):
+            return
         else:
             logging.info("Received statistics for %s", mac)
 
-        # parse the currently read temperature
-        payload = json.loads(msg.payload)
-        if payload['temperature'] is None:
+        # parse the read temperatures
+        with self.metrics.span("parse"):
+            try:
+                if self.negotiate(mac, msg.topic):
+                    readings = wire_format.decode_statistics(msg.payload)
+                else:
+                    readings = hades_utils.parse_readings(msg.payload)
+            except (ValueError, TypeError) as e:
+                # json.JSONDecodeError is a ValueError as well
+                logging.error("Malformed statistics for %s: %s", mac, e)
+                return
+        if not readings:
             logging.error("There is no Temperature entry for %s", mac)
             return
+        temperatures = tuple(t for t, _ in hades_utils.in_order(readings))
 
-        state_file = os.path.join(self.states_dir, mac)
-        if os.path.exists(state_file):
-            # first read what values exist already - we don't want to lose them
-            with open(state_file, 'r') as json_file:
-                data = json.load(json_file)
-                prev_delta = hades_utils.num(data['stats']['prev_delta'])
-                prev_temp = hades_utils.num(data['stats']['prev_temperature'])
-                send_interval = hades_utils.num(data['stats']['send_interval'])
-        else:
-            # its the first statistic from the device -
-            # default values, roll out!
-            prev_temp = payload['temperature']
-            prev_delta = 0
-            send_interval = 1
-
-        data['stats'] = {
-                'prev_temperature': prev_temp,
-                'prev_delta': prev_delta,
-                'curr_temperature': payload['temperature'],
-                'send_interval': send_interval,
-        }
+        # the readings are applied to the device state and trained on by a
+        # training worker - statistics of a burst are trained on together.
+        self.dqn_agent.start()
+        with self.metrics.span("enqueue"):
+            submitted = self.scheduler.submit(mac, (net, temperatures))
+        if not submitted:
+            self.metrics.count("dropped_total", len(temperatures))
+            logging.warning("training queue for %s is full, dropping", mac)
+
+        return
+
+    def _train_device(self, mac, items):
+        """_train_device is executed by a training worker and will do the
+        actual training for the device. All of the readings of the coalesced
+        statistics are collected as transitions in order and a single
+        training step is run.
+        """
+        first = False
+        net = items[-1][0]
+        temperatures = [temperature for _, readings in items
+                        for temperature in readings]
 
-        with open(state_file, 'w') as outfile:
-            json.dump(data, outfile)
+        # the device was handed over to another worker while queued.
+        if not self.owns(mac):
+            return
 
-        # at this point we should have dumped the received statistics to the
-        # state file - we can start the training.
+        with self.metrics.span("state"):
+            self.state_store.ensure(mac)
+        before = self.state_store.get(mac)
         if self.dqn_agent.device_exists(mac) is not True:
             first = True
-            self.dqn_agent.add_device(mac)
+            with self.metrics.span("add_device"):
+                self.dqn_agent.add_device(mac)
+
+        def observe(i):
+            self.state_store.observe(mac, temperatures[i])
+
+        with self.metrics.span("train"):
+            changed = self.dqn_agent.train(mac, steps=len(temperatures),
+                                           before_step=observe)
+        self.metrics.count("readings_trained_total", len(temperatures))
+        if changed:
+            self.exporter.request(self.dqn_agent.export_key(mac))
 
-        self.dqn_agent.train(mac)
+        # the greedy decision depends on the current delta as well.
+        after = self.state_store.get(mac)
+        if self.config.intervals["greedy"] or before is None or \
+                after.send_interval != before.send_interval:
+            self.interval_cache.invalidate(mac, net)
+
+        logging.debug("trained %s on %d readings (coalescing ratio %.2f)",
+                      mac, len(temperatures),
+                      self.scheduler.coalescing_ratio())
 
         # if it was a first request - send a new interval
         if first is True:
             self.send_interval(net, mac)
 
-        return
-
     """on_request will handle a request for a new model. A server may ask for
     a new model via this handler and the handler should respond with a new
-    model.
+    model. The request may carry the version of the model the node has, in
+    which case the model is only sent if it has changed.
 
     endpoint: /hades/+/+/model/request
     """
@@ -183,33 +748,132 @@ class Hades:
         if not hades_utils.verify_mac(mac):
             logging.info("MAC address (%s) is invalid!", mac)
             return
+        if not self.owns(mac):
+            return
+
+        current = hades_utils.parse_version(msg.payload)
+
+        # the policy was trained since the last export - export it first and
+        # send the model once it is done. If the export fails, the model of
+        # the previous export is sent, if there is one.
+        if self.dqn_agent.needs_export(mac):
+            self.exporter.request(
+                self.dqn_agent.export_key(mac),
+                lambda key, version: self.send_model(net, mac, current))
+            return
 
+        self.send_model(net, mac, current)
+        return
+
+    def _export_model(self, key):
+        """_export_model is executed by an export worker, it exports the model
+        and puts the new model into the model cache.
+        """
+        with self.metrics.span("export"):
+            version = self.dqn_agent.export(key)
+        if version is not None:
+            self.model_cache.load(self.dqn_agent.model_path(key), version)
+            with self._policies_lock:
+                self.policies.pop(key, None)
+
+            # the greedy decisions of the devices of the model have changed
+            if self.config.intervals["greedy"]:
+                if key == "fleet":
+                    self.interval_cache.clear()
+                else:
+                    self.interval_cache.invalidate(key)
+        return version
+
+    def _policy(self, mac):
+        """_policy returns the greedy policy of the exported model of the
+        device, read when first needed, or None if it has no model yet.
+        """
+        key = self.dqn_agent.export_key(mac)
+        with self._policies_lock:
+            if key in self.policies:
+                return self.policies[key]
+
+        policy = NumpyPolicy.load(self.dqn_agent.model_path(mac) +
+                                  NUMPY_SUFFIX)
+        with self._policies_lock:
+            # don't keep a missing policy, the model may be exported later
+            if policy is not None:
+                self.policies[key] = policy
+        return policy
+
+    def greedy_intervals(self, macs):
+        """greedy_intervals decides the next send interval of every device by
+        the greedy action of its exported model on its current temperature
+        delta, the same decision a device running the model makes. The
+        policies of all of the devices are evaluated in one batch.
+
+        Returns:
+            A dict of the send intervals by MAC address, of the devices with a
+            state and an exported model.
+        """
+        states, policies = [], []
+        for mac in macs:
+            state = self.state_store.get(mac)
+            policy = self._policy(mac) if state is not None else None
+            if policy is not None:
+                states.append((mac, state))
+                policies.append(policy)
+        if not states:
+            return {}
+
+        deltas = [state.prev_delta for _, state in states]
+        if all(policy is policies[0] for policy in policies):
+            actions = policies[0].actions(deltas)
+        else:
+            actions = PolicyBatch(policies).actions(deltas)
+
+        return {mac: sensor_kernel.calculate_read_time(
+                    int(action), state.send_interval)
+                for (mac, state), action in zip(states, actions)}
+
+    def send_model(self, net, mac, current=None):
+        """send_model will send the model of the device, unless the version
+        the node already has is the current one - then only a "not modified"
+        event is sent.
+        """
         # does a model for this device exist?
-        if hades_utils.check_model(self.models_dir, mac):
-            modelMac = os.path.join(self.models_dir, mac)
+        modelMac = self.dqn_agent.model_path(mac)
+        blob = self.model_cache.get(modelMac)
+        if blob is not None:
+            topicEvent = f"node/{net}/{mac}/hades/event/sent"
+            timeSent = time.localtime()
+
+            if current == blob.digest:
+                notModified = json.dumps({
+                    "model": modelMac,
+                    "time_sent": time.strftime("%H:%M:%S", timeSent),
+                    "version": blob.digest,
+                    "not_modified": True,
+                })
+
+                logging.debug("publishing on %s", topicEvent)
+                self.publisher.publish(topicEvent, notModified)
+                return
 
             # prepare data
-            f = open(modelMac, 'rb')
-            byteArray = bytes(f.read())
-            f.close()
+            byteArray = blob.payload()
 
-            timeSent = time.localtime()
             currentTime = json.dumps({
                 "model": modelMac,
-                "time_sent": time.strftime("%H:%M:%S", timeSent)
+                "time_sent": time.strftime("%H:%M:%S", timeSent),
+                "version": blob.digest,
             })
 
             # construct publish topics for hermes and iotctl.
             topic = f"{self.hermesPrefix}/node/{net}/{mac}/hades/model/receive"
-            topicEvent = f"node/{net}/{mac}/hades/event/sent"
 
             logging.debug("publishing on %s", topic)
-            self.client.publish(topic, byteArray, 0)
+            self.publisher.publish(topic, byteArray)
 
             # Notify IoT Controller about a sent model
             # TODO: implement an Event infrastructure.
             logging.debug("publishing on %s", topicEvent)
-            self.client.publish(topicEvent, currentTime, 0)
+            self.publisher.publish(topicEvent, currentTime)
         else:
             logging.info("no model for node (%s)", mac)
         return
@@ -219,54 +883,113 @@ class Hades:
         a new model via this handler and the handler should respond with a new
         model.
 
-        endpoint: /hades/+/+/interval/request
+        endpoint: /hades/+/+/interval/request[/bin]
         """
         _, net, mac, _ = hades_utils.split_segments4(msg.topic)
 
         if not hades_utils.verify_mac(mac):
             logging.info("MAC address (%s) is invalid!", mac)
             return
+        if not self.owns(mac):
+            return
 
+        self.negotiate(mac, msg.topic)
         self.send_interval(net, mac)
         return
 
     def send_interval(self, net, mac):
-        hermesPrefix = self.hermesPrefix
+        """send_interval will send the send interval of the device, from the
+        cache of the replies if it hasn't changed since the last request.
+        """
+        reply = self.interval_cache.get(mac, net)
+        if reply is None:
+            reply = self._interval_reply(net, mac)
+        if reply is None:
+            logging.info("no send interval for node (%s)", mac)
+            return
 
-        # does a state for this device exist?
-        if hades_utils.check_model(self.states_dir, mac):
-            state_file = os.path.join(self.states_dir, mac)
+        self._publish_interval(mac, reply)
+        return
 
-            with open(state_file, 'r') as json_file:
-                data = json.load(json_file)
-                send_interval = hades_utils.num(data['stats']['send_interval'])
+    def _interval_reply(self, net, mac, send_interval=None):
+        """_interval_reply builds the interval reply of the device and puts
+        it into the cache, returns None if the device has no state.
+        """
+        generation = self.interval_cache.generation(mac)
 
-            timeSent = time.localtime()
-            currentTime = json.dumps({
-                "model": mac,
-                "time_sent": time.strftime("%H:%M:%S", timeSent),
-                "send_interval": send_interval,
-                })
+        # does a state for this device exist?
+        self.state_store.ensure(mac)
+        state = self.state_store.get(mac)
+        if state is None:
+            return None
 
-            interval_msg = json.dumps({
-                "mac": mac,
-                "send_interval": send_interval,
-                })
+        if send_interval is None:
+            send_interval = state.send_interval
 
-            # construct publish topics for hermes and iotctl.
-            topic = f"{hermesPrefix}/node/{net}/{mac}/hades/interval/receive"
-            topicEvent = f"node/{net}/{mac}/hades/event/sent"
+            # answer with the decision of the exported model, if any.
+            if self.config.intervals["greedy"]:
+                send_interval = self.greedy_intervals([mac]).get(
+                    mac, send_interval)
 
-            logging.debug("publishing on %s", topic)
-            self.client.publish(topic, interval_msg, 0)
+        return self.interval_cache.put(mac, net, send_interval, generation)
 
-            # Notify IoT Controller about a sent model
-            # TODO: implement an Event infrastructure.
-            logging.debug("publishing on %s", topicEvent)
-            self.client.publish(topicEvent, currentTime, 0)
-        else:
-            logging.info("no send interval for node (%s)", mac)
-        return
+    def _publish_interval(self, mac, reply):
+        topic, payload = reply.message(mac in self.binary_devices)
+        logging.debug("publishing on %s", topic)
+        self.publisher.publish(topic, payload)
+        self.interval_cache.sent(mac, reply.send_interval)
+
+        # Notify IoT Controller about a sent model
+        # TODO: implement an Event infrastructure.
+        timeSent = time.strftime("%H:%M:%S", time.localtime())
+        logging.debug("publishing on %s", reply.event_topic)
+        self.publisher.publish(reply.event_topic, reply.event(timeSent))
+
+    def push_intervals(self):
+        """push_intervals will send the send interval to every device whose
+        interval has changed since it was last sent, in one pass. The greedy
+        decisions of all of the devices are made in one batch.
+
+        Returns:
+            The number of devices the interval was sent to.
+        """
+        stale = self.interval_cache.stale()
+        if not stale:
+            return 0
+
+        greedy = {}
+        if self.config.intervals["greedy"]:
+            greedy = self.greedy_intervals(list(stale))
+
+        pushed = 0
+        for mac, net in stale.items():
+            if not self.owns(mac):
+                continue
+            reply = self._interval_reply(net, mac, greedy.get(mac))
+            if reply is None or \
+                    reply.send_interval == self.interval_cache.last_sent(mac):
+                continue
+
+            self._publish_interval(mac, reply)
+            pushed += 1
+
+        logging.debug("pushed the send intervals of %d of %d devices",
+                      pushed, len(stale))
+        return pushed
+
+    def _push_loop(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.push_intervals()
+            except Exception:
+                logging.exception("failed to push the send intervals")
+
+    def _checkpoint_loop(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.dqn_agent.save_overdue()
+            except Exception:
+                logging.exception("failed to save the overdue checkpoints")
 
     """on_ping will handle a request for a ping checking. A device may ask for
     a ping check and we should respond to it.
@@ -277,18 +1000,24 @@ class Hades:
         if not hades_utils.verify_mac(mac):
             logging.info("MAC address (%s) is invalid!", mac)
             return
+        if not self.owns(mac):
+            return
 
         topic = f"{self.hermesPrefix}/node/{net}/{mac}/hades/pong"
         logging.debug("publishing on %s", topic)
-        self.client.publish(topic, None, 0)
+        self.publisher.publish(topic, None)
+
+        if self.first_pong_seconds is None:
+            self.first_pong_seconds = time.monotonic() - STARTED
+            logging.info("answered the first ping %.2fs after start "
+                         "(agent loaded: %s)", self.first_pong_seconds,
+                         self.dqn_agent.loaded)
 
     def on_log(self, client, level, buf):
         logging.debug(buf)
 
-    """main shall be the entry point for this function and will setup required
-    connections for MQTT broker and other required services.
-    """
-    def main(self):
+    """create_client will create the MQTT client and attach the handlers."""
+    def create_client(self):
         mqttConfig = self.config.mqtt
 
         # TODO: make distinct init functions for different services.
@@ -296,8 +1025,18 @@ class Hades:
         self.t = time.time()
         self.state = 0
 
-        self.client = mqtt.Client(client_id=mqttConfig["clientid"])
+        # every worker of a cluster needs its own client ID.
+        clientid = mqttConfig["clientid"]
+        if self.cluster is not None:
+            clientid = "%s-%s" % (clientid, self.cluster.worker_id)
+
+        self.client = mqtt.Client(client_id=clientid)
+        if self.cluster is not None:
+            self.client.will_set(self.cluster.member_topic(), None, 1,
+                                 retain=True)
         self.client.on_log = self.on_log
+        self.client.max_inflight_messages_set(mqttConfig["max_inflight"])
+        self.client.max_queued_messages_set(mqttConfig["max_queued"])
         # self.client.enable_logger(logger=logging)
 
         self.subscribe()
@@ -307,6 +1046,10 @@ class Hades:
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
 
+    """connect will connect the MQTT client to the broker."""
+    def connect(self):
+        mqttConfig = self.config.mqtt
+
         logging.info("mqtt client connecting to %s:%d", mqttConfig["server"],
                      mqttConfig["port"])
 
@@ -314,11 +1057,83 @@ class Hades:
         self.client.username_pw_set(mqttConfig["user"], mqttConfig["password"])
         self.client.connect(mqttConfig["server"], int(mqttConfig["port"]))
 
+    """start_services will start the background services - state flushing,
+    training, export, publishing and the metrics endpoint.
+    """
+    def start_services(self):
+        self._stopped.clear()
+        self.state_store.start()
+        self.scheduler.start()
+        self.exporter.start()
+
+        # load the agent now rather than on the first statistics.
+        if self.config.training["warm_up"]:
+            self.dqn_agent.start()
+
+        if self.config.publish["queued"]:
+            self.publisher.start()
+
+        push_interval = self.config.intervals["push_interval"]
+        if push_interval > 0:
+            self._pusher = threading.Thread(
+                target=self._push_loop, args=(push_interval,),
+                name="hades-interval-push", daemon=True)
+            self._pusher.start()
+
+        every_seconds = self.config.checkpoint["every_seconds"]
+        if every_seconds > 0:
+            self._sweeper = threading.Thread(
+                target=self._checkpoint_loop,
+                args=(min(CheckpointPolicy.sweep_interval, every_seconds),),
+                name="hades-checkpoint-sweep", daemon=True)
+            self._sweeper.start()
+
+        metricsConfig = self.config.metrics
+        if metricsConfig["enabled"]:
+            self.metrics.start(metricsConfig["host"], metricsConfig["port"])
+
+    """stop_services will stop the background services and write out what is
+    left of the training and device states.
+    """
+    def stop_services(self):
+        # leave the cluster, the other workers take over the devices.
+        if self.cluster is not None:
+            self.client.publish(self.cluster.member_topic(), None, 1,
+                                retain=True)
+
+        self._stopped.set()
+        if self._pusher is not None:
+            self._pusher.join()
+            self._pusher = None
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+        # publish what is queued while the client is still connected.
+        self.publisher.stop()
+        self.scheduler.stop(wait=False)
+        self.exporter.stop(wait=False)
+        self.dqn_agent.close()
+        self.state_store.close()
+        self.metrics.stop()
+
+    """main shall be the entry point for this function and will setup required
+    connections for MQTT broker and other required services.
+    """
+    def main(self):
+        self.create_client()
+        self.connect()
+
         if self.client is None:
             return
 
-        while True:
-            self.client.loop_forever()
+        self.start_services()
+
+        try:
+            while True:
+                self.client.loop_forever()
+        finally:
+            self.stop_services()
         return
 
 
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hades import Hades
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    print("failed to import paho.mqtt.client")
+
+
+class AsyncioHelper:
+    """AsyncioHelper drives the network loop of a paho MQTT client from an
+    asyncio event loop instead of loop_forever. Reads and writes happen when
+    the socket is ready, so publishes made while handling a batch of messages
+    are written out together.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = \
+            self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sock,
+                                       client.loop_read)
+        self.loop.call_soon_threadsafe(self._start_misc)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_reader, sock)
+        if self.misc is not None:
+            self.loop.call_soon_threadsafe(self.misc.cancel)
+
+    # publishing is done from the training and export workers as well, so the
+    # socket is (un)registered through the loop.
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock,
+                                       client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    def _start_misc(self):
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncHades(Hades):
+    """AsyncHades is Hades with the MQTT front end running on an asyncio
+    event loop. The topic handlers are the same as in the synchronous mode,
+    every message is handled by its own coroutine. Handlers which may block
+    on disk I/O run in an executor, while training and export already run on
+    their own worker pools.
+    """
+
+    # handlers which may block and are run in the executor
+    blocking_handlers = ("on_request",)
+
+    def __init__(self, config):
+        super(AsyncHades, self).__init__(config)
+        self.loop = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.mqtt["handler_workers"],
+            thread_name_prefix="hades-handler")
+        self._reconnect = None
+
+    def subscribe(self):
+        topics = self.topics()
+
+        # subscribe to the given topic list
+        for topic, handler in topics.items():
+            self.client.message_callback_add(topic, self.dispatcher(handler))
+            logging.info("subscribed to " + topic)
+
+    def dispatcher(self, handler):
+        """dispatcher wraps a handler into a paho callback which schedules
+        the handling of the message as a coroutine on the event loop.
+        """
+        blocking = handler.__name__ in self.blocking_handlers
+
+        def dispatch(client, userdata, msg):
+            self.loop.create_task(
+                self.handle(handler, blocking, client, userdata, msg))
+
+        return dispatch
+
+    async def handle(self, handler, blocking, client, userdata, msg):
+        try:
+            if blocking:
+                await self.loop.run_in_executor(self.executor, handler,
+                                                client, userdata, msg)
+            else:
+                handler(client, userdata, msg)
+        except Exception:
+            logging.exception("failed to handle %s", msg.topic)
+
+    def on_disconnect(self, client, userdata, rc):
+        super(AsyncHades, self).on_disconnect(client, userdata, rc)
+        if self._reconnect is not None:
+            self.loop.call_soon_threadsafe(self._reconnect.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._reconnect = asyncio.Event()
+
+        self.create_client()
+        AsyncioHelper(self.loop, self.client)
+        self.connect()
+
+        self.start_services()
+
+        try:
+            while True:
+                await self._reconnect.wait()
+                self._reconnect.clear()
+
+                logging.info("mqtt client disconnected, reconnecting")
+                await asyncio.sleep(1)
+                try:
+                    self.client.reconnect()
+                except OSError:
+                    logging.exception("failed to reconnect")
+                    self._reconnect.set()
+        finally:
+            self.stop_services()
+            self.executor.shutdown(wait=False)
+
+    """main shall be the entry point for the asyncio mode."""
+    def main(self):
+        asyncio.run(self.run())
@@ -1,4 +1,6 @@
 import re
+import json
+import math
 from os import path
 
 
@@ -37,3 +39,90 @@ def num(string):
         return int(string)
 
     return 0
+
+
+def parse_version(payload):
+    """parse_version will return the model version carried in a request
+    payload or None if the payload doesn't carry one.
+    """
+    if not payload:
+        return None
+
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+
+    if isinstance(data, dict) and isinstance(data.get("version"), str):
+        return data["version"]
+    return None
+
+
+def is_number(value):
+    """is_number returns True if the value is a finite int or float, booleans
+    are not numbers.
+    """
+    return isinstance(value, (int, float)) and not isinstance(value, bool) \
+        and math.isfinite(value)
+
+
+def parse_readings(payload):
+    """parse_readings will return the readings carried in a statistics
+    payload as a list of (temperature, timestamp) tuples, the timestamp is None
+    if the reading doesn't carry one. A payload carries either a single reading
+    or a list of them under 'readings'. Readings without a temperature are
+    skipped. Raises ValueError if the payload is malformed.
+    """
+    data = json.loads(payload)
+    if isinstance(data, dict) and "readings" in data:
+        data = data["readings"]
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return []
+
+    readings = []
+    for reading in data:
+        if not isinstance(reading, dict):
+            raise ValueError("reading is not an object: %r" % (reading,))
+
+        temperature = reading.get("temperature")
+        if temperature is None:
+            continue
+        timestamp = reading.get("timestamp")
+        if not is_number(temperature):
+            raise ValueError("temperature is not a number: %r" %
+                             (temperature,))
+        if timestamp is not None and not is_number(timestamp):
+            raise ValueError("timestamp is not a number: %r" % (timestamp,))
+        readings.append((temperature, timestamp))
+    return readings
+
+
+def in_order(readings):
+    """in_order will return the readings in the order they were read. They
+    are sorted by their timestamps if all of them carry a numeric one,
+    otherwise the order they were sent in is kept.
+    """
+    if all(is_number(timestamp) for _, timestamp in readings):
+        return sorted(readings, key=lambda reading: reading[1])
+    return list(readings)
+
+
+def topic_matches(sub, topic):
+    """topic_matches will check whether the topic matches the given MQTT
+    subscription filter with '+' and '#' wildcards and return True if it
+    does.
+    """
+    sub_levels = sub.split("/")
+    topic_levels = topic.split("/")
+
+    for i, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+
+    return len(sub_levels) == len(topic_levels)
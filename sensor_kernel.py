@@ -0,0 +1,165 @@
+import numpy as np
+
+# the default boundary of the temperature delta
+DELTA = 3
+
+REWARD_WITHIN_BOUNDS = np.asarray(1., dtype=np.float32)
+REWARD_DO_NOTHING = np.asarray(0., dtype=np.float32)
+REWARD_OUT_OF_BOUNDS = np.asarray(-2., dtype=np.float32)
+
+REWARD_CORRECT_ACTION = np.asarray(1., dtype=np.float32)
+REWARD_INCORRECT_ACTION = np.asarray(-2., dtype=np.float32)
+
+REWARD_WITHIN_BOUNDS.setflags(write=False)
+REWARD_OUT_OF_BOUNDS.setflags(write=False)
+REWARD_DO_NOTHING.setflags(write=False)
+
+REWARD_INCORRECT_ACTION.setflags(write=False)
+REWARD_CORRECT_ACTION.setflags(write=False)
+
+
+def check_delta_within_bounds(current_delta, delta=DELTA):
+    """check_delta_within_bounds checks if the temperature delta is within the
+    given delta.
+
+    Returns:
+        A tuple of (need_adjust, reward) where need_adjust means whether the
+        send interval should be changed and reward is the reward for the
+        temperature delta: 1 = within bounds, 0 = just good, -2 = out of
+        bounds.
+    """
+    current_delta = abs(current_delta)
+
+    # XXX: the 'just in case' values (0.7; 0.5) should be made more logical
+    # and derived from something.
+    if current_delta >= delta:
+        # temperature delta is out of safe bounds - decrease send interval.
+        return True, REWARD_OUT_OF_BOUNDS
+    elif current_delta + 0.7 >= delta:
+        # we are in a comfortable position and can leave it at that.
+        return False, REWARD_DO_NOTHING
+    elif current_delta < (delta - 0.5):
+        # we can further increase the send interval, while still being within
+        # the delta bounds minus the accuracy penalty.
+        return True, REWARD_WITHIN_BOUNDS
+
+    return False, REWARD_DO_NOTHING
+
+
+def calculate_read_time(action, send_interval):
+    """calculate_read_time adjusts the send interval according to the action
+    selected by the policy: 1 decreases it by a minute, 2 increases it.
+    """
+    if action == 1 and send_interval > 1:
+        send_interval -= 1
+
+    if action == 2:
+        send_interval += 1
+
+    return send_interval
+
+
+def check_calculated(current_delta, delta, new_interval, reward,
+                     old_interval):
+    """check_calculated checks whether the adjustment of the send interval
+    was logical and returns the adjusted reward and send interval.
+    """
+    # if we got a negative reward and action was 1 - we reward.
+    if new_interval < old_interval and reward < 0:
+        return REWARD_CORRECT_ACTION, new_interval
+
+    # if we got a positive reward and needed to adjust, but haven't increased
+    # the send interval - punish.
+    if reward > 0 and new_interval <= old_interval:
+        return REWARD_INCORRECT_ACTION, new_interval
+
+    # if we increased the send interval but the delta was too big - punish
+    # and decrease the send interval.
+    if new_interval > old_interval and delta < current_delta:
+        if old_interval > 1:
+            return REWARD_INCORRECT_ACTION, old_interval - 1
+        else:
+            return REWARD_INCORRECT_ACTION, old_interval
+
+    # if we decremented and the delta was too big - reward!
+    if new_interval < old_interval and delta < current_delta:
+        return REWARD_CORRECT_ACTION, new_interval
+
+    # if we can increase but haven't - negative reward.
+    if current_delta < (delta - 0.5) and new_interval == old_interval:
+        return REWARD_INCORRECT_ACTION, new_interval + 1
+
+    return reward, new_interval
+
+
+def step(prev_temperature, curr_temperature, send_interval, action,
+         delta=DELTA):
+    """step is a single step of the environment of a device.
+
+    Returns:
+        A tuple of (temperature delta, reward, send interval) after the step,
+        the previous temperature becomes the current one.
+    """
+    if prev_temperature == -999:
+        prev_temperature = curr_temperature
+    current_delta = abs(prev_temperature - curr_temperature)
+
+    adjust, reward = check_delta_within_bounds(current_delta, delta)
+    if adjust:
+        new_interval = calculate_read_time(action, send_interval)
+        reward, send_interval = check_calculated(
+            current_delta, delta, new_interval, reward, send_interval)
+
+    return current_delta, reward, send_interval
+
+
+def sensor_step(prev_temperatures, curr_temperatures, send_intervals,
+                actions, delta=DELTA):
+    """sensor_step is the step of the environments of many devices at once,
+    given as arrays with a value for every device. The result is equal to
+    calling step for every device.
+
+    Returns:
+        A tuple of float64 temperature deltas, float32 rewards and float64
+        send intervals.
+    """
+    prev = np.asarray(prev_temperatures, dtype=np.float64)
+    curr = np.asarray(curr_temperatures, dtype=np.float64)
+    old = np.asarray(send_intervals, dtype=np.float64)
+    actions = np.asarray(actions).reshape(old.shape)
+
+    prev = np.where(prev == -999, curr, prev)
+    current_delta = np.abs(prev - curr)
+
+    # check_delta_within_bounds
+    out_of_bounds = current_delta >= delta
+    within_bounds = ~(current_delta + 0.7 >= delta) & \
+        (current_delta < (delta - 0.5))
+    adjust = out_of_bounds | within_bounds
+    reward = np.where(out_of_bounds, REWARD_OUT_OF_BOUNDS,
+                      np.where(within_bounds, REWARD_WITHIN_BOUNDS,
+                               REWARD_DO_NOTHING))
+
+    # calculate_read_time
+    new = np.where((actions == 1) & (old > 1), old - 1, old)
+    new = np.where(actions == 2, new + 1, new)
+
+    # check_calculated, the first matching condition takes precedence so
+    # they are applied from the last one.
+    checks = [
+        ((new < old) & (reward < 0), REWARD_CORRECT_ACTION, new),
+        ((reward > 0) & (new <= old), REWARD_INCORRECT_ACTION, new),
+        ((new > old) & (delta < current_delta), REWARD_INCORRECT_ACTION,
+         np.where(old > 1, old - 1, old)),
+        ((new < old) & (delta < current_delta), REWARD_CORRECT_ACTION, new),
+        ((current_delta < (delta - 0.5)) & (new == old),
+         REWARD_INCORRECT_ACTION, new + 1),
+    ]
+    checked_reward, checked_interval = reward, new
+    for condition, value, interval in reversed(checks):
+        checked_reward = np.where(condition, value, checked_reward)
+        checked_interval = np.where(condition, interval, checked_interval)
+
+    reward = np.where(adjust, checked_reward, reward).astype(np.float32)
+    send_interval = np.where(adjust, checked_interval, old)
+    return current_delta, reward, send_interval
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+"""Replays temperature traces of simulated devices through Hades without a
+broker and reports the throughput, the latency and the send intervals.
+
+    python simulate.py --devices 50 --minutes 1440
+    python simulate.py --trace readings.csv --agent kernel --json report.json
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict, deque, namedtuple
+
+import hades
+import sensor_kernel
+from AgentLoader import AgentLoader
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+def synthetic_traces(devices, minutes, seed=0):
+    """synthetic_traces generates a random walk of the temperature of every
+    device, some of the devices are steady and some change quickly.
+
+    Returns:
+        A dict of the temperature of every device for every minute.
+    """
+    rng = random.Random(seed)
+    traces = {}
+    for i in range(devices):
+        mac = "02:00:00:%02X:%02X:%02X" % (i >> 16 & 0xff, i >> 8 & 0xff,
+                                          i & 0xff)
+        temperature = rng.uniform(15, 30)
+        volatility = rng.choice([0.3, 0.6, 1.0, 2.0])
+
+        trace = traces[mac] = []
+        for _ in range(minutes):
+            temperature += rng.gauss(0, volatility)
+            trace.append(round(temperature, 2))
+    return traces
+
+
+def read_traces(path):
+    """read_traces reads a recorded trace, a CSV file with a MAC address and
+    a temperature on every line - a reading of every device for every minute
+    in the order they were recorded.
+    """
+    traces = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(",")]
+            if len(fields) < 2 or fields[0].startswith("#"):
+                continue
+            try:
+                temperature = float(fields[1])
+            except ValueError:
+                # the header line
+                continue
+            traces[fields[0]].append(temperature)
+    return dict(traces)
+
+
+def percentile(values, q):
+    """percentile returns the q-th percentile of sorted values, by the
+    nearest rank.
+    """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[rank]
+
+
+class FakeClient:
+    """FakeClient is an in-process stand-in for the MQTT client, it counts
+    the published messages and keeps the send intervals sent to the devices.
+    """
+
+    def __init__(self):
+        self.published = defaultdict(int)
+        self.intervals = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        segments = topic.split("/")
+        with self._lock:
+            self.published["/".join(segments[-2:])] += 1
+            if topic.endswith("/hades/interval/receive"):
+                message = json.loads(payload)
+                self.intervals[message["mac"]].append(
+                    message["send_interval"])
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class KernelAgent:
+    """KernelAgent steps the devices with sensor_kernel and picks the action
+    by a fixed rule instead of a policy network. It is used to measure the
+    message handling of Hades alone and does not need TensorFlow.
+    """
+
+    def __init__(self, state_store, delta=sensor_kernel.DELTA):
+        self._state_store = state_store
+        self._delta = delta
+        self._devices = set()
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    def device_exists(self, mac):
+        return mac in self._devices
+
+    def add_device(self, mac):
+        self._devices.add(mac)
+
+    def release(self, mac):
+        self._devices.discard(mac)
+
+    def action(self, current_delta):
+        """action decreases the send interval when the delta is out of
+        bounds and increases it when there is room left.
+        """
+        if current_delta >= self._delta:
+            return 1
+        if current_delta < self._delta - 0.5:
+            return 2
+        return 0
+
+    def train(self, mac, steps=1, before_step=None):
+        for i in range(steps):
+            if before_step is not None:
+                before_step(i)
+
+            state = self._state_store.get(mac)
+            current_delta = abs(state.prev_temperature -
+                                state.curr_temperature)
+            current_delta, _, send_interval = sensor_kernel.step(
+                state.prev_temperature, state.curr_temperature,
+                state.send_interval, self.action(current_delta),
+                self._delta)
+            self._state_store.update(
+                mac, prev_temperature=state.curr_temperature,
+                prev_delta=current_delta, send_interval=send_interval)
+        return False
+
+    def export_key(self, mac):
+        return mac
+
+    def needs_export(self, mac):
+        return False
+
+    def export(self, key):
+        return None
+
+    def model_path(self, mac):
+        return os.path.join("models", mac)
+
+    def save_checkpoint(self, mac):
+        pass
+
+    def save_overdue(self):
+        pass
+
+    def cache_stats(self):
+        return {}
+
+    def replay_stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class Simulation(hades.Hades):
+    """Simulation is Hades fed directly with the statistics of simulated
+    devices. Every reading is timed from its arrival in on_stats until it
+    has been trained on.
+    """
+
+    def __init__(self, config, agent=None):
+        super(Simulation, self).__init__(config)
+        self.client = FakeClient()
+        if agent is not None:
+            self.dqn_agent = AgentLoader(lambda: agent(self.state_store))
+
+        self.latencies = []
+        self.readings = defaultdict(int)
+        self._arrivals = defaultdict(deque)
+        self._lock = threading.Lock()
+        # notified when the readings of a device have been trained on.
+        self._trained = threading.Condition(self._lock)
+
+    def on_stats(self, client, userdata, msg):
+        _, _, mac, _ = msg.topic.split("/")
+        submitted = self.scheduler.stats["submitted"]
+        with self._lock:
+            self._arrivals[mac].append(time.perf_counter())
+
+        super(Simulation, self).on_stats(client, userdata, msg)
+
+        # the reading was dropped or ignored
+        if self.scheduler.stats["submitted"] == submitted:
+            with self._lock:
+                self._arrivals[mac].pop()
+
+    def _train_device(self, mac, items):
+        trained = False
+        try:
+            super(Simulation, self)._train_device(mac, items)
+            trained = True
+        finally:
+            # the device sends its next reading even if training failed, the
+            # failure is counted by the scheduler.
+            done = time.perf_counter()
+            with self._lock:
+                arrivals = self._arrivals[mac]
+                for _ in items:
+                    arrived = arrivals.popleft()
+                    if trained:
+                        self.latencies.append(done - arrived)
+                self._trained.notify_all()
+
+    def run(self, traces, net="global", request_every=1):
+        """run replays the traces on a simulated clock as fast as the devices
+        are trained on. Like a real device, a simulated one sends its next
+        reading once the previous one was trained on, asking for its send
+        interval every request_every readings and reading its temperature
+        again after the interval it was sent last.
+
+        Returns:
+            The report of the run, see report.
+        """
+        minutes = max(len(trace) for trace in traces.values())
+        devices = [(0, mac) for mac in sorted(traces)]
+        heapq.heapify(devices)
+
+        self.start_services()
+        started = time.perf_counter()
+        try:
+            while devices:
+                minute, mac = heapq.heappop(devices)
+                trace = traces[mac]
+                if minute >= len(trace):
+                    continue
+
+                with self._trained:
+                    while self._arrivals[mac]:
+                        self._trained.wait()
+
+                readings = self.readings[mac]
+                if readings and request_every and \
+                        readings % request_every == 0:
+                    self.on_request_send_interval(None, None, Message(
+                        f"hades/{net}/{mac}/interval/request", b""))
+
+                payload = json.dumps({"temperature": trace[minute]})
+                self.on_stats(None, None, Message(
+                    f"hades/{net}/{mac}/statistics", payload))
+                self.readings[mac] += 1
+
+                intervals = self.client.intervals.get(mac)
+                interval = int(intervals[-1]) if intervals else 1
+                heapq.heappush(devices, (minute + max(1, interval), mac))
+
+            self.scheduler.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            self.stop_services()
+
+        return self.report(elapsed, minutes)
+
+    def report(self, elapsed, minutes):
+        """report summarizes the run.
+
+        Returns:
+            A dict with the number of trained readings, the throughput in
+            readings per second, how many times faster than real time the
+            simulated minutes were replayed, the latency percentiles in
+            milliseconds and the convergence of the send interval of every
+            device: its final value, how many times it changed and after how
+            many interval replies it stopped changing and its range over
+            the last quarter of the replies.
+        """
+        latencies = sorted(self.latencies)
+        devices = {}
+        for mac, readings in sorted(self.readings.items()):
+            intervals = self.client.intervals.get(mac) or [1]
+            changes = [i for i in range(1, len(intervals))
+                       if intervals[i] != intervals[i - 1]]
+            last = intervals[len(intervals) * 3 // 4:]
+            devices[mac] = {
+                "readings": readings,
+                "final_interval": intervals[-1],
+                "changes": len(changes),
+                "settled_at": changes[-1] if changes else 0,
+                "last_quarter": [min(last), max(last)],
+            }
+
+        # a device has settled if its interval stayed within a factor of two
+        # over the last quarter of the replies it got.
+        settled = [device for device in devices.values()
+                   if device["last_quarter"][1] <=
+                   2 * device["last_quarter"][0]]
+
+        return {
+            "readings": len(latencies),
+            "devices": len(devices),
+            "minutes": minutes,
+            "elapsed": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "speedup": 60 * minutes / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": 1000 * percentile(latencies, 50),
+                "p90": 1000 * percentile(latencies, 90),
+                "p99": 1000 * percentile(latencies, 99),
+                "max": 1000 * percentile(latencies, 100),
+            },
+            "coalescing_ratio": self.scheduler.coalescing_ratio(),
+            "dropped": self.scheduler.stats["rejected"],
+            "failed": self.scheduler.stats["failed"],
+            "published": dict(self.client.published),
+            "settled": len(settled),
+            "per_device": devices,
+        }
+
+
+def format_report(report, show=10):
+    """format_report returns the report as text, with the convergence of at
+    most show devices.
+    """
+    latency = report["latency_ms"]
+    lines = [
+        "%d readings of %d devices over %d minutes in %.2f s" % (
+            report["readings"], report["devices"], report["minutes"],
+            report["elapsed"]),
+        "throughput %.1f readings/s, %.0fx faster than real time" % (
+            report["throughput"], report["speedup"]),
+        "latency p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms" % (
+            latency["p50"], latency["p90"], latency["p99"], latency["max"]),
+        "coalescing ratio %.2f, %d dropped, %d failed" % (
+            report["coalescing_ratio"], report["dropped"], report["failed"]),
+        "%d of %d devices settled on a send interval" % (
+            report["settled"], report["devices"]),
+        "",
+        "%-17s %8s %8s %8s %10s %12s" % (
+            "device", "readings", "interval", "changes", "settled at",
+            "last quarter"),
+    ]
+    for mac, device in list(report["per_device"].items())[:show]:
+        lines.append("%-17s %8d %8s %8d %10d %12s" % (
+            mac, device["readings"], device["final_interval"],
+            device["changes"], device["settled_at"],
+            "%s-%s" % tuple(device["last_quarter"])))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="hades.conf")
+    parser.add_argument("--trace", help="a CSV file of mac,temperature")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--minutes", type=int, default=600,
+                        help="minutes of the synthetic traces")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--agent", choices=["dqn", "kernel"], default="dqn",
+                        help="train with the configured agent or step the "
+                             "devices by a fixed rule")
+    parser.add_argument("--request-every", type=int, default=1,
+                        help="readings between interval requests")
+    parser.add_argument("--window", type=float, default=0.0,
+                        help="the coalescing window, in seconds. A device "
+                             "waits for its reading to be trained on, so a "
+                             "window only adds to the latency")
+    parser.add_argument("--show", type=int, default=10,
+                        help="devices to show in the report")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = hades.HadesConfig(args.config)
+    config.parseConfig()
+    config.cluster["enabled"] = False
+    config.training["coalesce_window"] = args.window
+
+    report_path = os.path.abspath(args.json) if args.json else None
+    if args.trace:
+        traces = read_traces(args.trace)
+    else:
+        traces = synthetic_traces(args.devices, args.minutes, args.seed)
+
+    # the states, checkpoints and models are written to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="hades-sim-"))
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.makedirs(directory, exist_ok=True)
+
+    agent = KernelAgent if args.agent == "kernel" else None
+    report = Simulation(config, agent=agent).run(
+        traces, request_every=args.request_every)
+
+    print(format_report(report, args.show))
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+from AgentCache import AgentCache
+
+
+def test_evicts_least_recently_used():
+    cache = AgentCache(max_entries=2)
+
+    assert cache.put("a", 1) == []
+    assert cache.put("b", 2) == []
+    cache.get("a")
+    assert cache.put("c", 3) == [("b", 2)]
+
+    assert cache.keys() == ["a", "c"]
+    assert cache.stats["evictions"] == 1
+
+
+def test_evicts_by_memory_budget():
+    cache = AgentCache(max_bytes=100)
+
+    cache.put("a", 1, size=60)
+    cache.put("b", 2, size=30)
+    assert cache.put("c", 3, size=50) == [("a", 1)]
+    assert cache.memory() == 80
+
+
+def test_pinned_entries_are_kept():
+    cache = AgentCache(max_entries=1)
+
+    cache.put("a", 1)
+    cache.pin("a")
+    assert cache.put("b", 2) == []
+    cache.unpin("a")
+    assert cache.put("c", 3) == [("a", 1), ("b", 2)]
+
+
+def test_hits_and_misses():
+    cache = AgentCache()
+
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    cache.record_rehydration(0.5)
+
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+    assert cache.stats["rehydrations"] == 1
+    assert cache.stats["rehydration_max_seconds"] == 0.5
+
+
+def test_resize_only_updates_the_cached_entry():
+    cache = AgentCache(max_bytes=100)
+    device = object()
+
+    cache.put("a", device, size=10)
+    cache.put("b", 2, size=10)
+    assert cache.resize("a", device, size=95) == [("b", 2)]
+    assert cache.memory() == 95
+
+    # the entry was released meanwhile, it isn't put back
+    cache.pop("a")
+    assert cache.resize("a", device, size=50) == []
+    assert "a" not in cache
+    assert cache.memory() == 0
@@ -0,0 +1,56 @@
+import os
+import threading
+import pytest
+from AgentLoader import AgentLoader
+
+
+class Agent:
+
+    devices = ["AA:BB:CC:DD:EE:FF"]
+
+    def export_key(self, mac):
+        return mac
+
+    def needs_export(self, mac):
+        return True
+
+    def model_path(self, mac):
+        return os.path.join("trained", mac)
+
+
+def test_serves_without_the_agent_while_loading():
+    release = threading.Event()
+
+    def factory():
+        release.wait()
+        return Agent()
+
+    loader = AgentLoader(factory, shared_key="fleet")
+    loader.start()
+
+    assert not loader.loaded
+    assert loader.devices == []
+    assert loader.needs_export("AA:BB:CC:DD:EE:FF") is False
+    assert loader.model_path("AA:BB:CC:DD:EE:FF") == \
+        os.path.join("models", "fleet")
+
+    release.set()
+    agent = loader.get()
+
+    assert loader.loaded
+    assert loader.load_seconds is not None
+    assert loader.devices == agent.devices
+    assert loader.needs_export("AA:BB:CC:DD:EE:FF") is True
+    assert loader.model_path("AA:BB:CC:DD:EE:FF") == \
+        os.path.join("trained", "AA:BB:CC:DD:EE:FF")
+
+
+def test_failed_load():
+    def factory():
+        raise ImportError("no tensorflow")
+
+    loader = AgentLoader(factory)
+
+    with pytest.raises(RuntimeError):
+        loader.device_exists("AA:BB:CC:DD:EE:FF")
+    loader.close()
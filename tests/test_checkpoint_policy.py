@@ -0,0 +1,45 @@
+from CheckpointPolicy import CheckpointPolicy
+
+
+def test_every_steps():
+    policy = CheckpointPolicy(every_steps=3, every_seconds=0)
+
+    assert policy.step("a", now=0) is False
+    assert policy.step("a", now=0) is False
+    assert policy.step("a", now=0) is True
+    policy.saved("a", now=0)
+    assert policy.step("a", now=0) is False
+
+
+def test_every_seconds():
+    policy = CheckpointPolicy(every_steps=0, every_seconds=10)
+
+    assert policy.step("a", now=100) is False
+    assert policy.step("a", now=105) is False
+    assert policy.step("a", now=110) is True
+    policy.saved("a", now=110)
+    assert policy.step("a", now=111) is False
+
+
+def test_unsaved():
+    policy = CheckpointPolicy(every_steps=0, every_seconds=0)
+
+    policy.step("a")
+    policy.step("b")
+    policy.saved("b")
+
+    assert policy.unsaved() == ["a"]
+
+
+def test_overdue():
+    policy = CheckpointPolicy(every_steps=0, every_seconds=10)
+
+    policy.step("a", now=100)
+    policy.step("b", now=105)
+    policy.step("c", now=100)
+    policy.saved("c", now=100)
+
+    assert policy.overdue(now=109) == []
+    assert policy.overdue(now=110) == ["a"]
+    assert sorted(policy.overdue(now=115)) == ["a", "b"]
+    assert CheckpointPolicy(every_seconds=0).overdue() == []
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import threading
+import hades
+from collections import namedtuple
+from AgentLoader import AgentLoader
+from Cluster import Cluster, HashRing
+from hades_utils import topic_matches
+from LocalBroker import (LocalBroker, CONNECT, PUBLISH, SUBSCRIBE,
+                         DISCONNECT, encode_packet, encode_string,
+                         decode_string, read_packet)
+
+MACS = ["AA:BB:CC:DD:%02X:%02X" % (i // 256, i % 256) for i in range(1000)]
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+def test_ring_moves_only_the_devices_of_a_new_member():
+    ring = HashRing(["w1", "w2", "w3"])
+    before = {mac: ring.owner(mac) for mac in MACS}
+
+    ring.add("w4")
+    moved = [mac for mac in MACS if ring.owner(mac) != before[mac]]
+
+    assert all(ring.owner(mac) == "w4" for mac in moved)
+    assert 100 < len(moved) < 400
+
+
+def test_ring_spreads_devices():
+    ring = HashRing(["w1", "w2", "w3"])
+    counts = {}
+    for mac in MACS:
+        owner = ring.owner(mac)
+        counts[owner] = counts.get(owner, 0) + 1
+
+    assert sorted(counts) == ["w1", "w2", "w3"]
+    assert min(counts.values()) > 200
+
+
+def test_workers_agree_on_owners():
+    workers = [Cluster("w%d" % i) for i in range(3)]
+    for worker in workers:
+        for other in workers:
+            worker.on_member(other.member_topic(), b'{}')
+
+    for mac in MACS[:100]:
+        owners = [worker for worker in workers if worker.owns(mac)]
+        assert len(owners) == 1
+
+    # a worker leaving hands its devices over to the others
+    assert workers[0].on_member(workers[2].member_topic(), b"")
+    assert workers[0].members() == ["w0", "w1"]
+    assert not workers[0].on_member(workers[0].member_topic(), b"")
+
+
+def test_devices_handed_over_are_owned_once_settled():
+    worker = Cluster("w1", settle_seconds=0.05)
+    worker.join()
+    worker.on_member("hades/cluster/w2", b"{}")
+
+    # nothing is owned until the announcements have settled
+    mine = [mac for mac in MACS[:100] if worker.owner(mac) == "w1"]
+    assert mine and not any(worker.owns(mac) for mac in mine)
+    time.sleep(0.05)
+    assert worker.settled()
+    assert all(worker.owns(mac) for mac in mine)
+
+    # the devices of a worker leaving wait for the settle period, the
+    # devices which were owned before don't.
+    worker.on_member("hades/cluster/w2", b"")
+    assert all(worker.owns(mac) for mac in mine)
+    assert not any(worker.owns(mac) for mac in MACS[:100]
+                   if mac not in mine)
+    time.sleep(0.05)
+    assert all(worker.owns(mac) for mac in MACS[:100])
+
+
+def connect(client_id, will=None):
+    flags = 0x02
+    payload = encode_string(client_id)
+    if will is not None:
+        flags |= 0x04 | 0x20
+        payload += encode_string(will[0]) + encode_string(will[1])
+    body = encode_string("MQTT") + bytes([4, flags]) + b"\x00\x3c" + payload
+    return encode_packet(CONNECT, 0, body)
+
+
+def subscribe(topic):
+    return encode_packet(SUBSCRIBE, 2, b"\x00\x01" + encode_string(topic) +
+                         b"\x00")
+
+
+def publish(topic, payload, retain=False):
+    return encode_packet(PUBLISH, 1 if retain else 0,
+                         encode_string(topic) + payload)
+
+
+async def receive(reader):
+    while True:
+        packet_type, _, body = await asyncio.wait_for(read_packet(reader), 1)
+        if packet_type == PUBLISH:
+            topic, offset = decode_string(body, 0)
+            return topic.decode(), body[offset:]
+
+
+def test_local_broker_retained_and_will():
+    async def run():
+        broker = LocalBroker(port=0)
+        await broker.start()
+
+        # w1 announces itself and goes away without a disconnect
+        _, w1 = await asyncio.open_connection(broker.host, broker.port)
+        w1.write(connect("w1", will=("hades/cluster/w1", b"")))
+        w1.write(publish("hades/cluster/w1", b"{}", retain=True))
+        await w1.drain()
+
+        reader, w2 = await asyncio.open_connection(broker.host, broker.port)
+        w2.write(connect("w2"))
+        w2.write(subscribe("hades/cluster/+"))
+        await w2.drain()
+
+        announced = await receive(reader)
+        w1.close()
+        left = await receive(reader)
+
+        w2.write(encode_packet(DISCONNECT, 0, b""))
+        w2.close()
+        await broker.stop()
+        return announced, left, broker._retained
+
+    announced, left, retained = asyncio.run(run())
+
+    assert announced == ("hades/cluster/w1", b"{}")
+    assert left == ("hades/cluster/w1", b"")
+    assert retained == {}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class BrokerClient:
+    """BrokerClient stands in for the MQTT client of a worker, it calls the
+    handlers of the matching topics from its reader thread.
+    """
+
+    def __init__(self, broker, client_id, will=None):
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.sock = socket.create_connection((broker.host, broker.port))
+        self.sock.sendall(connect(client_id, will))
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        with self.lock:
+            self.sock.sendall(publish(topic, payload, retain))
+
+    def subscribe(self, topic, qos=0):
+        with self.lock:
+            self.sock.sendall(subscribe(topic))
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def close(self):
+        # without a disconnect, the broker sends the last will.
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join(5)
+
+    def _read(self):
+        reader = self.sock.makefile("rb")
+        try:
+            while True:
+                header = reader.read(1)
+                if not header:
+                    return
+                length, multiplier = 0, 1
+                while True:
+                    byte = reader.read(1)[0]
+                    length += (byte & 0x7f) * multiplier
+                    if not byte & 0x80:
+                        break
+                    multiplier *= 128
+                body = reader.read(length)
+                if header[0] >> 4 != PUBLISH:
+                    continue
+
+                topic, offset = decode_string(body, 0)
+                msg = Message(topic.decode(), body[offset:])
+                for sub, callback in list(self.callbacks.items()):
+                    if topic_matches(sub, msg.topic):
+                        callback(self, None, msg)
+        except (OSError, IndexError):
+            return
+
+
+class Agent:
+
+    def __init__(self, worker_id, trained):
+        self.worker_id = worker_id
+        self.trained = trained
+        self.devices = set()
+
+    def device_exists(self, mac):
+        return mac in self.devices
+
+    def add_device(self, mac):
+        self.devices.add(mac)
+
+    def train(self, mac, steps=1, before_step=None):
+        for i in range(steps):
+            before_step(i)
+        self.trained.append((self.worker_id, mac))
+        return False
+
+    def release(self, mac):
+        self.devices.discard(mac)
+
+    def export_key(self, mac):
+        return mac
+
+    def model_path(self, mac):
+        return os.path.join("models", mac)
+
+
+def test_every_device_is_trained_by_one_worker(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints"):
+        os.mkdir(directory)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    broker = LocalBroker(port=0)
+    asyncio.run_coroutine_threadsafe(broker.start(), loop).result(5)
+
+    trained = []
+    workers = {}
+
+    def start_worker(worker_id):
+        config = hades.HadesConfig("hades.conf")
+        config.cluster["enabled"] = True
+        config.cluster["worker_id"] = worker_id
+        config.cluster["settle_seconds"] = 0.2
+        server = hades.Hades(config)
+        agent = Agent(worker_id, trained)
+        server.dqn_agent = AgentLoader(lambda: agent)
+        server.dqn_agent.get()
+        server.client = BrokerClient(broker, worker_id,
+                                     will=(server.cluster.member_topic(), b""))
+        server.subscribe()
+        server.scheduler.start()
+        server.on_connect(server.client, None, None, 0)
+        workers[worker_id] = server
+
+    def settled(members):
+        return all(server.cluster.members() == members and
+                   server.cluster.settled() for server in workers.values())
+
+    devices = BrokerClient(broker, "devices")
+    macs = MACS[:32]
+
+    def train_round():
+        del trained[:]
+        for mac in macs:
+            devices.publish(f"hades/global/{mac}/statistics",
+                            json.dumps({"temperature": 20.0}))
+        wait_until(lambda: len(trained) >= len(macs))
+        for server in workers.values():
+            server.scheduler.join()
+
+        by_worker = {}
+        for worker_id, mac in trained:
+            by_worker.setdefault(mac, []).append(worker_id)
+        return by_worker
+
+    try:
+        start_worker("w1")
+        start_worker("w2")
+        wait_until(lambda: settled(["w1", "w2"]))
+        owners = {mac: workers["w1"].cluster.owner(mac) for mac in macs}
+        assert all(train_round()[mac] == [owners[mac]] for mac in macs)
+
+        # a third worker joins, the first two hand some devices over
+        start_worker("w3")
+        wait_until(lambda: settled(["w1", "w2", "w3"]))
+        owners = {mac: workers["w1"].cluster.owner(mac) for mac in macs}
+        assert len(set(owners.values())) == 3
+        assert all(train_round()[mac] == [owners[mac]] for mac in macs)
+
+        # the devices handed over were released by their previous owners
+        for worker_id, server in workers.items():
+            wait_until(lambda: server.dqn_agent.devices == {
+                mac for mac in macs if owners[mac] == worker_id})
+    finally:
+        for server in workers.values():
+            server.client.close()
+            server.scheduler.stop(wait=False)
+        devices.close()
+        asyncio.run_coroutine_threadsafe(broker.stop(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from CompactReplayBuffer import CompactReplayBuffer, Field  # noqa: E402
+
+
+def create_buffer(**kwargs):
+    fields = [Field((1,), np.float32),
+              Field((1,), np.int32, minimum=0, maximum=2)]
+    return CompactReplayBuffer(fields, **kwargs)
+
+
+def add(buffer, values):
+    values = np.asarray(values, dtype=np.float32)
+    buffer.add_batch([values.reshape(-1, 1),
+                      (values.astype(np.int32) % 3).reshape(-1, 1)])
+
+
+def test_compact_storage():
+    buffer = create_buffer(initial_length=4)
+    assert [array.dtype for array in buffer._arrays] == [np.float32, np.int8]
+    assert buffer.memory() == 4 * 4 + 4 * 1
+
+
+def test_half_precision_storage():
+    fields = [Field((1,), np.float32, half_precision=True),
+              Field((1,), np.int32, minimum=0, maximum=2)]
+    buffer = CompactReplayBuffer(fields, initial_length=4)
+    assert [array.dtype for array in buffer._arrays] == [np.float16, np.int8]
+    assert buffer.memory() == 4 * 2 + 4 * 1
+
+
+def test_grows_geometrically_up_to_max_length():
+    buffer = create_buffer(initial_length=4, max_length=10)
+
+    add(buffer, range(5))
+    assert buffer.capacity == 8
+    add(buffer, range(5, 9))
+    assert buffer.capacity == 10
+    assert buffer.size == 9
+
+    # the oldest items are overwritten once the maximum is reached
+    add(buffer, range(9, 13))
+    assert buffer.capacity == 10
+    assert buffer.size == 10
+    values = sorted(buffer.sample(200)[0][:, 0].tolist())
+    assert values[0] == 3 and values[-1] == 12
+
+
+def test_samples_consecutive_steps():
+    buffer = create_buffer(initial_length=2, max_length=6)
+    add(buffer, range(9))
+
+    observations, actions = buffer.sample(50, num_steps=2)
+    assert observations.shape == (50, 2, 1)
+    assert observations.dtype == np.float32
+    assert actions.dtype == np.int32
+    assert np.all(observations[:, 1] - observations[:, 0] == 1)
+
+
+def test_spill_and_unspill(tmp_path):
+    buffer = create_buffer(initial_length=8)
+    add(buffer, range(6))
+    memory = buffer.memory()
+
+    buffer.spill(str(tmp_path / "device"))
+    assert buffer.spilled
+    assert buffer.memory() == 0
+    assert buffer.disk() == memory
+    add(buffer, [6])
+
+    buffer.unspill()
+    assert not buffer.spilled
+    assert buffer.memory() == memory
+    assert sorted(buffer.sample(100)[0][:, 0].tolist())[-1] == 6
+    assert list((tmp_path / "device").iterdir()) == []
+
+
+def test_save_and_restore(tmp_path):
+    buffer = create_buffer(initial_length=4, max_length=8)
+    add(buffer, range(10))
+    buffer.save(str(tmp_path / "replay.npz"))
+
+    restored = create_buffer(initial_length=4, max_length=8)
+    assert restored.restore(str(tmp_path / "replay.npz"))
+    assert restored.size == 8
+
+    observations, _ = restored.sample(100, num_steps=8)
+    assert observations[0, :, 0].tolist() == list(range(2, 10))
+    assert not restored.restore(str(tmp_path / "missing.npz"))
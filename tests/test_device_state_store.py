@@ -0,0 +1,72 @@
+import json
+import os
+from DeviceStateStore import DeviceStateStore
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+
+def test_observe_first_reading_uses_defaults(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+
+    store.observe(MAC, 21.5)
+    state = store.get(MAC)
+
+    assert state.prev_temperature == 21.5
+    assert state.curr_temperature == 21.5
+    assert state.prev_delta == 0
+    assert state.send_interval == 1
+
+    # write-behind - nothing is on disk before a flush
+    assert not os.path.exists(os.path.join(str(tmp_path), MAC))
+
+
+def test_observe_keeps_existing_values(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+
+    store.update(MAC, prev_temperature=20.0, prev_delta=0.5,
+                 curr_temperature=20.0, send_interval=4)
+    store.observe(MAC, 23.0)
+    state = store.get(MAC)
+
+    assert state.prev_temperature == 20.0
+    assert state.prev_delta == 0.5
+    assert state.curr_temperature == 23.0
+    assert state.send_interval == 4
+
+
+def test_flush_and_reload(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+    store.update(MAC, prev_temperature=25.2, prev_delta=0.5,
+                 curr_temperature=25.2, send_interval=2.0)
+    store.flush()
+
+    with open(os.path.join(str(tmp_path), MAC)) as json_file:
+        data = json.load(json_file)
+    assert data['stats']['send_interval'] == 2.0
+
+    reloaded = DeviceStateStore(str(tmp_path))
+    assert reloaded.load() == 1
+    assert reloaded.get(MAC).prev_delta == 0.5
+    assert reloaded.get("00:00:00:00:00:01") is None
+
+
+def test_write_through_without_flush_interval(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=0)
+    store.observe(MAC, 21.5)
+
+    assert os.path.exists(os.path.join(str(tmp_path), MAC))
+
+
+def test_release_and_ensure(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+    store.update(MAC, send_interval=3)
+
+    # the state is written out for the worker taking over the device
+    store.release(MAC)
+    assert not store.exists(MAC)
+    assert store.keys() == []
+
+    other = DeviceStateStore(str(tmp_path), flush_interval=10)
+    assert other.ensure(MAC)
+    assert other.get(MAC).send_interval == 3
+    assert not other.ensure("11:22:33:44:55:66")
@@ -0,0 +1,49 @@
+import threading
+from ExportPipeline import ExportPipeline
+
+
+def test_queued_requests_are_deduplicated():
+    release = threading.Event()
+    exported = []
+
+    def export(key):
+        release.wait()
+        exported.append(key)
+        return len(exported)
+
+    pipeline = ExportPipeline(export, workers=1)
+    done = []
+
+    # workers are not started yet, so every request stays queued
+    for i in range(5):
+        pipeline.request("AA:BB:CC:DD:EE:FF",
+                         lambda key, version: done.append(version))
+    pipeline.request("AA:BB:CC:DD:EE:00")
+
+    assert pipeline.pending() == 2
+    assert pipeline.stats["deduplicated"] == 4
+
+    release.set()
+    pipeline.start()
+    pipeline.join()
+    pipeline.stop()
+
+    assert exported == ["AA:BB:CC:DD:EE:FF", "AA:BB:CC:DD:EE:00"]
+    assert done == [1] * 5
+
+
+def test_failed_export_calls_callbacks_without_version():
+    def export(key):
+        raise RuntimeError("conversion failed")
+
+    pipeline = ExportPipeline(export)
+    done = []
+    pipeline.request("AA:BB:CC:DD:EE:FF",
+                     lambda key, version: done.append(version))
+
+    pipeline.start()
+    pipeline.join()
+    pipeline.stop()
+
+    assert done == [None]
+    assert pipeline.stats["failed"] == 1
@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from FleetDqnAgent import TransitionReplay  # noqa: E402
+
+
+def rows(values):
+    values = np.asarray(values, dtype=np.float32)
+    return {
+        "observation": values.reshape(-1, 1),
+        "next_observation": values.reshape(-1, 1) + 1,
+        "action": (values.astype(np.int32) % 3).reshape(-1, 1),
+        "reward": values,
+        "discount": np.ones_like(values),
+        "step_type": np.ones(len(values), dtype=np.int32),
+        "next_step_type": np.ones(len(values), dtype=np.int32),
+    }
+
+
+def test_save_and_restore(tmp_path):
+    path = str(tmp_path / "replay.npz")
+    replay = TransitionReplay(4)
+    replay.add(rows(range(6)))
+    replay.save(path)
+
+    restored = TransitionReplay(4)
+    assert restored.restore(path)
+    assert restored.size == 4
+    assert sorted(restored.reward.tolist()) == [2, 3, 4, 5]
+
+    # only the newest rows fit a smaller buffer, the oldest go first
+    smaller = TransitionReplay(2)
+    assert smaller.restore(path)
+    assert sorted(smaller.reward.tolist()) == [4, 5]
+    smaller.add(rows([6]))
+    assert sorted(smaller.reward.tolist()) == [5, 6]
+
+
+def test_restore_without_file(tmp_path):
+    assert not TransitionReplay(4).restore(str(tmp_path / "missing.npz"))
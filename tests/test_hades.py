@@ -0,0 +1,360 @@
+import json
+import os
+import sys
+import pytest
+import subprocess
+import hades
+from AgentLoader import AgentLoader
+from collections import namedtuple
+from ModelCache import model_digest
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.mkdir(directory)
+
+    server = hades.Hades(hades.HadesConfig("hades.conf"))
+    server.client = FakeClient()
+    return server
+
+
+def test_on_request_sends_model(server):
+    with open(os.path.join("models", MAC), 'wb') as f:
+        f.write(b"model")
+
+    server.on_request(None, None,
+                      Message(f"hades/global/{MAC}/model/request", b""))
+
+    topics = [topic for topic, _ in server.client.published]
+    assert topics == [f"hermes/node/global/{MAC}/hades/model/receive",
+                      f"node/global/{MAC}/hades/event/sent"]
+    assert server.client.published[0][1] == b"model"
+
+    event = json.loads(server.client.published[1][1])
+    assert event["version"] == model_digest(b"model")
+
+
+def test_on_request_not_modified(server):
+    with open(os.path.join("models", MAC), 'wb') as f:
+        f.write(b"model")
+
+    payload = json.dumps({"version": model_digest(b"model")})
+    server.on_request(None, None,
+                      Message(f"hades/global/{MAC}/model/request", payload))
+
+    assert len(server.client.published) == 1
+    topic, event = server.client.published[0]
+    assert topic == f"node/global/{MAC}/hades/event/sent"
+    assert json.loads(event)["not_modified"] is True
+
+
+def test_on_request_without_model(server):
+    server.on_request(None, None,
+                      Message(f"hades/global/{MAC}/model/request", b""))
+
+    assert server.client.published == []
+
+
+def test_async_dispatch(tmp_path, monkeypatch):
+    import asyncio
+    from hades_async import AsyncHades
+
+    monkeypatch.chdir(tmp_path)
+    server = AsyncHades(hades.HadesConfig("hades.conf"))
+    server.client = FakeClient()
+
+    async def run():
+        server.loop = asyncio.get_running_loop()
+        topics = server.topics()
+
+        ping = server.dispatcher(topics["hades/+/+/ping"])
+        request = server.dispatcher(topics["hades/+/+/model/request"])
+        ping(None, None, Message(f"hades/global/{MAC}/ping", b""))
+        request(None, None,
+                Message(f"hades/global/{MAC}/model/request", b""))
+
+        while len(asyncio.all_tasks()) > 1:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    server.executor.shutdown()
+
+    assert server.client.published == [
+        (f"hermes/node/global/{MAC}/hades/pong", None)]
+
+
+def test_cluster_ignores_devices_of_other_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = hades.HadesConfig("hades.conf")
+    config.cluster["enabled"] = True
+    config.cluster["worker_id"] = "w1"
+    server = hades.Hades(config)
+    server.client = FakeClient()
+    server.cluster.on_member("hades/cluster/w2", b"{}")
+
+    macs = ["AA:BB:CC:DD:EE:%02X" % i for i in range(16)]
+    for mac in macs:
+        server.on_ping(None, None, Message(f"hades/global/{mac}/ping", b""))
+
+    owned = [mac for mac in macs if server.cluster.owner(mac) == "w1"]
+    assert 0 < len(owned) < len(macs)
+    assert server.client.published == [
+        (f"hermes/node/global/{mac}/hades/pong", None) for mac in owned]
+
+
+def test_import_does_not_load_tensorflow():
+    modules = subprocess.check_output(
+        [sys.executable, "-c",
+         "import sys, hades; print(' '.join(sys.modules))"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    assert b"tensorflow" not in modules.split()
+    assert b"DqnAgent" not in modules.split()
+
+
+def test_first_pong_before_the_agent_is_loaded(server):
+    server.on_ping(None, None, Message(f"hades/global/{MAC}/ping", b""))
+
+    assert server.client.published == [
+        (f"hermes/node/global/{MAC}/hades/pong", None)]
+    assert server.first_pong_seconds > 0
+    assert not server.dqn_agent.loaded
+
+
+def test_greedy_interval(server):
+    np = pytest.importorskip("numpy")
+    from NumpyPolicy import NumpyPolicy
+
+    # a single layer always choosing to increase the send interval
+    NumpyPolicy(np.array([0, 0, 0, 0, 0, 1], dtype=np.float32),
+                [(1, 3)]).save(os.path.join("models", MAC + ".npz"))
+    server.state_store.update(MAC, prev_delta=1.0, send_interval=3)
+    server.config.intervals["greedy"] = True
+
+    server.on_request_send_interval(
+        None, None, Message(f"hades/global/{MAC}/interval/request", b""))
+
+    topic, payload = server.client.published[0]
+    assert topic == f"hermes/node/global/{MAC}/hades/interval/receive"
+    assert json.loads(payload)["send_interval"] == 4
+    assert server.greedy_intervals([MAC, "AA:BB:CC:DD:EE:00"]) == {MAC: 4}
+
+
+def test_interval_replies_are_cached_until_changed(server):
+    server.state_store.update(MAC, send_interval=3)
+    request = Message(f"hades/global/{MAC}/interval/request", b"")
+
+    server.on_request_send_interval(None, None, request)
+    server.on_request_send_interval(None, None, request)
+
+    assert server.interval_cache.stats["hits"] == 1
+    assert server.client.published[0] == server.client.published[2]
+    assert server.push_intervals() == 0
+
+    # training changed the interval of the device
+    server.state_store.update(MAC, send_interval=4)
+    server.interval_cache.invalidate(MAC, "global")
+    server.client.published.clear()
+
+    assert server.push_intervals() == 1
+    assert server.push_intervals() == 0
+    topic, payload = server.client.published[0]
+    assert json.loads(payload)["send_interval"] == 4
+
+
+def test_binary_wire_format(server):
+    import wire_format
+
+    submitted = []
+    server.scheduler.submit = lambda mac, item: submitted.append(item) or True
+    server.state_store.update(MAC, send_interval=3)
+
+    server.on_stats(None, None, Message(
+        f"hades/global/{MAC}/statistics/bin",
+        wire_format.encode_statistics([(20.5, 1000), (21.0, 1060)])))
+    assert submitted == [("global", (20.5, 21.0))]
+
+    server.on_request_send_interval(None, None, Message(
+        f"hades/global/{MAC}/interval/request/bin", b""))
+    topic, payload = server.client.published[0]
+    assert topic == f"hermes/node/global/{MAC}/hades/interval/receive/bin"
+    assert wire_format.decode_interval(payload) == 3
+
+    # the device went back to JSON
+    server.on_stats(None, None, Message(f"hades/global/{MAC}/statistics",
+                                        json.dumps({"temperature": 22.0})))
+    assert MAC not in server.binary_devices
+
+
+def test_statistics_with_several_readings(server):
+    trained = []
+
+    class Agent:
+        def device_exists(self, mac):
+            return True
+
+        def train(self, mac, steps=1, before_step=None):
+            for i in range(steps):
+                before_step(i)
+                trained.append(server.state_store.get(mac).curr_temperature)
+            return False
+
+    server.dqn_agent = AgentLoader(Agent)
+    server.scheduler.submit = lambda mac, item: server._train_device(
+        mac, [item]) or True
+
+    # buffered by the device, sent out of order
+    server.on_stats(None, None, Message(
+        f"hades/global/{MAC}/statistics", json.dumps({"readings": [
+            {"temperature": 21.0, "timestamp": 1060},
+            {"temperature": 20.0, "timestamp": 1000},
+            {"temperature": 22.0, "timestamp": 1120},
+        ]})))
+
+    assert trained == [20.0, 21.0, 22.0]
+
+
+def test_malformed_statistics_are_dropped(server):
+    submitted = []
+    server.dqn_agent = AgentLoader(object)
+    server.scheduler.submit = lambda mac, item: submitted.append(item) or True
+
+    for payload in (b'{"temperature": 20', b'{"temperature": "20"}',
+                    json.dumps({"readings": [{"temperature": 20.0},
+                                             {"temperature": [21.0]}]}),
+                    b'\xff\xfe', None):
+        server.on_stats(None, None,
+                        Message(f"hades/global/{MAC}/statistics", payload))
+    assert submitted == []
+
+    # readings without a timestamp keep the order they were sent in
+    server.on_stats(None, None, Message(
+        f"hades/global/{MAC}/statistics", json.dumps({"readings": [
+            {"temperature": 21.0, "timestamp": 1060},
+            {"temperature": 20.0},
+            {"temperature": 22.0, "timestamp": 1000},
+        ]})))
+    assert submitted == [("global", (21.0, 20.0, 22.0))]
+
+
+def test_idle_devices_are_checkpointed_by_the_sweep(server):
+    import threading
+
+    swept = threading.Event()
+
+    class Agent:
+        def save_overdue(self):
+            swept.set()
+
+        def close(self):
+            pass
+
+    server.dqn_agent = AgentLoader(Agent)
+    server.dqn_agent.get()
+    server.config.checkpoint["every_seconds"] = 0.05
+    server.start_services()
+    try:
+        assert swept.wait(5)
+    finally:
+        server.stop_services()
+
+
+def test_on_request_sends_cached_model_when_export_fails(server):
+    with open(os.path.join("models", MAC), 'wb') as f:
+        f.write(b"model")
+
+    class Agent:
+        def needs_export(self, mac):
+            return True
+
+        def export_key(self, mac):
+            return mac
+
+        def model_path(self, mac):
+            return os.path.join("models", mac)
+
+        def export(self, key):
+            raise RuntimeError("conversion failed")
+
+    server.dqn_agent = AgentLoader(Agent)
+    server.dqn_agent.get()
+    server.exporter.start()
+    try:
+        server.on_request(None, None,
+                          Message(f"hades/global/{MAC}/model/request", b""))
+        server.exporter.join()
+    finally:
+        server.exporter.stop()
+
+    assert server.client.published[0] == (
+        f"hermes/node/global/{MAC}/hades/model/receive", b"model")
+
+
+def test_agent_stats_gauges(server):
+    class Agent:
+        def cache_stats(self):
+            return {"hits": 3, "misses": 1}
+
+        def replay_stats(self):
+            return {"devices": {MAC: {"memory": 64}}, "memory": 64,
+                    "disk": 128}
+
+    server.dqn_agent = AgentLoader(Agent)
+    server.dqn_agent.get()
+    server.metrics.enabled = True
+
+    text = server.metrics.render()
+    assert 'hades_agent_cache{event="hits"} 3' in text
+    assert 'hades_replay_bytes{medium="disk"} 128' in text
+
+
+def test_returning_device_gets_a_fresh_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("models")
+    config = hades.HadesConfig("hades.conf")
+    config.cluster["enabled"] = True
+    config.cluster["worker_id"] = "w1"
+    server = hades.Hades(config)
+    server.client = FakeClient()
+
+    server.cluster.on_member("hades/cluster/w2", b"{}")
+    mac = next(mac for mac in ("AA:BB:CC:DD:EE:%02X" % i for i in range(64))
+               if server.cluster.owner(mac) == "w2")
+    server.cluster.on_member("hades/cluster/w2", b"")
+
+    with open(os.path.join("models", mac), 'wb') as f:
+        f.write(b"model")
+    server.state_store.observe(mac, 20.0)
+    server.policies[mac] = object()
+    server.on_request(None, None,
+                      Message(f"hades/global/{mac}/model/request", b""))
+
+    # the device moves to w2, which exports a new model, and comes back
+    server.cluster.on_member("hades/cluster/w2", b"{}")
+    server.rebalance()
+    with open(os.path.join("models", mac), 'wb') as f:
+        f.write(b"model of w2")
+    server.cluster.on_member("hades/cluster/w2", b"")
+
+    server.client.published = []
+    server.on_request(None, None,
+                      Message(f"hades/global/{mac}/model/request", b""))
+
+    assert mac not in server.policies
+    assert server.client.published[0] == (
+        f"hermes/node/global/{mac}/hades/model/receive", b"model of w2")
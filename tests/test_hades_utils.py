@@ -19,3 +19,66 @@ def test_verify_mac():
 
     for mac in table:
         assert hades_utils.verify_mac(mac) is table[mac]
+
+def test_parse_version():
+    table = {
+        b'{"version": "0123456789abcdef"}': "0123456789abcdef",
+        b'{"version": 3}': None,
+        b'{}': None,
+        b'': None,
+        None: None,
+        b'not json': None,
+    }
+
+    for payload in table:
+        assert hades_utils.parse_version(payload) == table[payload]
+
+def test_topic_matches():
+    table = {
+        ("hades/+/+/statistics", "hades/global/AA/statistics"): True,
+        ("hades/+/+/statistics", "hades/global/AA/ping"): False,
+        ("hades/+/+/+", "hades/global/AA/model/request"): False,
+        ("hades/#", "hades/global/AA/model/request"): True,
+        ("hades/cluster/+", "hades/cluster/w1"): True,
+        ("hades/cluster/+", "hades/cluster"): False,
+    }
+
+    for sub, topic in table:
+        assert hades_utils.topic_matches(sub, topic) is table[(sub, topic)]
+
+
+def test_parse_readings():
+    table = {
+        b'{"temperature": 20.5}': [(20.5, None)],
+        b'{"temperature": 20.5, "timestamp": 10}': [(20.5, 10)],
+        b'{"readings": [{"temperature": 20.5, "timestamp": 10}, '
+        b'{"timestamp": 20}, {"temperature": 21, "timestamp": 30}]}':
+            [(20.5, 10), (21, 30)],
+        b'[{"temperature": 20.5}, {"temperature": 21}]':
+            [(20.5, None), (21, None)],
+        b'{}': [],
+        b'3': [],
+    }
+
+    for payload in table:
+        assert hades_utils.parse_readings(payload) == table[payload]
+
+
+def test_parse_readings_rejects_malformed_payloads():
+    for payload in (b'{"temperature": "hot"}',
+                    b'{"temperature": true}',
+                    b'{"temperature": NaN}',
+                    b'{"temperature": 20.5, "timestamp": "noon"}',
+                    b'{"readings": [{"temperature": 20.5}, 3]}',
+                    b'{"temperature": 20.5',
+                    b'\xff'):
+        with pytest.raises(ValueError):
+            hades_utils.parse_readings(payload)
+
+
+def test_in_order():
+    assert hades_utils.in_order([(21, 30), (20, 10)]) == [(20, 10), (21, 30)]
+    assert hades_utils.in_order([(21, "30"), (20, 10)]) == [(21, "30"),
+                                                            (20, 10)]
+    assert hades_utils.in_order([(21, 30), (20, None)]) == [(21, 30),
+                                                            (20, None)]
@@ -0,0 +1,36 @@
+import json
+from IntervalCache import IntervalCache
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+
+def test_reply_payloads():
+    reply = IntervalCache().put(MAC, "global", 5)
+
+    assert reply.topic == f"hermes/node/global/{MAC}/hades/interval/receive"
+    assert reply.payload == json.dumps({"mac": MAC, "send_interval": 5})
+    assert reply.event_topic == f"node/global/{MAC}/hades/event/sent"
+    assert reply.event("12:30:00") == json.dumps({
+        "model": MAC, "time_sent": "12:30:00", "send_interval": 5})
+
+
+def test_invalidation():
+    cache = IntervalCache()
+    cache.put(MAC, "global", 5)
+
+    assert cache.get(MAC, "global").send_interval == 5
+    assert cache.get(MAC, "other") is None
+
+    generation = cache.generation(MAC)
+    cache.invalidate(MAC)
+
+    assert cache.get(MAC, "global") is None
+    assert cache.stale() == {MAC: "global"}
+    assert cache.stale() == {}
+
+    # a reply built from a state read before the invalidation isn't kept
+    cache.put(MAC, "global", 5, generation)
+    assert cache.get(MAC, "global") is None
+    cache.put(MAC, "global", 6, cache.generation(MAC))
+    assert cache.get(MAC, "global").send_interval == 6
+    assert cache.stats == {"hits": 2, "misses": 3, "invalidations": 1}
@@ -0,0 +1,76 @@
+import os
+import json
+import urllib.request
+import hades
+from collections import namedtuple
+from Metrics import Metrics, NULL_SPAN
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+def test_disabled_metrics_do_nothing():
+    metrics = Metrics()
+
+    def handler():
+        pass
+
+    assert metrics.span("train") is NULL_SPAN
+    assert metrics.handler("handler", handler) is handler
+    metrics.count("messages_total", handler="on_stats")
+    metrics.observe("stage_seconds", 0.1, stage="train")
+    assert metrics.render() == "\n"
+
+
+def test_render_text_format():
+    metrics = Metrics(enabled=True)
+    metrics.count("messages_total", handler="on_stats")
+    metrics.count("messages_total", 2, handler="on_stats")
+    metrics.observe("stage_seconds", 0.003, stage="train")
+    metrics.observe("stage_seconds", 20, stage="train")
+    metrics.gauge("queue_depth", lambda: 3)
+    metrics.gauge("training", lambda: {"runs": 1, "failed": 0},
+                  label="event")
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE hades_messages_total counter" in lines
+    assert 'hades_messages_total{handler="on_stats"} 3' in lines
+    assert "# TYPE hades_stage_seconds histogram" in lines
+    assert 'hades_stage_seconds_bucket{stage="train",le="0.0025"} 0' in lines
+    assert 'hades_stage_seconds_bucket{stage="train",le="0.005"} 1' in lines
+    assert 'hades_stage_seconds_bucket{stage="train",le="+Inf"} 2' in lines
+    assert 'hades_stage_seconds_sum{stage="train"} 20.003' in lines
+    assert 'hades_stage_seconds_count{stage="train"} 2' in lines
+    assert "hades_queue_depth 3" in lines
+    assert 'hades_training{event="failed"} 0' in lines
+
+
+def test_hades_endpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.mkdir(directory)
+
+    config = hades.HadesConfig("hades.conf")
+    config.metrics["enabled"] = True
+    server = hades.Hades(config)
+
+    on_stats = server.topics()["hades/+/+/statistics"]
+    on_stats(None, None, Message(f"hades/global/{MAC}/statistics",
+                                 json.dumps({"temperature": 20.5})))
+
+    host, port = server.metrics.start(port=0)
+    try:
+        with urllib.request.urlopen(
+                "http://%s:%d/metrics" % (host, port)) as response:
+            body = response.read().decode()
+    finally:
+        server.metrics.stop()
+
+    lines = body.splitlines()
+    assert 'hades_messages_total{handler="on_stats"} 1' in lines
+    assert 'hades_stage_seconds_count{stage="parse"} 1' in lines
+    assert 'hades_stage_seconds_count{stage="enqueue"} 1' in lines
+    assert "hades_training_queue_depth 1" in lines
+    assert "hades_active_devices 0" in lines
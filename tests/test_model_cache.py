@@ -0,0 +1,76 @@
+import os
+from ModelCache import ModelCache
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_serves_from_memory(tmp_path):
+    path = write(tmp_path / "AA:BB:CC:DD:EE:FF", b"model")
+    cache = ModelCache()
+
+    assert cache.get(path).payload() == b"model"
+    os.remove(path)
+    assert cache.get(path).payload() == b"model"
+
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 1
+    assert cache.stats["loads"] == 1
+
+
+def test_missing_model(tmp_path):
+    cache = ModelCache()
+
+    assert cache.get(str(tmp_path / "AA:BB:CC:DD:EE:FF")) is None
+
+
+def test_load_replaces_the_cached_model(tmp_path):
+    path = write(tmp_path / "AA:BB:CC:DD:EE:FF", b"old")
+    cache = ModelCache()
+    cache.get(path)
+
+    write(path, b"new")
+    cache.load(path, version=2)
+
+    blob = cache.get(path)
+    assert blob.payload() == b"new"
+    assert blob.version == 2
+
+
+def test_byte_budget(tmp_path):
+    a = write(tmp_path / "a", b"x" * 60)
+    b = write(tmp_path / "b", b"x" * 60)
+    cache = ModelCache(max_bytes=100)
+
+    cache.get(a)
+    cache.get(b)
+
+    assert cache.memory() == 60
+    assert cache.stats["evictions"] == 1
+
+
+def test_large_models_are_mapped(tmp_path):
+    path = write(tmp_path / "a", b"x" * 200)
+    cache = ModelCache(max_bytes=100, mmap_threshold=100)
+
+    blob = cache.get(path)
+    assert blob.mapped
+    assert blob.payload() == b"x" * 200
+    assert cache.memory() == 0
+
+
+def test_mapped_models_are_bounded(tmp_path):
+    paths = [write(tmp_path / name, b"x" * 200) for name in "abc"]
+    cache = ModelCache(mmap_threshold=100, max_mapped=2)
+
+    blobs = [cache.get(path) for path in paths]
+
+    assert cache.stats["evictions"] == 1
+    assert cache._mapped == 2
+    assert blobs[0]._map.closed and not blobs[2]._map.closed
+
+    # an evicted model being served is read from its file
+    assert blobs[0].payload() == b"x" * 200
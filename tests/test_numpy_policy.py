@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from NumpyPolicy import NumpyPolicy, PolicyBatch  # noqa: E402
+
+SHAPES = [(1, 75), (75, 40), (40, 3)]
+
+
+def random_policy(rng, shapes=SHAPES):
+    size = sum(inputs * outputs + outputs for inputs, outputs in shapes)
+    return NumpyPolicy(rng.standard_normal(size).astype(np.float32), shapes)
+
+
+def reference_q_values(policy, observations):
+    x = np.asarray(observations, dtype=np.float64).reshape(-1, 1)
+    for i, (kernel, bias) in enumerate(policy.layers):
+        x = x @ kernel.astype(np.float64) + bias
+        if i < len(policy.layers) - 1:
+            x = np.maximum(x, 0)
+    return x
+
+
+def test_q_values_and_actions():
+    rng = np.random.default_rng(0)
+    policy = random_policy(rng)
+    observations = rng.uniform(0, 10, 64).astype(np.float32)
+
+    expected = reference_q_values(policy, observations)
+
+    assert np.allclose(policy.q_values(observations), expected, rtol=1e-4,
+                       atol=1e-4)
+    assert policy.actions(observations).tolist() == \
+        np.argmax(expected, axis=-1).tolist()
+    assert policy.action(observations[0]) == np.argmax(expected[0])
+
+
+def test_batch_of_devices():
+    rng = np.random.default_rng(1)
+    policies = [random_policy(rng) for _ in range(32)]
+    observations = rng.uniform(0, 10, 32)
+
+    expected = [policy.action(observation) for policy, observation in
+                zip(policies, observations)]
+
+    assert PolicyBatch(policies).actions(observations).tolist() == expected
+    assert PolicyBatch([]).actions([]).tolist() == []
+
+
+def test_save_and_load(tmp_path):
+    policy = random_policy(np.random.default_rng(2))
+    path = str(tmp_path / "model.npz")
+
+    policy.save(path)
+    loaded = NumpyPolicy.load(path)
+
+    assert loaded.weights.tobytes() == policy.weights.tobytes()
+    assert loaded.shapes.tolist() == [list(shape) for shape in SHAPES]
+    assert NumpyPolicy.load(str(tmp_path / "missing.npz")) is None
+
+
+def test_shapes_must_match_the_weights():
+    with pytest.raises(ValueError):
+        NumpyPolicy(np.zeros(10, dtype=np.float32), SHAPES)
+    with pytest.raises(ValueError):
+        PolicyBatch([random_policy(np.random.default_rng(3)),
+                     random_policy(np.random.default_rng(4),
+                                   [(1, 8), (8, 3)])])
+
+
+def test_matches_the_q_network():
+    pytest.importorskip("tf_agents")
+    import tensorflow as tf
+    from tf_agents.networks import q_network
+    from tf_agents.specs import tensor_spec
+
+    q_net = q_network.QNetwork(
+        tensor_spec.BoundedTensorSpec((1,), tf.float32, 0, 100),
+        tensor_spec.BoundedTensorSpec((1,), tf.int32, 0, 2))
+    observations = np.linspace(0, 10, 41, dtype=np.float32).reshape(-1, 1)
+    q_values, _ = q_net(observations)
+
+    policy = NumpyPolicy.from_q_network(q_net)
+
+    assert np.allclose(policy.q_values(observations), q_values.numpy(),
+                       atol=1e-5)
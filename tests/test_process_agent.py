@@ -0,0 +1,127 @@
+from DeviceStateStore import DeviceStateStore
+from ProcessDqnAgent import ProcessDqnAgent
+
+MACS = ["AA:BB:CC:DD:EE:%02X" % i for i in range(8)]
+
+
+class CountingAgent:
+    """CountingAgent stands in for the DqnAgent of a training process, it
+    applies the readings and doubles the send interval on every step.
+    """
+
+    def __init__(self, state_store):
+        self.state_store = state_store
+        self.devices = set()
+
+    def device_exists(self, mac):
+        return mac in self.devices
+
+    def add_device(self, mac):
+        self.devices.add(mac)
+
+    def train(self, mac, steps=1, before_step=None):
+        if mac not in self.devices:
+            return False
+        for i in range(steps):
+            before_step(i)
+            state = self.state_store.get(mac)
+            self.state_store.update(mac, send_interval=state.send_interval * 2,
+                                    prev_temperature=state.curr_temperature)
+        return True
+
+    def export(self, mac):
+        return 1
+
+    def save_checkpoint(self, mac):
+        pass
+
+    def cache_stats(self):
+        return {"devices": len(self.devices), "rehydration_max_seconds": 0.5}
+
+    def replay_stats(self):
+        return {"devices": {}, "memory": 64 * len(self.devices), "disk": 0}
+
+    def release(self, mac):
+        self.devices.discard(mac)
+
+    def close(self):
+        pass
+
+
+class EvictingAgent(CountingAgent):
+    """EvictingAgent keeps a single device, like an agent cache bounded to
+    one device.
+    """
+
+    def add_device(self, mac):
+        self.devices = {mac}
+
+
+def create_counting_agent(state_store, settings):
+    return CountingAgent(state_store)
+
+
+def create_evicting_agent(state_store, settings):
+    return EvictingAgent(state_store)
+
+
+def test_process_agent_trains_in_child_processes(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+    agent = ProcessDqnAgent(processes=2, state_store=store,
+                            factory=create_counting_agent)
+    try:
+        for mac in MACS:
+            agent.add_device(mac)
+        assert sorted(agent.devices) == MACS
+
+        for mac in MACS:
+            def observe(i):
+                store.observe(mac, 20.0 + i)
+
+            assert agent.train(mac, steps=3, before_step=observe)
+            assert agent.needs_export(mac)
+
+        # the state computed by the process is applied to the Hades store
+        state = store.get(MACS[0])
+        assert state.send_interval == 8
+        assert state.prev_temperature == 22.0
+
+        assert agent.export(MACS[0]) == 1
+        assert not agent.needs_export(MACS[0])
+        assert len({agent.process(mac).name for mac in MACS}) == 2
+
+        # the stats came with the train replies, reading them doesn't wait
+        # for the processes.
+        for process in agent._processes.values():
+            process._lock.acquire()
+        try:
+            assert agent.cache_stats() == {"devices": len(MACS),
+                                           "rehydration_max_seconds": 0.5}
+            assert agent.replay_stats() == {"memory": 64 * len(MACS),
+                                            "disk": 0}
+        finally:
+            for process in agent._processes.values():
+                process._lock.release()
+
+        agent.release(MACS[0])
+        assert not agent.device_exists(MACS[0])
+        assert not agent.train(MACS[0])
+    finally:
+        agent.close()
+
+
+def test_process_agent_readds_evicted_devices(tmp_path):
+    store = DeviceStateStore(str(tmp_path), flush_interval=10)
+    agent = ProcessDqnAgent(processes=1, state_store=store,
+                            factory=create_evicting_agent)
+    try:
+        agent.add_device(MACS[0])
+        agent.add_device(MACS[1])
+
+        # the process evicted the first device, it is trained all the same
+        store.update(MACS[0], send_interval=1)
+        assert agent.train(MACS[0], before_step=lambda i: store.observe(
+            MACS[0], 20.0))
+        assert store.get(MACS[0]).send_interval == 2
+    finally:
+        agent.close()
@@ -0,0 +1,130 @@
+import time
+import threading
+from Metrics import Metrics
+from Publisher import Publisher, topic_class
+
+MAC = "AA:BB:CC:DD:EE:FF"
+INTERVAL = f"hermes/node/global/{MAC}/hades/interval/receive"
+EVENT = f"node/global/{MAC}/hades/event/sent"
+
+
+class Recorder:
+
+    def __init__(self):
+        self.sent = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, topic, payload, qos, retain):
+        self.gate.wait()
+        self.sent.append((topic, payload))
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_topic_classes():
+    assert topic_class(INTERVAL) == "interval"
+    assert topic_class(f"hades/{MAC}/hades/model/receive") == "model"
+    assert topic_class(EVENT) == "event"
+    assert topic_class(f"hades/{MAC}/hades/pong") == "pong"
+    assert topic_class("hades/cluster/members/hades-1") == "other"
+
+
+def test_publishes_directly_until_started():
+    send = Recorder()
+    publisher = Publisher(send)
+
+    assert publisher.publish(INTERVAL, "5")
+    assert send.sent == [(INTERVAL, "5")]
+    assert publisher.stats["published"] == 1
+    assert publisher.pending() == 0
+
+
+def test_queued_messages_are_published_in_order():
+    send = Recorder()
+    publisher = Publisher(send, batch_size=4)
+    publisher.start()
+    try:
+        for i in range(10):
+            publisher.publish(INTERVAL, str(i))
+        publisher.flush()
+    finally:
+        publisher.stop()
+
+    assert send.sent == [(INTERVAL, str(i)) for i in range(10)]
+    assert publisher.stats["published"] == 10
+    assert publisher.stats["batches"] >= 3
+
+
+def test_full_queue_drops():
+    send = Recorder()
+    send.gate.clear()
+    publisher = Publisher(send, batch_size=1, queue_size=2)
+    publisher.start()
+
+    # the first message is held in send, two more fill the queue.
+    publisher.publish(INTERVAL, "0")
+    wait_until(lambda: publisher.pending() == 0)
+    assert publisher.publish(INTERVAL, "1")
+    assert publisher.publish(INTERVAL, "2")
+    assert not publisher.publish(INTERVAL, "3")
+
+    send.gate.set()
+    publisher.stop()
+
+    assert [payload for _, payload in send.sent] == ["0", "1", "2"]
+    assert publisher.stats["dropped"] == 1
+
+
+def test_rate_limit_only_holds_back_its_class():
+    send = Recorder()
+    publisher = Publisher(send, rates={"interval": 1, "event": 0})
+    publisher.start()
+    try:
+        for i in range(5):
+            publisher.publish(INTERVAL, str(i))
+            publisher.publish(EVENT, str(i))
+
+        # the events are not held back by the throttled intervals.
+        wait_until(lambda: publisher.stats["published"] >= 6)
+        assert [topic for topic, _ in send.sent].count(INTERVAL) == 1
+        assert publisher.pending() == 4
+    finally:
+        publisher.stop()
+
+    # stopping publishes the rest without the limit.
+    assert len(send.sent) == 10
+    assert publisher.pending() == 0
+
+
+def test_metrics():
+    metrics = Metrics(enabled=True)
+    publisher = Publisher(Recorder(), metrics=metrics)
+    publisher.start()
+    publisher.publish(INTERVAL, "5")
+    publisher.publish(EVENT, "{}")
+    publisher.stop()
+
+    text = metrics.render()
+    assert 'hades_published_total{topic_class="interval"} 1' in text
+    assert 'hades_publish_lag_seconds_count{topic_class="event"} 1' in text
+    assert publisher.stats["max_lag_seconds"] >= 0
+
+
+def test_qos_by_topic_class():
+    sent = []
+    publisher = Publisher(lambda topic, payload, qos, retain: sent.append(
+        (topic, qos)), qos={"interval": 1, "event": 2})
+
+    publisher.publish(INTERVAL, "5")
+    publisher.publish(EVENT, "{}")
+    publisher.publish(f"hades/{MAC}/hades/pong")
+    publisher.publish(INTERVAL, "5", qos=0)
+
+    assert sent == [(INTERVAL, 1), (EVENT, 2),
+                    (f"hades/{MAC}/hades/pong", 0), (INTERVAL, 0)]
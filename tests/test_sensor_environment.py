@@ -0,0 +1,23 @@
+import itertools
+import pytest
+
+pytest.importorskip("tf_agents")
+
+import tensorflow as tf  # noqa: E402
+import sensor_kernel  # noqa: E402
+from SensorEnvironment import tf_sensor_step  # noqa: E402
+
+TEMPERATURES = [-999, 18.0, 19.3, 20.0, 21.2, 22.3, 22.7, 25.0, 30.5]
+INTERVALS = [1, 2, 5]
+ACTIONS = [0, 1, 2]
+
+
+def test_tf_sensor_step_matches_the_kernel():
+    for prev, curr, interval, action in itertools.product(
+            TEMPERATURES, TEMPERATURES[1:], INTERVALS, ACTIONS):
+        delta, reward, send_interval = tf_sensor_step(
+            tf.constant(prev, tf.float64), tf.constant(curr, tf.float64),
+            tf.constant(interval, tf.float64), tf.constant(action))
+
+        assert (delta.numpy(), reward.numpy(), send_interval.numpy()) == \
+            sensor_kernel.step(prev, curr, interval, action)
@@ -0,0 +1,61 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import sensor_kernel  # noqa: E402
+
+# deltas right at and around the boundaries of the default delta of 3
+EDGES = [0.0, 1.0, 2.2, 2.3, 2.4, 2.5, 2.6, 2.9, 3.0, 3.1, 2.3 + 1e-12,
+         2.5 - 1e-12, 3.0 - 1e-12]
+
+
+def scalar_steps(prev, curr, intervals, actions, delta):
+    results = [sensor_kernel.step(p, c, i, a, delta) for p, c, i, a in
+               zip(prev.tolist(), curr.tolist(), intervals.tolist(),
+                   actions.tolist())]
+    deltas, rewards, new_intervals = zip(*results)
+    return (np.array(deltas, dtype=np.float64),
+            np.array(rewards, dtype=np.float32),
+            np.array(new_intervals, dtype=np.float64))
+
+
+def random_inputs(rng, count):
+    curr = np.round(rng.uniform(-10, 40, count), rng.integers(0, 4))
+    prev = curr + rng.choice(EDGES, count) * rng.choice([-1, 1], count)
+
+    # a part of the deltas are random and a part of the devices are new
+    random = rng.random(count) < 0.3
+    prev[random] = rng.uniform(-10, 40, random.sum())
+    prev[rng.random(count) < 0.05] = -999
+
+    intervals = rng.integers(1, 6, count).astype(np.float64)
+    actions = rng.integers(0, 3, count)
+    return prev, curr, intervals, actions
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_sensor_step_equals_scalar_step(seed):
+    rng = np.random.default_rng(seed)
+    prev, curr, intervals, actions = random_inputs(rng, 500)
+    delta = [3, 3.0, 2.5, 1][seed % 4]
+
+    expected = scalar_steps(prev, curr, intervals, actions, delta)
+    result = sensor_kernel.sensor_step(prev, curr, intervals, actions, delta)
+
+    for value, reference in zip(result, expected):
+        assert value.dtype == reference.dtype
+        assert value.tobytes() == reference.tobytes()
+
+
+def test_sensor_step_covers_every_branch():
+    prev = np.array([20.0, 20.0, 20.0, 20.0, 20.0, 20.0, -999])
+    curr = np.array([24.0, 24.0, 22.5, 21.0, 21.0, 24.0, 15.0])
+    intervals = np.array([3.0, 1.0, 2.0, 2.0, 2.0, 1.0, 1.0])
+    actions = np.array([1, 2, 0, 2, 0, 0, 2])
+
+    deltas, rewards, new_intervals = sensor_kernel.sensor_step(
+        prev, curr, intervals, actions)
+
+    assert deltas.tolist() == [4.0, 4.0, 2.5, 1.0, 1.0, 4.0, 0.0]
+    assert rewards.tolist() == [1.0, -2.0, 0.0, 1.0, -2.0, -2.0, 1.0]
+    assert new_intervals.tolist() == [2.0, 1.0, 2.0, 3.0, 2.0, 1.0, 2.0]
@@ -0,0 +1,75 @@
+import os
+import pytest
+import hades
+import simulate
+
+
+@pytest.fixture
+def simulation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.mkdir(directory)
+
+    config = hades.HadesConfig("hades.conf")
+    config.training["coalesce_window"] = 0.0
+    return simulate.Simulation(config, agent=simulate.KernelAgent)
+
+
+def test_simulation_trains_every_reading(simulation):
+    traces = simulate.synthetic_traces(devices=4, minutes=120, seed=1)
+    report = simulation.run(traces, request_every=1)
+
+    assert report["devices"] == 4
+    assert report["readings"] == sum(simulation.readings.values())
+    assert report["dropped"] == report["failed"] == 0
+    assert report["published"]["interval/receive"] > 0
+    assert 0 < report["latency_ms"]["p50"] <= report["latency_ms"]["max"]
+
+    # a device is sent its interval after the first reading and asks for it
+    # before every other one, reading less often once the interval grows.
+    for mac, device in report["per_device"].items():
+        assert len(simulation.client.intervals[mac]) == device["readings"]
+        if device["final_interval"] > 1:
+            assert device["readings"] < 120
+
+
+def test_read_traces(tmp_path):
+    path = tmp_path / "trace.csv"
+    path.write_text("mac,temperature\n"
+                    "AA:BB:CC:DD:EE:01,20.5\n"
+                    "AA:BB:CC:DD:EE:02,18\n"
+                    "AA:BB:CC:DD:EE:01,21\n")
+
+    assert simulate.read_traces(str(path)) == {
+        "AA:BB:CC:DD:EE:01": [20.5, 21.0],
+        "AA:BB:CC:DD:EE:02": [18.0],
+    }
+
+
+def test_percentile():
+    values = list(range(1, 101))
+
+    assert simulate.percentile(values, 50) == 50
+    assert simulate.percentile(values, 99) == 99
+    assert simulate.percentile(values, 100) == 100
+    assert simulate.percentile([], 50) == 0.0
+
+
+def test_failed_training_does_not_stall_the_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ("models", "states", "checkpoints", "policies"):
+        os.mkdir(directory)
+
+    class FailingAgent(simulate.KernelAgent):
+        def train(self, mac, steps=1, before_step=None):
+            raise RuntimeError("training failed")
+
+    config = hades.HadesConfig("hades.conf")
+    config.training["coalesce_window"] = 0.0
+    simulation = simulate.Simulation(config, agent=FailingAgent)
+    report = simulation.run(simulate.synthetic_traces(devices=2, minutes=5,
+                                                      seed=1))
+
+    assert report["failed"] == sum(simulation.readings.values()) == 10
+    assert report["readings"] == 0
+    assert report["latency_ms"]["max"] == 0
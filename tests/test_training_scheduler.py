@@ -0,0 +1,151 @@
+import threading
+from TrainingScheduler import TrainingScheduler
+
+
+def test_submit_keeps_device_order():
+    done = []
+
+    def handler(key, items):
+        done.extend((key, i) for i in items)
+
+    scheduler = TrainingScheduler(handler, workers=3, queue_depth=32)
+    scheduler.start()
+
+    for i in range(20):
+        scheduler.submit("AA:BB:CC:DD:EE:FF", i)
+        scheduler.submit("AA:BB:CC:DD:EE:00", i)
+
+    scheduler.join()
+    scheduler.stop()
+
+    for mac in ("AA:BB:CC:DD:EE:FF", "AA:BB:CC:DD:EE:00"):
+        assert [i for key, i in done if key == mac] == list(range(20))
+    assert scheduler.stats["completed"] == 40
+
+
+def test_submit_rejects_when_queue_full():
+    release = threading.Event()
+    scheduler = TrainingScheduler(lambda key, items: release.wait(),
+                                  workers=1, queue_depth=2)
+
+    # workers are not started, so nothing is taken from the queue
+    assert scheduler.submit("AA:BB:CC:DD:EE:FF", 1) is True
+    assert scheduler.submit("AA:BB:CC:DD:EE:FF", 2) is True
+    assert scheduler.submit("AA:BB:CC:DD:EE:FF", 3) is False
+    assert scheduler.submit("AA:BB:CC:DD:EE:00", 1) is True
+
+    assert scheduler.pending("AA:BB:CC:DD:EE:FF") == 2
+    assert scheduler.pending() == 3
+    assert scheduler.stats["rejected"] == 1
+
+    release.set()
+    scheduler.start()
+    scheduler.join()
+    scheduler.stop()
+    assert scheduler.pending() == 0
+
+
+def test_device_is_never_trained_concurrently():
+    lock = threading.Lock()
+    running = set()
+    overlap = []
+
+    def handler(key, items):
+        with lock:
+            if key in running:
+                overlap.append(key)
+            running.add(key)
+        threading.Event().wait(0.001)
+        with lock:
+            running.discard(key)
+
+    scheduler = TrainingScheduler(handler, workers=4)
+    scheduler.start()
+    for i in range(10):
+        scheduler.submit("AA:BB:CC:DD:EE:FF", i)
+    scheduler.join()
+    scheduler.stop()
+
+    assert overlap == []
+
+
+def test_burst_is_coalesced_into_one_run():
+    runs = []
+    scheduler = TrainingScheduler(lambda key, items: runs.append(items),
+                                  workers=2, window=0.05)
+    scheduler.start()
+
+    for i in range(5):
+        scheduler.submit("AA:BB:CC:DD:EE:FF", i)
+
+    scheduler.join()
+    scheduler.stop()
+
+    assert runs == [[0, 1, 2, 3, 4]]
+    assert scheduler.stats["submitted"] == 5
+    assert scheduler.stats["runs"] == 1
+    assert scheduler.coalescing_ratio() == 5.0
+
+
+def test_join_does_not_take_the_wakeup_of_a_worker():
+    scheduler = TrainingScheduler(lambda key, items: None, workers=1)
+    scheduler.start()
+
+    for i in range(50):
+        # a joiner waits while the worker is idle, the next submit must
+        # still reach the worker.
+        joined = threading.Event()
+        busy = threading.Event()
+
+        def join():
+            busy.wait()
+            scheduler.join()
+            joined.set()
+
+        joiner = threading.Thread(target=join, daemon=True)
+        joiner.start()
+        scheduler.submit("AA:BB:CC:DD:EE:FF", i)
+        busy.set()
+
+        assert joined.wait(5)
+        joiner.join(5)
+
+    scheduler.stop()
+    assert scheduler.stats["completed"] == 50
+
+
+def test_discard_drops_the_queue_and_waits_for_the_run():
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def handler(key, items):
+        started.set()
+        release.wait(5)
+        done.extend(items)
+
+    scheduler = TrainingScheduler(handler, workers=1)
+    scheduler.start()
+    scheduler.submit("AA:BB:CC:DD:EE:FF", 1)
+    assert started.wait(5)
+    scheduler.submit("AA:BB:CC:DD:EE:FF", 2)
+    scheduler.submit("AA:BB:CC:DD:EE:FF", 3)
+
+    discarded = []
+    discard = threading.Thread(target=lambda: discarded.append(
+        scheduler.discard("AA:BB:CC:DD:EE:FF")), daemon=True)
+    discard.start()
+    discard.join(0.05)
+    assert discarded == []
+
+    release.set()
+    discard.join(5)
+    assert discarded == [2]
+    assert done == [1]
+
+    # a discarded device is scheduled again on the next item.
+    scheduler.submit("AA:BB:CC:DD:EE:FF", 4)
+    scheduler.join()
+    scheduler.stop()
+    assert done == [1, 4]
+    assert scheduler.pending() == 0
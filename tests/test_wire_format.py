@@ -0,0 +1,36 @@
+import pytest
+import wire_format
+
+
+def test_statistics_round_trip():
+    readings = [(20.5, 1700000000), (21.25, 1700000060), (-3.5, 0)]
+    payload = wire_format.encode_statistics(readings)
+
+    assert len(payload) == 2 + 8 * len(readings)
+    assert wire_format.decode_statistics(payload) == [
+        (20.5, 1700000000), (21.25, 1700000060), (-3.5, None)]
+    assert wire_format.decode_statistics(bytearray(payload))[0][0] == 20.5
+
+
+def test_interval_round_trip():
+    payload = wire_format.encode_interval(7)
+
+    assert payload == b"\x01\x07\x00\x00\x00"
+    assert wire_format.decode_interval(payload) == 7
+
+
+def test_malformed_payloads():
+    payload = wire_format.encode_statistics([(20.5, 0)])
+
+    for bad in (b"", b"\x02" + payload[1:], payload[:-1], payload + b"\x00"):
+        with pytest.raises(ValueError):
+            wire_format.decode_statistics(bad)
+    with pytest.raises(ValueError):
+        wire_format.decode_interval(b"\x01\x07")
+    with pytest.raises(ValueError):
+        wire_format.encode_statistics([(20.0, 0)] * 256)
+
+
+def test_is_binary():
+    assert wire_format.is_binary("hades/global/mac/statistics/bin")
+    assert not wire_format.is_binary("hades/global/mac/statistics")
@@ -0,0 +1,82 @@
+import struct
+
+# the devices which speak the binary format publish on, and are answered on,
+# the topics of the JSON messages with this suffix.
+SUFFIX = "/bin"
+
+VERSION = 1
+
+# statistics: the version and the number of readings, followed by every
+# reading as its temperature and the unix time it was read at, 0 if unknown.
+STATISTICS_HEADER = struct.Struct("<BB")
+READING = struct.Struct("<fI")
+MAX_READINGS = 255
+
+# interval reply: the version and the send interval.
+INTERVAL = struct.Struct("<BI")
+
+
+def is_binary(topic):
+    """is_binary returns True if the message on the topic is in the binary
+    format.
+    """
+    return topic.endswith(SUFFIX)
+
+
+def _check_version(payload):
+    if not payload:
+        raise ValueError("empty payload")
+    if payload[0] != VERSION:
+        raise ValueError("unsupported wire format version %d" % payload[0])
+
+
+def encode_statistics(readings):
+    """encode_statistics returns the binary statistics of the readings, a
+    list of (temperature, timestamp) in the order they were read.
+    """
+    if len(readings) > MAX_READINGS:
+        raise ValueError("at most %d readings fit a message" % MAX_READINGS)
+
+    payload = bytearray(STATISTICS_HEADER.size + READING.size * len(readings))
+    STATISTICS_HEADER.pack_into(payload, 0, VERSION, len(readings))
+    offset = STATISTICS_HEADER.size
+    for temperature, timestamp in readings:
+        READING.pack_into(payload, offset, temperature, int(timestamp or 0))
+        offset += READING.size
+    return bytes(payload)
+
+
+def decode_statistics(payload):
+    """decode_statistics returns the readings of binary statistics as a list
+    of (temperature, timestamp), the timestamp is None if it is unknown.
+    Raises ValueError if the payload is malformed.
+    """
+    payload = memoryview(payload)
+    _check_version(payload)
+    if len(payload) < STATISTICS_HEADER.size:
+        raise ValueError("truncated statistics header")
+
+    _, count = STATISTICS_HEADER.unpack_from(payload)
+    body = payload[STATISTICS_HEADER.size:]
+    if len(body) != count * READING.size:
+        raise ValueError("expected %d readings in %d bytes" %
+                         (count, len(body)))
+
+    return [(temperature, timestamp or None)
+            for temperature, timestamp in READING.iter_unpack(body)]
+
+
+def encode_interval(send_interval):
+    """encode_interval returns the binary interval reply."""
+    return INTERVAL.pack(VERSION, int(send_interval))
+
+
+def decode_interval(payload):
+    """decode_interval returns the send interval of a binary interval reply.
+    Raises ValueError if the payload is malformed.
+    """
+    _check_version(payload)
+    if len(payload) != INTERVAL.size:
+        raise ValueError("expected %d bytes of an interval reply" %
+                         INTERVAL.size)
+    return INTERVAL.unpack(payload)[1]